@@ -3,12 +3,17 @@
 import os
 import sys
 import json
+import shutil
+import logging
+import tempfile
 import warnings
 import argparse
 
 from dejavu import Dejavu
 from dejavu.recognize import FileRecognizer
 from dejavu.recognize import MicrophoneRecognizer
+from dejavu.recognize import TimelineRecognizer
+from dejavu.profiling import Profiler, merge_profiles
 from argparse import RawTextHelpFormatter
 
 warnings.filterwarnings("ignore")
@@ -16,9 +21,9 @@ warnings.filterwarnings("ignore")
 DEFAULT_CONFIG_FILE = "dejavu.cnf.SAMPLE"
 
 
-def init(configpath):
+def init(configpath, **options):
     """ 
-    Load config from a JSON file
+    Load config from a JSON file, `options` override its settings
     """
     try:
         with open(configpath) as f:
@@ -26,11 +31,26 @@ def init(configpath):
     except IOError as err:
         print("Cannot open configuration: %s. Exiting" % (str(err)))
         sys.exit(1)
+    config.update(options)
 
     # create a Dejavu instance
     return Dejavu(config)
 
 
+def report_progress(result):
+    """
+    Prints a single line per song fingerprinted by `fingerprint_directory`.
+    """
+    if result.error is not None:
+        print("[%d/%d] Failed: %s" % (result.index, result.total, result.error))
+    else:
+        print("[%d/%d] %s (%d hashes)" % (result.index, result.total,
+                                          result.song_name, result.num_hashes))
+    if result.progress is not None and result.progress.eta is not None:
+        print("        %.2f files/s, ETA %ds" % (result.progress.files_per_sec,
+                                                result.progress.eta))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="Dejavu: Audio Fingerprinting library",
@@ -49,10 +69,40 @@ if __name__ == '__main__':
                              'playing through the microphone\n'
                              'Usage: \n'
                              '--recognize mic number_of_seconds \n'
-                             '--recognize file path/to/file \n')
+                             '--recognize listen max_number_of_seconds \n'
+                             '--recognize file path/to/file \n'
+                             '--recognize timeline path/to/recording \n')
+    parser.add_argument('-q', '--enqueue', nargs=2,
+                        help='Add the files of a directory to the job queue\n'
+                             'Usage: \n'
+                             '--enqueue /path/to/directory extension\n')
+    parser.add_argument('-w', '--work', action='store_true',
+                        help='Fingerprint files from the job queue until it\n'
+                             'is empty\n')
+    parser.add_argument('--wait', action='store_true',
+                        help='With --work, keep waiting for new files\n')
+    parser.add_argument('-k', '--catalog', nargs='?',
+                        help='Catalog to fingerprint into or recognize from\n'
+                             'Usage: \n'
+                             '--catalog name\n')
+    parser.add_argument('-p', '--profile', nargs='?',
+                        help='Profile the run, workers included, and write\n'
+                             'OUTPUT.pstats and OUTPUT.collapsed (flame graph)\n'
+                             'Usage: \n'
+                             '--profile OUTPUT\n')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='With --profile, also measure memory per stage\n'
+                             'into OUTPUT.memory.txt\n')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='Increase logging output, repeat for debug output\n')
     args = parser.parse_args()
 
-    if not args.fingerprint and not args.recognize:
+    logging.basicConfig(
+        format="%(asctime)s %(processName)s %(name)s %(levelname)s: %(message)s",
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)])
+
+    if not (args.fingerprint or args.recognize or args.enqueue or
+            args.work):
         parser.print_help()
         sys.exit(0)
 
@@ -61,7 +111,18 @@ if __name__ == '__main__':
         config_file = DEFAULT_CONFIG_FILE
         # print "Using default config file: %s" % (config_file)
 
-    djv = init(config_file)
+    options = {}
+    profiler = None
+    if args.profile:
+        # every process profiled writes its files here
+        profile_dir = tempfile.mkdtemp(prefix="dejavu-profile-")
+        options["profile"] = {"dir": profile_dir,
+                              "memory": args.profile_memory}
+        options["timings"] = True
+        profiler = Profiler(memory=args.profile_memory)
+        profiler.start()
+
+    djv = init(config_file, **options)
     if args.fingerprint:
         # Fingerprint all files in a directory
         if len(args.fingerprint) == 2:
@@ -69,14 +130,28 @@ if __name__ == '__main__':
             extension = args.fingerprint[1]
             print("Fingerprinting all .%s files in the %s directory"
                   % (extension, directory))
-            djv.fingerprint_directory(directory, ["." + extension], 4)
+            djv.fingerprint_directory(directory, ["." + extension], 4,
+                                      callback=report_progress,
+                                      catalog=args.catalog)
+            djv.retry_quarantined(callback=report_progress)
+            djv.close()
 
         elif len(args.fingerprint) == 1:
             filepath = args.fingerprint[0]
             if os.path.isdir(filepath):
                 print("Please specify an extension if you'd like to fingerprint a directory!")
                 sys.exit(1)
-            djv.fingerprint_file(filepath)
+            djv.fingerprint_file(filepath, catalog=args.catalog)
+
+    elif args.enqueue:
+        directory, extension = args.enqueue
+        count = djv.enqueue_directory(directory, ["." + extension],
+                                      catalog=args.catalog)
+        print("Offered %d files to the job queue" % count)
+
+    elif args.work:
+        djv.process_queue(4, callback=report_progress, wait=args.wait)
+        djv.close()
 
     elif args.recognize:
         # Recognize audio source
@@ -85,9 +160,30 @@ if __name__ == '__main__':
         opt_arg = args.recognize[1]
 
         if source in ('mic', 'microphone'):
-            song = djv.recognize(MicrophoneRecognizer, seconds=opt_arg)
+            song = djv.recognize(MicrophoneRecognizer, seconds=opt_arg,
+                                 catalog=args.catalog)
+        elif source == 'listen':
+            song = MicrophoneRecognizer(djv).listen(
+                max_seconds=float(opt_arg), catalog=args.catalog)
         elif source == 'file':
-            song = djv.recognize(FileRecognizer, opt_arg)
-        print(song)
+            song = djv.recognize(FileRecognizer, opt_arg,
+                                 catalog=args.catalog)
+        elif source == 'timeline':
+            recognizer = TimelineRecognizer(djv)
+            for entry in recognizer.iter_timeline(opt_arg,
+                                                  catalog=args.catalog):
+                print(entry)
+        if source != 'timeline':
+            print(song)
+
+    if profiler is not None:
+        djv.close()
+        profiler.stop()
+        profiler.save(profile_dir, "main")
+        stats = merge_profiles(profile_dir, args.profile)
+        shutil.rmtree(profile_dir)
+        stats.sort_stats("cumulative").print_stats(25)
+        print("Profile written to %s.pstats and %s.collapsed"
+              % (args.profile, args.profile))
 
     sys.exit(0)
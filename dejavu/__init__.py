@@ -1,12 +1,77 @@
 import os
 import sys
+import binascii
 import time
-import traceback
+import logging
+import functools
+import itertools
+import threading
 import fingerprint
-import multiprocessing
 
-from dejavu.database import get_database, Database
+from collections import namedtuple
+from operator import itemgetter
+
+from dejavu.align import Aligner
+from dejavu.database import get_database, Database, SongHashSet
+from dejavu.cache import ResultCache, DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL
+from dejavu.timing import (StageTimer, NULL_TIMER, STAGE_DECODE, STAGE_DEDUPE,
+                           STAGE_QUERY, STAGE_ALIGN, STAGE_STORE,
+                           COUNT_SAMPLES, COUNT_HASHES_SENT, COUNT_ROWS,
+                           COUNT_CHUNKS)
+from dejavu.scheduler import (IngestScheduler, DEFAULT_MAXTASKSPERCHILD,
+                              DEFAULT_TIMEOUT_BASE, DEFAULT_TIMEOUT_PER_MB,
+                              DEFAULT_PREFETCH, ORDER_SIZE)
+from dejavu.jobqueue import (open_queue, LeaseKeeper, LeaseLost,
+                             DEFAULT_LEASE, DEFAULT_POLL)
 import dejavu.decoder as decoder
+import dejavu.metrics as metrics
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Per-song outcome handed to progress callbacks and yielded by
+# `Dejavu.iter_fingerprint_directory`. `song_id` is None and `error` is set
+# when the song could not be fingerprinted. `progress` is an
+# `IngestProgress` with throughput and ETA of the batch, or None.
+# `duplicate` is True when the file was linked to the existing song
+# `song_id` instead of having its fingerprints stored. `timings` and
+# `counts` hold the seconds spent per stage and the samples, peaks and
+# hashes of the song (see `dejavu.timing`), None when it failed.
+IngestResult = namedtuple('IngestResult', (
+    'filename', 'song_name', 'file_sha1', 'song_id', 'num_hashes',
+    'error', 'index', 'total', 'progress', 'duplicate', 'timings',
+    'counts'))
+
+# Seconds between two checks of the active fingerprint version, so
+# processes follow a switch made by another one.
+DEFAULT_VERSION_CHECK_INTERVAL = 5
+
+
+class FingerprintVersionChanged(Exception):
+    """
+    The active fingerprint version changed while a song was fingerprinted,
+    its hashes were made with parameters no longer in use.
+    """
+    pass
+
+# Hashes stored per transaction, the ingestion journal of a song moves past
+# every batch so an interrupted ingestion resumes at the last one stored.
+DEFAULT_JOURNAL_BATCH = 10000
+
+# Seconds after which a song whose ingestion stopped is deleted, unless the
+# next run fingerprinting its file resumed it in the meantime.
+DEFAULT_UNFINISHED_MAX_AGE = 24 * 3600
+
+# Number of hashes of a new song looked up to find near-duplicates and the
+# fraction of them that must align with an existing song to link to it.
+DEFAULT_DEDUPE_SAMPLE = 1000
+DEFAULT_DEDUPE_THRESHOLD = 0.2
+
+# Defaults of the progressive query mode: aligned matches the leading song
+# needs, how many times the runner-up's it needs, and hashes per round trip.
+DEFAULT_PROGRESSIVE_CONFIDENCE = 20
+DEFAULT_PROGRESSIVE_MARGIN = 2.0
+DEFAULT_PROGRESSIVE_CHUNK = 250
 
 class Dejavu(object):
     SONG_ID = "song_id"
@@ -15,6 +80,8 @@ class Dejavu(object):
     MATCH_TIME = 'match_time'
     OFFSET = 'offset'
     OFFSET_SECS = 'offset_seconds'
+    TIMINGS = 'timings'
+    COUNTS = 'counts'
 
     def __init__(self, config):
         super(Dejavu, self).__init__()
@@ -28,123 +95,1037 @@ class Dejavu(object):
         self.db = db_cls(**config.get("database", {}))
         self.db.setup()
 
+        # hash budget of every query and hashes it skips, see
+        # `query_hashes`
+        self.query_config = self.config.get("query") or {}
+
+        # queries run on several threads at once (segments of a file,
+        # monitored streams...), the state they load on first use or
+        # refresh is only ever (re)loaded by one of them
+        self._state_lock = threading.RLock()
+
+        # parameters of the active fingerprint version, every hash stored or
+        # looked up is made with them
+        self.fingerprint_version = None
+        self.fingerprint_params = dict(fingerprint.DEFAULT_PARAMS)
+        self.version_check_interval = self.config.get(
+            "fingerprint_version_interval", DEFAULT_VERSION_CHECK_INTERVAL)
+        self.load_fingerprint_version()
+
         # if we should limit seconds fingerprinted,
         # None|-1 means use entire track
         self.limit = self.config.get("fingerprint_limit", None)
         if self.limit == -1:  # for JSON compatibility
             self.limit = None
-    
-        # get songs previously indexed
-        self.update_songs()
+
+        # worker pool shared by every `fingerprint_directory` call, created
+        # on first use and released by `close`
+        self.ingest_config = self.config.get("ingest", {})
+        self.scheduler = None
+        self.reclaim_unfinished_songs()
+
+        # sha1s of songs previously indexed, only loaded when asked for,
+        # ingestion checks the database in batches otherwise
+        self._songhashes_set = None
+        # song id => (raw sha1, time first seen) of the songs that were
+        # still being fingerprinted when last pulled
+        self._songs_unfinished = {}
+        # seconds between incremental refreshes of the loaded song set,
+        # None only refreshes on `refresh_songs`
+        self.song_refresh_interval = self.config.get("song_refresh_interval")
+        self._songs_refreshed = None
+
+        # optional cache of recognition results, see `get_songs_version`
+        # for how it's invalidated
+        cache_config = self.config.get("cache")
+        self.result_cache = None
+        if cache_config:
+            self.result_cache = ResultCache(
+                cache_config.get("size", DEFAULT_CACHE_SIZE),
+                cache_config.get("ttl", DEFAULT_CACHE_TTL))
+        self._songs_changes = 0
+        self._db_num_songs = None
+        self._db_songs_checked = None
+
+        # catalog of every file handed to the scheduler and not stored yet,
+        # so quarantined files keep theirs when retried
+        self._catalogs = {}
+        # `Database.UnfinishedSong` of every file handed to the scheduler
+        # whose interrupted ingestion it continues
+        self._resumes = {}
+
+        # ingestion job queue shared with other processes and hosts, opened
+        # on first use
+        self.job_queue = None
+
+        # metrics are always collected, exported when configured
+        self.metrics_exporter = metrics.start_exporter(
+            self.config.get("metrics"))
 
     def update_songs(self):
-        self.songs = self.db.get_songs()
-        self.songhashes_set = set()  # to know which ones we've computed before
-        for song in self.songs:
-            song_hash = song._asdict()[Database.FIELD_FILE_SHA1]
-            self.songhashes_set.add(song_hash)
+        """
+        (Re)loads the sha1 of every fingerprinted song from the database.
+        """
+        with self._state_lock:
+            songs = SongHashSet(self.db.get_song_aliases())
+            # every song up to the high-water mark has been seen, the
+            # fingerprinted ones are in the set, `_num_songs` of them
+            self._songs_hwm = 0
+            self._songs_unfinished = {}
+            self._num_songs = 0
+            # filled before other threads get to see it
+            self._pull_songs(songs)
+            self._songhashes_set = songs
+
+    def refresh_songs(self):
+        """
+        Brings the loaded song set up to date, pulling only the songs added
+        since the last refresh. Reloads everything when songs were removed.
+        Files linked to existing songs by other processes are only picked up
+        by full reloads.
+        """
+        with self._state_lock:
+            if self._songhashes_set is None:
+                # nothing cached, lookups go to the database
+                return
+            self._pull_songs(self._songhashes_set)
+            if self._num_songs != self.db.get_num_songs():
+                logger.info("Songs were removed from the database, reloading")
+                self.update_songs()
+
+    def get_songs_version(self):
+        """
+        Returns a value that changes whenever the set of songs does, used to
+        invalidate cached recognition results. Songs stored by this process
+        change it right away, changes made by other processes are noticed
+        every `song_refresh_interval` seconds when that is set.
+        """
+        with self._state_lock:
+            now = time.time()
+            if (self.song_refresh_interval is not None and
+                    (self._db_songs_checked is None or
+                     now - self._db_songs_checked >=
+                     self.song_refresh_interval)):
+                self._db_num_songs = self.db.get_num_songs()
+                self._db_songs_checked = now
+            return (self._songs_changes, self._db_num_songs,
+                    self.fingerprint_version)
+
+    def load_fingerprint_version(self):
+        """
+        (Re)reads the active fingerprint version and the parameters it was
+        built with.
+        """
+        with self._state_lock:
+            active = self.db.get_active_fingerprint_version()
+            if active is None:
+                version, params = None, {}
+            else:
+                version, params = active.version, active.params
+            self.fingerprint_params = dict(fingerprint.DEFAULT_PARAMS,
+                                           **params)
+            self.fingerprint_version = version
+            self._version_checked = time.time()
+            # common hashes of the previous version mean nothing in this one
+            self._common_hashes = None
+
+    def maybe_refresh_fingerprint_version(self):
+        """
+        Reloads the active fingerprint version when
+        `fingerprint_version_interval` has passed, picking up switches made
+        by other processes.
+        """
+        if not self._version_check_due():
+            return
+        with self._state_lock:
+            # another thread may have reloaded it while this one waited
+            if not self._version_check_due():
+                return
+            previous = self.fingerprint_version
+            self.load_fingerprint_version()
+            if self.fingerprint_version != previous:
+                logger.info("Fingerprint version %s is now active",
+                            self.fingerprint_version)
+                self._songs_changes += 1
+
+    def _version_check_due(self):
+        return (self.version_check_interval is not None and
+                time.time() - self._version_checked >=
+                self.version_check_interval)
+
+    def maybe_refresh_songs(self):
+        """
+        Calls `refresh_songs` when `song_refresh_interval` has passed.
+        """
+        if (self.song_refresh_interval is not None and
+                self._songs_refreshed is not None and
+                time.time() - self._songs_refreshed >= self.song_refresh_interval):
+            with self._state_lock:
+                if time.time() - self._songs_refreshed >= \
+                        self.song_refresh_interval:
+                    self.refresh_songs()
+
+    def _pull_songs(self, songs):
+        """
+        Adds the fingerprinted songs above the high-water mark to `songs`
+        and moves the mark past every song seen. Songs still being
+        fingerprinted are looked up again by sha1 on the next pulls, until
+        they are done or `unfinished_max_age` has passed and they are
+        reclaimed, so they don't hold the mark back.
+        """
+        now = time.time()
+        hwm = self._songs_hwm
+        digests = []
+        for sid, digest, fingerprinted in self.db.get_songs_after(hwm):
+            hwm = max(hwm, sid)
+            if fingerprinted:
+                digests.append(digest)
+            else:
+                self._songs_unfinished[sid] = (digest, now)
+
+        if self._songs_unfinished:
+            done = self.db.filter_fingerprinted(
+                [binascii.hexlify(digest).upper() for digest, _
+                 in self._songs_unfinished.itervalues()])
+            done = set(file_sha1.upper() for file_sha1 in done)
+            max_age = self.ingest_config.get("unfinished_max_age",
+                                             DEFAULT_UNFINISHED_MAX_AGE)
+            for sid, (digest, seen) in self._songs_unfinished.items():
+                if binascii.hexlify(digest).upper() in done:
+                    digests.append(digest)
+                elif max_age is None or now - seen < max_age:
+                    continue
+                del self._songs_unfinished[sid]
+
+        if digests:
+            self._songs_changes += 1
+        songs.update(digests)
+        self._songs_hwm = hwm
+        self._num_songs += len(digests)
+        self._songs_refreshed = now
+
+    def reclaim_unfinished_songs(self):
+        """
+        Deletes the songs whose ingestion stopped more than
+        `unfinished_max_age` seconds ago and was not resumed since, see
+        `Database.delete_stale_songs`. Done when Dejavu starts.
+        """
+        max_age = self.ingest_config.get("unfinished_max_age",
+                                         DEFAULT_UNFINISHED_MAX_AGE)
+        if max_age is not None:
+            self.db.delete_stale_songs(max_age)
+
+    @property
+    def songhashes_set(self):
+        if self._songhashes_set is None:
+            with self._state_lock:
+                if self._songhashes_set is None:
+                    self.update_songs()
+        return self._songhashes_set
 
     def get_fingerprinted_songs(self):
         return self.songhashes_set
 
-    def fingerprint_directory(self, path, extensions, nprocesses=None):
-        # Try to use the maximum amount of processes if not given.
-        try:
-            nprocesses = nprocesses or (multiprocessing.cpu_count() - 1)
-        except NotImplementedError:
-            nprocesses = 1
-        else:
-            nprocesses = 1 if (nprocesses <= 0) else nprocesses
+    def is_fingerprinted(self, file_hashes, catalog=None):
+        """
+        Returns which of the given file sha1s are already fingerprinted,
+        from the song set when it is loaded, from the database otherwise.
+        With a `catalog` only songs of that catalog count, which always
+        asks the database.
+        """
+        if catalog is not None:
+            return self.db.filter_fingerprinted(file_hashes, catalog=catalog)
+        if self._songhashes_set is not None:
+            self.maybe_refresh_songs()
+            return set(h for h in file_hashes if h in self._songhashes_set)
+        return self.db.filter_fingerprinted(file_hashes)
+
+    def fingerprint_directory(self, path, extensions, nprocesses=None,
+                              callback=None, catalog=None):
+        """
+        Fingerprints every file below `path` matching `extensions`, into
+        `catalog` when given.
 
-        pool = multiprocessing.Pool(nprocesses)
+        `callback`, when given, is called with an `IngestResult` for every
+        song as soon as it has been stored (or has failed).
+        """
+        for result in self.iter_fingerprint_directory(path, extensions,
+                                                      nprocesses=nprocesses,
+                                                      catalog=catalog):
+            if callback is not None:
+                callback(result)
 
+    def iter_fingerprint_directory(self, path, extensions, nprocesses=None,
+                                   catalog=None):
+        """
+        Generator version of `fingerprint_directory`, yields an
+        `IngestResult` per song in completion order.
+        """
         filenames_to_fingerprint = []
-        for filename, _ in decoder.find_files(path, extensions):
+        new_files = self._find_new_files(path, extensions, catalog)
+        for filename, _ in new_files:
+            logger.debug("Adding '%s' to Queue", filename)
+            filenames_to_fingerprint.append(filename)
+            self._catalogs[filename] = catalog
+        self._plan_resumes([(filename, file_hash, catalog)
+                            for filename, file_hash in new_files])
+
+        if not filenames_to_fingerprint:
+            logger.info("All the files provided have already been "
+                        "fingerprinted, exiting...")
+            return
+
+        scheduler = self.get_scheduler(nprocesses)
+        logger.info("Fingerprinting %d files with %d processes",
+                    len(filenames_to_fingerprint), scheduler.nprocesses)
+
+        results = scheduler.run(self._fingerprinter(),
+                                filenames_to_fingerprint, self.limit,
+                                loader=_decode_worker,
+                                estimator=self.estimate_memory)
+        for result in self._store_results(results, self.fingerprint_version):
+            yield result
+
+    def _find_new_files(self, path, extensions, catalog=None):
+        """
+        Returns (filename, file_sha1) of the files below `path` matching
+        `extensions` that are not fingerprinted yet.
+        """
+        file_hashes = [(filename, decoder.unique_hash(filename))
+                       for filename, _ in decoder.find_files(path, extensions)]
+        fingerprinted = self.is_fingerprinted([h for _, h in file_hashes],
+                                              catalog=catalog)
+
+        new_files = []
+        for filename, file_hash in file_hashes:
             # don't refingerprint already fingerprinted files
-            if decoder.unique_hash(filename) in self.songhashes_set:
-                print "%s already fingerprinted, continuing..." % filename
-                continue
+            if file_hash in fingerprinted:
+                logger.debug("%s already fingerprinted, continuing...", filename)
             else:
-                print "Adding '%s' to Queue" % filename
-                filenames_to_fingerprint.append(filename)
+                new_files.append((filename, file_hash))
+        return new_files
 
-        if not filenames_to_fingerprint:
-            print "=============" * 3
-            print "All the files provided have already been fingerprinted, exiting..."
-            print "=============" * 3
-            return 
-
-        # Prepare _fingerprint_worker input
-        worker_input = zip(
-            filenames_to_fingerprint,
-            [self.limit, None, "wav"] * len(filenames_to_fingerprint))
-
-        # Send off our tasks
-        iterator = pool.imap_unordered(_fingerprint_worker, worker_input)
-        total_items = len(filenames_to_fingerprint)
-        songs_range = range(total_items)
-        done = []
-
-        # Loop till we have all of them
+    def get_job_queue(self):
+        """
+        Returns the ingestion job queue set with the `queue` option, see
+        `dejavu.jobqueue`.
+        """
+        if self.job_queue is None:
+            options = self.config.get("queue")
+            if options is None:
+                raise ValueError("the queue option is not set")
+            self.job_queue = open_queue(options, self.db)
+        return self.job_queue
+
+    def enqueue_directory(self, path, extensions, catalog=None):
+        """
+        Adds the files below `path` matching `extensions` that are not
+        fingerprinted yet to the job queue, to be fingerprinted into
+        `catalog` by `process_queue` in any process sharing the queue.
+        Files already queued for `catalog` are left alone unless their job
+        ended. Returns how many files were offered to the queue.
+        """
+        new_files = self._find_new_files(path, extensions, catalog)
+        self.get_job_queue().enqueue(new_files, catalog=catalog)
+        logger.info("Offered %d files to the job queue", len(new_files))
+        return len(new_files)
+
+    def process_queue(self, nprocesses=None, callback=None, wait=False):
+        """
+        Fingerprints files claimed from the job queue until it is empty,
+        or for as long as the process runs with `wait`.
+
+        `callback`, when given, is called with an `IngestResult` for every
+        song like with `fingerprint_directory`.
+        """
+        for result in self.iter_process_queue(nprocesses=nprocesses,
+                                              wait=wait):
+            if callback is not None:
+                callback(result)
+
+    def iter_process_queue(self, nprocesses=None, wait=False):
+        """
+        Generator version of `process_queue`, yields an `IngestResult` per
+        song. Their `index` and `total` count the files of the batch
+        claimed.
+
+        Files are claimed `batch` at a time with a lease of `lease` seconds,
+        renewed in the background while they are fingerprinted. With `wait`
+        the queue is polled every `poll` seconds once it is empty.
+        """
+        queue = self.get_job_queue()
+        options = self.config["queue"]
+        lease = options.get("lease", DEFAULT_LEASE)
+        scheduler = self.get_scheduler(nprocesses)
+        batch = options.get("batch") or 2 * scheduler.nprocesses
+
+        keeper = LeaseKeeper(queue, lease)
+        try:
+            while True:
+                jobs = self._claim_jobs(queue, batch, lease)
+                if not jobs:
+                    if not wait:
+                        break
+                    time.sleep(options.get("poll", DEFAULT_POLL))
+                    continue
+                for result in self._run_jobs(queue, keeper, jobs, lease):
+                    yield result
+        finally:
+            keeper.stop()
+            # claimed but not done, e.g. the caller stopped iterating
+            if keeper.held:
+                queue.release(keeper.held)
+
+    def _claim_jobs(self, queue, n, lease):
+        """
+        Claims up to `n` files from the job queue, completing right away the
+        ones fingerprinted since they were enqueued.
+        """
         while True:
-            print "=============" * 3
-            try:
-                song_name, hashes, file_hash = iterator.next()
-            except multiprocessing.TimeoutError:
+            jobs = queue.claim(n, lease)
+            fingerprinted = set()
+            for catalog in set(job.catalog for job in jobs):
+                fingerprinted.update(self.is_fingerprinted(
+                    [job.file_sha1 for job in jobs if job.catalog == catalog],
+                    catalog=catalog))
+
+            todo = []
+            for job in jobs:
+                if job.file_sha1 in fingerprinted:
+                    logger.debug("%s already fingerprinted, continuing...",
+                                 job.filename)
+                    queue.complete((job.file_sha1, job.catalog))
+                else:
+                    todo.append(job)
+            if todo or not jobs:
+                return todo
+
+    def _run_jobs(self, queue, keeper, jobs, lease):
+        """
+        Fingerprints claimed files and reports every outcome to the queue,
+        yields an `IngestResult` per song.
+        """
+        claimed, jobs = jobs, {}
+        for job in claimed:
+            if job.filename in jobs:
+                # the same file for another catalog, the scheduler runs a
+                # file once at a time
+                queue.release([(job.file_sha1, job.catalog)])
+            else:
+                jobs[job.filename] = job
+        for job in jobs.itervalues():
+            self._catalogs[job.filename] = job.catalog
+        self._plan_resumes([(job.filename, job.file_sha1, job.catalog)
+                            for job in jobs.itervalues()])
+        keeper.hold((job.file_sha1, job.catalog) for job in jobs.itervalues())
+
+        results = self.scheduler.run(self._fingerprinter(), list(jobs),
+                                     self.limit, loader=_decode_worker,
+                                     estimator=self.estimate_memory)
+        try:
+            for result in self._store_results(
+                    _owned_results(results, jobs, queue, lease),
+                    self.fingerprint_version):
+                job = jobs[result.filename]
+                key = (job.file_sha1, job.catalog)
+                if result.error is None:
+                    queue.complete(key)
+                elif not isinstance(result.error, LeaseLost):
+                    queue.fail(key, result.error)
+                keeper.drop(key)
+                yield result
+        finally:
+            # timed out files are retried through the queue, by any worker
+            quarantine = self.scheduler.quarantine
+            self.scheduler.quarantine = [filename for filename in quarantine
+                                         if filename not in jobs]
+            for filename in jobs:
+                self._catalogs.pop(filename, None)
+                self._resumes.pop(filename, None)
+
+    def retry_quarantined(self, callback=None):
+        """
+        Fingerprints the files that timed out in earlier
+        `fingerprint_directory` calls again, with a larger time budget.
+        """
+        if self.scheduler is None or not self.scheduler.quarantine:
+            return
+        results = self.scheduler.retry_quarantined(
+            self._fingerprinter(), self.limit, loader=_decode_worker,
+            estimator=self.estimate_memory)
+        for result in self._store_results(results, self.fingerprint_version):
+            if callback is not None:
+                callback(result)
+
+    def _plan_resumes(self, files):
+        """
+        Looks up which of the (filename, file_sha1, catalog) about to be
+        fingerprinted were left unfinished by an interrupted ingestion, so
+        they continue where their journal entry stops.
+        """
+        if not files:
+            return
+        unfinished = {}
+        for song in self.db.get_unfinished_songs():
+            unfinished.setdefault((song.file_sha1.upper(), song.catalog), song)
+        for filename, file_hash, catalog in files:
+            song = unfinished.pop((file_hash.upper(), catalog), None)
+            if song is None:
                 continue
-            except StopIteration:
-                break
-            except:
-                print("Failed fingerprint")
-                # Print traceback because we can't reraise it here
-                traceback.print_exc(file=sys.stdout)
+            if song.version != self.fingerprint_version:
+                # the hashes stored went away with the fingerprint table of
+                # their version
+                song = song._replace(song_offset=0)
+            logger.info("Resuming song %d (%s) at offset %d", song.song_id,
+                        filename, song.song_offset)
+            self._resumes[filename] = song
+
+    def _fingerprinter(self, params=None):
+        """
+        Returns the scheduler task fingerprinting decoded files with `params`.
+        By default these are the ones of the active fingerprint version, and
+        resumed songs are only fingerprinted from their journal offset.
+        """
+        if params is not None:
+            return functools.partial(_fingerprint_decoded, params=params)
+        offsets = dict((filename, song.song_offset) for filename, song
+                       in self._resumes.iteritems() if song.song_offset)
+        return functools.partial(_fingerprint_decoded,
+                                 params=self.fingerprint_params,
+                                 offsets=offsets)
+
+    def _store_results(self, results, version):
+        """
+        Stores the songs coming out of the scheduler, fingerprinted with the
+        parameters of fingerprint `version`, yields an `IngestResult` for
+        each of them.
+        """
+        progress = None
+        for filename, ok, value, progress in results:
+            if ok:
+                self.maybe_refresh_fingerprint_version()
+                if self.fingerprint_version != version:
+                    # stored now it would never match, fingerprinted again
+                    # by the next run
+                    ok, value = False, FingerprintVersionChanged(
+                        "Fingerprint version %s became active while %s was "
+                        "fingerprinted" % (self.fingerprint_version,
+                                           filename))
+            if not ok:
+                if filename not in self.scheduler.quarantine:
+                    self._catalogs.pop(filename, None)
+                    self._resumes.pop(filename, None)
+                metrics.SONGS_INGESTED.labels(result="failed").inc()
+                yield IngestResult(filename, None, None, None, 0, value,
+                                   progress.done, progress.total, progress,
+                                   False, None, None)
+                continue
+
+            song_name, hashes, file_hash, timer = value
+            sid, duplicate = self._ingest_song(
+                song_name, hashes, file_hash,
+                catalog=self._catalogs.pop(filename, None), timer=timer,
+                resume=self._resumes.pop(filename, None))
+            logger.debug("Stored song %d of %d %s:%s",
+                         progress.done, progress.total, song_name, file_hash)
+            _observe_ingest(len(hashes), duplicate, timer)
+            yield IngestResult(filename, song_name, file_hash, sid,
+                               len(hashes), None, progress.done,
+                               progress.total, progress, duplicate,
+                               timer.timings, timer.counts)
+
+        if progress is not None:
+            logger.info("Fingerprinted %d files in %.1fs (%.2f files/s)",
+                        progress.done, progress.elapsed,
+                        progress.files_per_sec)
+
+    def get_scheduler(self, nprocesses=None):
+        """
+        Returns the long lived ingestion scheduler, `nprocesses` overrides
+        the configured pool size.
+        """
+        nprocesses = nprocesses or self.ingest_config.get("processes")
+        if self.scheduler is None:
+            self.scheduler = IngestScheduler(
+                nprocesses,
+                maxtasksperchild=self.ingest_config.get(
+                    "maxtasksperchild", DEFAULT_MAXTASKSPERCHILD),
+                order=self.ingest_config.get("order", ORDER_SIZE),
+                timeout_base=self.ingest_config.get(
+                    "timeout_base", DEFAULT_TIMEOUT_BASE),
+                timeout_per_mb=self.ingest_config.get(
+                    "timeout_per_mb", DEFAULT_TIMEOUT_PER_MB),
+                prefetch=self.ingest_config.get("prefetch", DEFAULT_PREFETCH),
+                memory_budget=self.ingest_config.get("memory_budget"),
+                profile=self.config.get("profile"))
+        else:
+            self.scheduler.resize(nprocesses)
+        return self.scheduler
+
+    def estimate_memory(self, filename, params=None):
+        """
+        Estimates the (decoded, working) bytes fingerprinting `filename` with
+        `params` (default the active ones) takes from its duration and sample
+        rate, capped by `fingerprint_limit`.
+        """
+        info = decoder.get_audio_info(filename)
+        if info is None:
+            # assume a 128kbps 44.1kHz stereo mp3
+            info = (os.path.getsize(filename) * 8 / 128000.0, 44100, 2)
+        duration, Fs, channels = info
+        if self.limit:
+            duration = min(duration, self.limit)
+        params = params or self.fingerprint_params
+        return fingerprint.estimate_memory(duration, Fs, channels,
+                                           wsize=params["wsize"],
+                                           wratio=params["wratio"],
+                                           fan_value=params["fan_value"])
+
+    def build_fingerprint_version(self, path, extensions, params=None,
+                                  nprocesses=None, callback=None):
+        """
+        Fingerprints the songs of the library below `path` again, with
+        `params` (keyword arguments of `fingerprint.fingerprint`, the
+        defaults for the ones left out), into a new fingerprint version.
+        Recognition keeps being served from the active version meanwhile.
+
+        Files are matched to songs by sha1, files of unknown songs are
+        skipped. An unfinished build with the same parameters is resumed.
+        `callback` is called with an `IngestResult` per song. Returns the
+        version, to be switched to with `activate_fingerprint_version`.
+        """
+        params = dict(fingerprint.DEFAULT_PARAMS, **(params or {}))
+        version, done = None, set()
+        for existing in self.db.get_fingerprint_versions():
+            if existing.params != params:
+                continue
+            if existing.state == Database.VERSION_ACTIVE:
+                raise ValueError("Fingerprint version %d already uses these "
+                                 "parameters" % existing.version)
+            if existing.state == Database.VERSION_BUILDING:
+                version = existing.version
+                done = self.db.get_version_song_ids(version)
+        if version is None:
+            version = self.db.create_fingerprint_version(params)
+        logger.info("Building fingerprint version %d, %d songs done so far",
+                    version, len(done))
+
+        songs = dict((song.file_sha1, song.song_id)
+                     for song in self.db.get_songs())
+        song_ids = {}  # filename => song identifier
+        for filename, _ in decoder.find_files(path, extensions):
+            sid = songs.pop(decoder.unique_hash(filename), None)
+            if sid is not None and sid not in done:
+                song_ids[filename] = sid
+
+        if song_ids:
+            scheduler = self.get_scheduler(nprocesses)
+            results = scheduler.run(
+                self._fingerprinter(params), list(song_ids), self.limit,
+                loader=_decode_worker,
+                estimator=functools.partial(self.estimate_memory,
+                                            params=params))
+            try:
+                self._store_version_results(version, results, song_ids,
+                                            callback)
+            finally:
+                # timed out files are picked up by the next build
+                scheduler.quarantine = [filename for filename
+                                        in scheduler.quarantine
+                                        if filename not in song_ids]
+
+        logger.info("Fingerprint version %d misses %d songs", version,
+                    self.db.count_missing_version_songs(version))
+        return version
+
+    def _store_version_results(self, version, results, song_ids, callback):
+        """
+        Stores the hashes coming out of the scheduler in the shadow table of
+        `version`.
+        """
+        for filename, ok, value, progress in results:
+            if not ok:
+                result = IngestResult(filename, None, None, None, 0, value,
+                                      progress.done, progress.total, progress,
+                                      False, None, None)
             else:
-                done.append(songs_range.pop(0)) 
-                print "Inserting song %s of %s %s:%s to database" % (len(done), total_items, song_name, file_hash)
-                sid = self.db.insert_song(song_name, file_hash)
+                song_name, hashes, file_hash, timer = value
+                sid = song_ids[filename]
+                with timer.stage(STAGE_STORE):
+                    self.db.insert_version_hashes(version, sid, hashes)
+                result = IngestResult(filename, song_name, file_hash, sid,
+                                      len(hashes), None, progress.done,
+                                      progress.total, progress, False,
+                                      timer.timings, timer.counts)
+            if callback is not None:
+                callback(result)
 
-                print "inserting hashes for song %s" % song_name
-                self.db.insert_hashes(sid, hashes)
-                print "updating fingerprinted song %s" % song_name
-                self.db.set_song_fingerprinted(sid)
+    def activate_fingerprint_version(self, version, force=False,
+                                     reclaim=True):
+        """
+        Switches to a version built by `build_fingerprint_version`, in one
+        atomic swap of fingerprint tables. Other processes follow within
+        `fingerprint_version_interval` seconds.
 
-                print "updating song hashes: %s" % song_name
-                self.get_fingerprinted_songs().add(file_hash)
-            print "=============" * 3
+        Refuses while fingerprinted songs are missing from the version, e.g.
+        songs added during the build which building again picks up, unless
+        `force` is set. With `reclaim` the tables of retired versions are
+        dropped in the background, the thread doing so is returned.
+        """
+        missing = self.db.count_missing_version_songs(version)
+        if missing and not force:
+            raise ValueError("%d fingerprinted songs are missing from "
+                             "fingerprint version %d" % (missing, version))
+        retired = self.db.activate_fingerprint_version(version)
+        logger.info("Fingerprint version %d replaced version %d", version,
+                    retired)
+        previous = self.fingerprint_version
+        self.load_fingerprint_version()
+        if self.fingerprint_version != previous:
+            self._songs_changes += 1
+        if reclaim:
+            return self.reclaim_fingerprint_versions(background=True)
 
-        pool.close()
-        pool.join()
+    def reclaim_fingerprint_versions(self, background=False):
+        """
+        Drops the tables of retired fingerprint versions. With `background`
+        this is done by a daemon thread, which is returned.
+        """
+        if background:
+            thread = threading.Thread(target=self.reclaim_fingerprint_versions)
+            thread.daemon = True
+            thread.start()
+            return thread
+        for version in self.db.get_fingerprint_versions():
+            if version.state == Database.VERSION_RETIRED:
+                logger.info("Dropping retired fingerprint version %d",
+                            version.version)
+                self.db.drop_fingerprint_version(version.version)
 
-    def fingerprint_file(self, filepath, song_name=None):
+    def close(self):
+        """
+        Releases the ingestion worker pool and stops the metrics exporter,
+        writing the metrics file a last time when exporting to one.
+        """
+        if self.scheduler is not None:
+            self.scheduler.close()
+        if isinstance(self.metrics_exporter, metrics.FileExporter):
+            self.metrics_exporter.close()
+        elif self.metrics_exporter is not None:
+            self.metrics_exporter.shutdown()
+            self.metrics_exporter.server_close()
+
+    def fingerprint_file(self, filepath, song_name=None, catalog=None):
         songname = decoder.path_to_songname(filepath)
         song_hash = decoder.unique_hash(filepath)
         song_name = song_name or songname
         # don't refingerprint already fingerprinted files
-        if song_hash in self.songhashes_set:
-            print "%s already fingerprinted, continuing..." % song_name
-        else:
-            song_name, hashes, file_hash = _fingerprint_worker(
-                filepath,
-                self.limit,
-                song_name=song_name)
-
-            print "Inserting song %s:%s to database" % (song_name, file_hash)
-            sid = self.db.insert_song(song_name, file_hash)
-
-            print "Inserting hashes for song %s" % song_name
-            self.db.insert_hashes(sid, hashes)
-            
-            print "Updating fingerprinted song %s" % song_name
+        if self.is_fingerprinted([song_hash], catalog=catalog):
+            logger.info("%s already fingerprinted, continuing...", song_name)
+            return None
+
+        self._plan_resumes([(filepath, song_hash, catalog)])
+        resume = self._resumes.pop(filepath, None)
+        song_name, hashes, file_hash, timer = _fingerprint_worker(
+            filepath,
+            self.limit,
+            song_name=song_name,
+            params=self.fingerprint_params,
+            offset=resume.song_offset if resume is not None else 0)
+        sid, duplicate = self._ingest_song(song_name, hashes, file_hash,
+                                           catalog=catalog, timer=timer,
+                                           resume=resume)
+        _observe_ingest(len(hashes), duplicate, timer)
+        return IngestResult(filepath, song_name, file_hash, sid,
+                            len(hashes), None, 1, 1, None, duplicate,
+                            timer.timings, timer.counts)
+
+    def _ingest_song(self, song_name, hashes, file_hash, catalog=None,
+                     timer=None, resume=None):
+        """
+        Stores a fingerprinted song, or links it to an existing song of the
+        same catalog when near-duplicate detection is enabled and finds one.
+        `resume` is the `Database.UnfinishedSong` the song continues, if any.
+        Returns the song identifier and whether the file was linked.
+        """
+        timer = timer or NULL_TIMER
+        duplicate_of = None
+        if resume is None:
+            with timer.stage(STAGE_DEDUPE):
+                duplicate_of = self.find_duplicate(hashes, catalog=catalog)
+        if duplicate_of is None:
+            with timer.stage(STAGE_STORE):
+                sid = self._store_song(song_name, hashes, file_hash,
+                                       catalog=catalog, resume=resume)
+            return sid, False
+
+        logger.info("%s is a duplicate of song %s, linking it",
+                    song_name, duplicate_of)
+        with timer.stage(STAGE_STORE):
+            self.db.insert_alias(file_hash, duplicate_of)
+        self._songs_changes += 1
+        if self._songhashes_set is not None:
+            self._songhashes_set.add(file_hash)
+        return duplicate_of, True
+
+    def find_duplicate(self, hashes, catalog=None):
+        """
+        Looks a sample of the hashes of a new song up in the index, in
+        `catalog` when given. Returns the identifier of the song they align
+        with when enough of them do, None otherwise or when the `dedupe`
+        option is not set.
+        """
+        dedupe = self.config.get("dedupe")
+        if not dedupe or not hashes:
+            return None
+
+        # evenly spaced in time so a song sharing only an intro with
+        # another one does not look like a duplicate
+        sample_size = dedupe.get("sample", DEFAULT_DEDUPE_SAMPLE)
+        ordered = sorted(hashes, key=itemgetter(1))
+        step = max(len(ordered) // sample_size, 1)
+        sample = ordered[::step][:sample_size]
+
+        match = self.align_matches(list(self.find_hash_matches(
+            sample, catalog=catalog)))
+        if match is None:
+            return None
+        ratio = match[Dejavu.CONFIDENCE] / float(len(sample))
+        if ratio < dedupe.get("threshold", DEFAULT_DEDUPE_THRESHOLD):
+            return None
+        return match[Dejavu.SONG_ID]
+
+    def _store_song(self, song_name, hashes, file_hash, catalog=None,
+                    resume=None):
+        """
+        Writes a fingerprinted song and its hashes to the database in
+        journaled batches and marks it as fingerprinted. A `resume`d song
+        only gets the hashes past its journal offset. Returns the song
+        identifier.
+        """
+        batch_size = self.ingest_config.get("journal_batch",
+                                            DEFAULT_JOURNAL_BATCH)
+        with metrics.Timer(metrics.DB_INSERT_SECONDS):
+            if resume is not None:
+                sid, start = resume.song_id, resume.song_offset
+            elif catalog is None:
+                sid, start = self.db.insert_song(song_name, file_hash), 0
+            else:
+                sid, start = self.db.insert_song(song_name, file_hash,
+                                                 catalog=catalog), 0
+            for batch, offset in _journal_batches(hashes, start, batch_size):
+                self.db.insert_hash_batch(sid, batch, offset,
+                                          version=self.fingerprint_version)
             self.db.set_song_fingerprinted(sid)
+        self._songs_changes += 1
+        if self._songhashes_set is not None:
+            self._songhashes_set.add(file_hash)
+        return sid
 
-            print "Updating song hashes: %s" % song_name
-            self.get_fingerprinted_songs().add(file_hash)
+    def query_hashes(self, channels, Fs=fingerprint.DEFAULT_FS, timer=None):
+        """
+        Fingerprints the channels of a query and returns their (hash, offset)
+        pairs. With a `query` budget configured, at most `max_hashes` of
+        them are kept, picked by `fingerprint.select_hashes`, and the hashes
+        stored at least `common_rows` times are skipped.
+        """
+        budget = self.query_config.get("max_hashes")
+        common = self.get_common_hashes()
+        ranked = budget is not None or bool(common)
+        hashes = []
+        for samples in channels:
+            # a channel's own duplicates once, its hashes shared with other
+            # channels at each of their offsets
+            hashes.extend(set(fingerprint.fingerprint(
+                samples, Fs=Fs, timer=timer, strength=ranked,
+                **self.fingerprint_params)))
+        if ranked:
+            hashes = fingerprint.select_hashes(hashes, budget, common)
+        return hashes
 
-    def find_matches(self, samples, Fs=fingerprint.DEFAULT_FS):
-        hashes = fingerprint.fingerprint(samples, Fs=Fs)
-        return self.db.return_matches(hashes)
+    def get_common_hashes(self):
+        """
+        Returns the hashes queries skip, loaded on first use, or None when
+        `query.common_rows` is not configured.
+        """
+        if self.query_config.get("common_rows") is None:
+            return None
+        common = self._common_hashes
+        if common is None:
+            # concurrent first queries wait for a single load
+            with self._state_lock:
+                if self._common_hashes is None:
+                    self.load_common_hashes()
+                common = self._common_hashes
+        return common
 
-    def align_matches(self, matches):
+    def load_common_hashes(self):
+        """
+        (Re)reads the hashes stored at least `query.common_rows` times. This
+        counts the rows of every hash, so it is only done on first use and
+        when the fingerprint version changes.
+        """
+        min_rows = self.query_config["common_rows"]
+        with self._state_lock:
+            common = frozenset(self.db.get_common_hashes(min_rows))
+            self._common_hashes = common
+        logger.info("%d hashes stored at least %d times are skipped by "
+                    "queries", len(common), min_rows)
+
+    def find_matches(self, samples, Fs=fingerprint.DEFAULT_FS, catalog=None,
+                     timer=None):
+        """
+        Looks the samples of one channel up, with the hash budget and
+        common-hash filter of every query, see `query_hashes`.
+        """
+        hashes = self.query_hashes([samples], Fs=Fs, timer=timer)
+        return self.find_hash_matches(hashes, catalog=catalog, timer=timer)
+
+    def find_hash_matches(self, hashes, catalog=None, timer=None):
+        """
+        Looks `hashes` up in the database, only matching songs of `catalog`
+        when given. The catalog is filtered by the database query itself.
+
+        With a `StageTimer` as `timer` the database round trips are timed
+        and counted, and the matches are returned as a list.
+        """
+        if timer is None:
+            chunks = self._timed_chunks(
+                self._match_chunks(hashes, catalog=catalog), NULL_TIMER)
+            return itertools.chain.from_iterable(chunks)
+
+        hashes = list(hashes)
+        timer.count(COUNT_HASHES_SENT, len(set(h for h, _ in hashes)))
+        matches = []
+        for chunk in self._timed_chunks(
+                self._match_chunks(hashes, catalog=catalog), timer):
+            matches.extend(chunk)
+        return matches
+
+    def lookup_hashes(self, hashes, catalog=None):
+        """
+        Looks distinct `hashes` up and returns a dict of upper case hash =>
+        list of (song_id, database offset). Queries of several streams can
+        share the lookup, see `dejavu.monitor.Monitor`.
+        """
+        kwargs = {} if catalog is None else {"catalog": catalog}
+        rows = {}
+        chunks = self.db.lookup_hashes_chunks(hashes, **kwargs)
+        for chunk in self._timed_chunks(chunks, NULL_TIMER):
+            for hash, sid, offset in chunk:
+                rows.setdefault(hash, []).append((sid, offset))
+        return rows
+
+    def _match_chunks(self, hashes, chunk_size=None, catalog=None):
+        """
+        `Database.return_matches_chunks`, leaving unset options to the
+        backend.
+        """
+        kwargs = {}
+        if chunk_size is not None:
+            kwargs["chunk_size"] = chunk_size
+        if catalog is not None:
+            kwargs["catalog"] = catalog
+        return self.db.return_matches_chunks(hashes, **kwargs)
+
+    def _timed_chunks(self, chunks, timer):
+        """
+        Yields the lists of matches of `chunks`, timing every database round
+        trip as the query stage of `timer` and in the query metrics.
+        """
+        chunks = iter(chunks)
+        while True:
+            started = time.time()
+            with timer.stage(STAGE_QUERY):
+                matches = next(chunks, None)
+            if matches is None:
+                return
+            metrics.DB_QUERY_SECONDS.observe(time.time() - started)
+            metrics.DB_QUERY_ROWS.observe(len(matches))
+            timer.count(COUNT_CHUNKS)
+            timer.count(COUNT_ROWS, len(matches))
+            yield matches
+
+    def find_match_progressive(self, hashes, min_confidence=None, margin=None,
+                               deadline=None, chunk_size=None, catalog=None,
+                               timer=None):
+        """
+        Looks `hashes` up one chunk at a time and stops as soon as one song
+        leads with `min_confidence` aligned matches and `margin` times as
+        many as the runner-up, or once `deadline` (a `time.time()` value)
+        has passed. Returns the best match so far like `align_matches`.
+        Only songs of `catalog` are matched when it is given, stages are
+        recorded in `timer` when given.
+
+        Hashes are sent in the order `select_hashes` ranked them when a
+        `query.max_hashes` budget is set, otherwise spread over the query
+        in time. They are not sorted rarest first: the database only tells
+        the common hashes apart, and `query_hashes` leaves those out already.
+
+        Unset options come from the `progressive` configuration.
+        """
+        options = self.config.get("progressive") or {}
+        if min_confidence is None:
+            min_confidence = options.get("min_confidence",
+                                         DEFAULT_PROGRESSIVE_CONFIDENCE)
+        if margin is None:
+            margin = options.get("margin", DEFAULT_PROGRESSIVE_MARGIN)
+        chunk_size = chunk_size or options.get("chunk_size",
+                                               DEFAULT_PROGRESSIVE_CHUNK)
+
+        if self.query_config.get("max_hashes") is not None:
+            # `select_hashes` ranked them already, the strongest hash of
+            # every time slot in turn, keep that order
+            ordered = hashes
+        else:
+            # Every chunk samples the whole query evenly in time, so the
+            # first ones already carry a bit of the alignment peak.
+            ordered = sorted(set(hashes), key=itemgetter(1))
+            nchunks = max((len(ordered) + chunk_size - 1) // chunk_size, 1)
+            ordered = [h for i in xrange(nchunks) for h in ordered[i::nchunks]]
+
+        timer = timer or NULL_TIMER
+        aligner = Aligner()
+        sent = 0
+        for matches, nhashes in self._progressive_chunks(
+                ordered, chunk_size, catalog, timer):
+            sent += nhashes
+            with timer.stage(STAGE_ALIGN), \
+                    metrics.Timer(metrics.ALIGN_SECONDS):
+                aligner.add(matches)
+            if aligner.is_confident(min_confidence, margin):
+                break
+            if deadline is not None and time.time() >= deadline:
+                logger.debug("Deadline hit after %d chunks", aligner.chunks)
+                break
+        timer.count(COUNT_HASHES_SENT, sent)
+        return self._match_info(aligner)
+
+    def _progressive_chunks(self, hashes, chunk_size, catalog, timer):
+        """
+        Looks the distinct hashes of the (hash, offset) pairs `hashes` up
+        `chunk_size` at a time in the given order, and yields the matches
+        of every chunk with the number of hashes it sent.
+        """
+        # every hash is sent once, its rows are matched against all the
+        # offsets it was sampled at, e.g. in several channels
+        offsets = {}
+        values = []
+        for hash, offset in hashes:
+            hash = hash.upper()
+            if hash not in offsets:
+                values.append(hash)
+                offsets[hash] = set()
+            offsets[hash].add(offset)
+
+        kwargs = {} if catalog is None else {"catalog": catalog}
+        chunks = self.db.lookup_hashes_chunks(values, chunk_size, **kwargs)
+        for i, rows in enumerate(self._timed_chunks(chunks, timer)):
+            sent = len(values[i * chunk_size:(i + 1) * chunk_size])
+            yield [(sid, offset - sampled) for hash, sid, offset in rows
+                   for sampled in offsets[hash]], sent
+
+    def align_matches(self, matches, timer=None):
         """
             Finds hash matches that align in time with other matches and finds
             consensus about which hashes are "true" signal from the audio.
@@ -152,22 +1133,20 @@ class Dejavu(object):
             Returns a dictionary with match information.
         """
         # align by diffs
-        diff_counter = {}
-        largest = 0
-        largest_count = 0
-        song_id = -1
-        for tup in matches:
-            sid, diff = tup
-            if diff not in diff_counter:
-                diff_counter[diff] = {}
-            if sid not in diff_counter[diff]:
-                diff_counter[diff][sid] = 0
-            diff_counter[diff][sid] += 1
-
-            if diff_counter[diff][sid] > largest_count:
-                largest = diff
-                largest_count = diff_counter[diff][sid]
-                song_id = sid
+        aligner = Aligner()
+        with (timer or NULL_TIMER).stage(STAGE_ALIGN), \
+                metrics.Timer(metrics.ALIGN_SECONDS):
+            aligner.add(matches)
+        return self._match_info(aligner)
+
+    def _match_info(self, aligner):
+        """
+        Returns the match information of the leader of `aligner`, None when
+        there is none.
+        """
+        song_id = aligner.song_id
+        largest = aligner.offset
+        largest_count = aligner.confidence
 
         # extract idenfication
         song = self.db.get_song_by_id(song_id)
@@ -178,8 +1157,8 @@ class Dejavu(object):
 
         # return match info
         nseconds = round(float(largest) / fingerprint.DEFAULT_FS *
-                         fingerprint.DEFAULT_WINDOW_SIZE *
-                         fingerprint.DEFAULT_OVERLAP_RATIO, 5)
+                         self.fingerprint_params["wsize"] *
+                         self.fingerprint_params["wratio"], 5)
         song_dict = {
             Dejavu.SONG_ID : song_id,
             Dejavu.SONG_NAME : songname,
@@ -194,7 +1173,30 @@ class Dejavu(object):
         r = recognizer(self)
         return r.recognize(*options, **kwoptions)
 
-def _fingerprint_worker(filename, limit=None, file_format="wav", song_name=None):
+def _observe_ingest(num_hashes, duplicate, timer):
+    """
+    Updates the ingestion metrics with a stored song.
+    """
+    metrics.SONGS_INGESTED.labels(
+        result="duplicate" if duplicate else "stored").inc()
+    metrics.SONG_HASHES.observe(num_hashes)
+    for stage, seconds in timer.timings.iteritems():
+        metrics.INGEST_STAGE_SECONDS.labels(stage=stage).observe(seconds)
+
+def _owned_results(results, jobs, queue, lease):
+    """
+    Passes scheduler results on, failing the songs whose lease was lost so
+    the worker that claimed them since is the only one storing them.
+    """
+    for filename, ok, value, progress in results:
+        job = jobs[filename]
+        if ok and not queue.renew([(job.file_sha1, job.catalog)], lease):
+            ok, value = False, LeaseLost("%s was claimed by another worker"
+                                         % filename)
+        yield filename, ok, value, progress
+
+def _fingerprint_worker(filename, limit=None, file_format="wav", song_name=None,
+                        params=None, offset=0):
     # Pool.imap sends arguments as tuples so we have to unpack
     # them ourself.
     try:
@@ -202,22 +1204,68 @@ def _fingerprint_worker(filename, limit=None, file_format="wav", song_name=None)
     except ValueError:
         pass
 
+    decoded = _decode_worker(filename, limit, file_format)
+    return _fingerprint_decoded(filename, decoded, song_name=song_name,
+                                params=params, offsets={filename: offset})
+
+def _decode_worker(filename, limit=None, file_format="wav"):
+    """
+    I/O bound half of `_fingerprint_worker`, the scheduler runs it ahead of
+    time for the next file of a worker. Returns the decoded file and a
+    `StageTimer` holding the time it took.
+    """
+    timer = StageTimer()
+    with timer.stage(STAGE_DECODE):
+        decoded = decoder.read(filename, limit, file_format)
+    timer.count(COUNT_SAMPLES, sum(len(channel) for channel in decoded[0]))
+    return decoded, timer
+
+def _fingerprint_decoded(filename, decoded, song_name=None, params=None,
+                         offsets=None):
+    """
+    CPU bound half of `_fingerprint_worker`, fingerprints the channels
+    returned by `_decode_worker` with `params`, keyword arguments of
+    `fingerprint.fingerprint`. Only hashes at or past the offset `offsets`
+    gives for `filename`, if any, are made.
+
+    returns: (song_name, hashes, file_hash, timer)
+    """
     songname, extension = os.path.splitext(os.path.basename(filename))
     song_name = song_name or songname
-    channels, Fs, file_hash = decoder.read(filename, limit, file_format)
+    (channels, Fs, file_hash), timer = decoded
     result = set()
     channel_amount = len(channels)
+    offset = (offsets or {}).get(filename, 0)
 
     for channeln, channel in enumerate(channels):
-        # TODO: Remove prints or change them into optional logging.
-        print("Fingerprint channel %d/%d for %s" % (channeln + 1,
-                                                       channel_amount,
-                                                       filename))
-        hashes = fingerprint.fingerprint(channel, Fs=Fs, song_name=song_name)
-        print("Finished channel %d/%d for %s" % (channeln + 1, channel_amount, filename))
-        result |= set(hashes)
-
-    return song_name, result, file_hash
+        logger.debug("Fingerprint channel %d/%d for %s",
+                     channeln + 1, channel_amount, filename)
+        result.update(fingerprint.fingerprint_from(channel, offset, Fs=Fs,
+                                                   song_name=song_name,
+                                                   timer=timer,
+                                                   **(params or {})))
+
+    return song_name, result, file_hash, timer
+
+def _journal_batches(hashes, start, size):
+    """
+    Splits the hashes at offset `start` or later into batches of about
+    `size` in offset order, never splitting the hashes of an offset. Yields
+    (batch, offset), where all hashes below `offset` are in the batches so
+    far.
+    """
+    hashes = sorted((h for h in hashes if h[1] >= start), key=itemgetter(1))
+    i = 0
+    while i < len(hashes):
+        end = min(i + size, len(hashes))
+        while end < len(hashes) and hashes[end][1] == hashes[end - 1][1]:
+            end += 1
+        if end < len(hashes):
+            offset = hashes[end][1]
+        else:
+            offset = hashes[end - 1][1] + 1
+        yield hashes[i:end], int(offset)
+        i = end
 
 def chunkify(lst, n):
     """
@@ -0,0 +1,52 @@
+""" Offset histogram used to decide which song a query matches.
+"""
+
+
+class Aligner(object):
+    """
+    Counts (song_id, offset_difference) matches. Matches of the right song
+    pile up on the offset the query starts at within that song, the
+    (song, offset) pair seen most often wins.
+
+    Matches can be added in several goes, e.g. one per database round trip,
+    and the leader inspected in between.
+    """
+
+    def __init__(self):
+        super(Aligner, self).__init__()
+        self.song_id = -1
+        self.offset = 0
+        self.confidence = 0
+        self.rows = 0
+        self.chunks = 0
+        self._counts = {}  # (sid, diff) => count
+        self._best = {}  # sid => highest count of any of its offsets
+
+    def add(self, matches):
+        counts = self._counts
+        best = self._best
+        for sid, diff in matches:
+            key = (sid, diff)
+            count = counts.get(key, 0) + 1
+            counts[key] = count
+            if count > best.get(sid, 0):
+                best[sid] = count
+            if count > self.confidence:
+                self.song_id, self.offset, self.confidence = sid, diff, count
+            self.rows += 1
+        self.chunks += 1
+
+    def runner_up(self):
+        """
+        Returns the confidence of the best song other than the leader.
+        """
+        return max([count for sid, count in self._best.iteritems()
+                    if sid != self.song_id] or [0])
+
+    def is_confident(self, min_confidence, margin):
+        """
+        True once the leader has at least `min_confidence` aligned matches
+        and `margin` times as many as any other song.
+        """
+        return (self.confidence >= min_confidence and
+                self.confidence >= margin * self.runner_up())
@@ -0,0 +1,87 @@
+""" Cache of recognition results keyed by the content of the query.
+"""
+import copy
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+import dejavu.metrics as metrics
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 300
+
+
+def samples_key(channels, Fs):
+    """
+    Returns a key for decoded query audio, the sha1 of every channel's
+    samples and the sample rate.
+    """
+    h = hashlib.sha1(str(Fs))
+    for channel in channels:
+        h.update("|")
+        # channels are often strided views into interleaved samples
+        h.update(np.ascontiguousarray(channel))
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    """
+    LRU cache of recognition results with a time to live.
+
+    Every entry remembers the song set version it was computed against,
+    entries of an older version are treated as missing.
+
+    ```python
+    cache = ResultCache(maxsize=100, ttl=60)
+    cache.put(key, version, result)
+    cache.get(key, version)
+    ```
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        super(ResultCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, default=None):
+        """
+        Returns a copy of the result cached for `key`, `default` when there
+        is none, it expired or belongs to another `version`.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                expires, entry_version, result = entry
+                if entry_version == version and (expires is None or
+                                                 expires > time.time()):
+                    # re-insert as most recently used
+                    self._entries[key] = entry
+                    self.hits += 1
+                    metrics.CACHE_REQUESTS.labels(result="hit").inc()
+                    return copy.deepcopy(result)
+            self.misses += 1
+            metrics.CACHE_REQUESTS.labels(result="miss").inc()
+            return default
+
+    def put(self, key, version, result):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, version, copy.deepcopy(result))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
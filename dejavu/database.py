@@ -1,6 +1,11 @@
 from __future__ import absolute_import
 
 import abc
+import json
+import binascii
+import itertools
+
+import numpy as np
 
 from collections import namedtuple
 
@@ -10,6 +15,10 @@ class Database(object):
      # tables
     FINGERPRINTS_TABLENAME = "fingerprint"
     SONGS_TABLENAME = "song"
+    ALIASES_TABLENAME = "song_alias"
+    VERSIONS_TABLENAME = "fingerprint_version"
+    VERSION_SONGS_TABLENAME = "fingerprint_version_song"
+    JOURNAL_TABLENAME = "ingest_journal"
 
     FIELD_SONG_ID = 'song_id'
     FIELD_SONGNAME = 'song_name'
@@ -17,9 +26,31 @@ class Database(object):
     FIELD_OFFSET = 'song_offset'
     FIELD_HASH = 'song_hash'
     FIELD_FINGERPRINTED = "fingerprinted"
+    FIELD_CATALOG = "catalog"
+    FIELD_VERSION = "version"
+    FIELD_PARAMS = "params"
+    FIELD_STATE = "state"
+    FIELD_UPDATED = "updated"
+
+    # fingerprint version states: filled in a shadow table, being swapped
+    # in, serving recognition, replaced and waiting to be dropped, dropped
+    VERSION_BUILDING = "building"
+    VERSION_SWITCHING = "switching"
+    VERSION_ACTIVE = "active"
+    VERSION_RETIRED = "retired"
+    VERSION_DROPPED = "dropped"
 
     Song = namedtuple('Song', (FIELD_SONG_ID, FIELD_SONGNAME, FIELD_FILE_SHA1))
     Fingerprint = namedtuple('Fingerprint', (FIELD_SONG_ID, FIELD_OFFSET, FIELD_HASH))
+    # `params` are the `dejavu.fingerprint.fingerprint` keyword arguments
+    # the version's hashes were made with
+    FingerprintVersion = namedtuple('FingerprintVersion', (
+        FIELD_VERSION, FIELD_PARAMS, FIELD_STATE))
+    # a song whose ingestion was interrupted, its hashes below `song_offset`
+    # are stored in the fingerprint table of fingerprint `version`
+    UnfinishedSong = namedtuple('UnfinishedSong', (
+        FIELD_SONG_ID, FIELD_FILE_SHA1, FIELD_CATALOG, FIELD_VERSION,
+        FIELD_OFFSET))
 
     # Name of your Database subclass, this is used in configuration
     # to refer to your class
@@ -80,7 +111,8 @@ class Database(object):
     @abc.abstractmethod
     def set_song_fingerprinted(self, sid):
         """
-        Sets a specific song as having all fingerprints in the database.
+        Sets a specific song as having all fingerprints in the database, and
+        closes its entry in the ingestion journal.
 
         sid: Song identifier
         """
@@ -93,6 +125,179 @@ class Database(object):
         """
         pass
 
+    def get_song_hashes(self):
+        """
+        Returns the file sha1 of every fully fingerprinted song as raw
+        20 byte strings.
+
+        Backends should override this with a query that only reads the sha1
+        column.
+        """
+        for song in self.get_songs():
+            yield binascii.unhexlify(song.file_sha1)
+
+    def get_songs_after(self, sid):
+        """
+        Returns (song_id, file_sha1, fingerprinted) for every song, finished
+        or not, with an identifier above `sid` in identifier order.
+        `file_sha1` is the raw 20 byte digest.
+
+        Backends should override this so unfinished songs are returned as
+        well, the default only knows about fingerprinted ones.
+        """
+        songs = sorted(self.get_songs(), key=lambda song: song.song_id)
+        for song in songs:
+            if song.song_id > sid:
+                yield song.song_id, binascii.unhexlify(song.file_sha1), True
+
+    def filter_fingerprinted(self, file_hashes, catalog=None):
+        """
+        Returns the subset of the given hexadecimal file sha1s that belong to
+        fully fingerprinted songs or are aliases of one, only counting songs
+        of `catalog` when it is given.
+
+        Backends should override this with batched lookups instead of
+        reading the whole song table.
+        """
+        if catalog is not None:
+            raise NotImplementedError("%s does not support catalogs"
+                                      % self.__class__.__name__)
+        wanted = set(h.upper() for h in file_hashes)
+        known = itertools.chain(self.get_song_hashes(), self.get_song_aliases())
+        return set(binascii.hexlify(h).upper() for h in known) & wanted
+
+    def get_song_aliases(self):
+        """
+        Returns the raw 20 byte sha1 of every file linked to an existing song
+        with `insert_alias`.
+        """
+        return iter(())
+
+    def insert_alias(self, file_hash, sid):
+        """
+        Links a file to an already fingerprinted song instead of storing its
+        fingerprints again, e.g. the same recording in another format.
+
+        file_hash: sha1 of the file, in hexadecimal format
+              sid: Song identifier the file is a duplicate of
+        """
+        raise NotImplementedError("%s does not support song aliases"
+                                  % self.__class__.__name__)
+
+    def get_unfinished_songs(self):
+        """
+        Returns an `UnfinishedSong` for every song being fingerprinted, or
+        left unfinished by an interrupted ingestion, according to the
+        ingestion journal. `file_sha1` is in hexadecimal format.
+
+        Backends without a journal return nothing and interrupted songs are
+        fingerprinted again from the start.
+        """
+        return iter(())
+
+    def delete_stale_songs(self, max_age):
+        """
+        Removes the songs whose ingestion stopped more than `max_age`
+        seconds ago, hashes included, so songs whose file is never ingested
+        again don't stay unfinished forever.
+
+        Backends without a journal can't tell an interrupted song from one
+        being fingerprinted, they remove every unfinished song.
+        """
+        self.delete_unfingerprinted_songs()
+
+    def insert_hash_batch(self, sid, hashes, offset, version=None):
+        """
+        Inserts a batch of the hashes of a song being fingerprinted and
+        records in the ingestion journal, in the same transaction, that all
+        of its hashes below `offset` are stored. An interrupted ingestion
+        resumes from there.
+
+            sid: Song identifier the fingerprints belong to
+         hashes: A sequence of tuples in the format (hash, offset)
+         offset: Offset the next batch starts at
+        version: Fingerprint version the hashes were made with
+
+        Backends without a journal only insert the hashes.
+        """
+        self.insert_hashes(sid, hashes)
+
+    def get_fingerprint_versions(self):
+        """
+        Returns a `FingerprintVersion` for every fingerprint version, the
+        active one included, in version order.
+        """
+        raise NotImplementedError("%s does not support fingerprint versions"
+                                  % self.__class__.__name__)
+
+    def get_active_fingerprint_version(self):
+        """
+        Returns the `FingerprintVersion` recognition is served from, None
+        when the backend doesn't keep versions and the parameters in
+        `dejavu.fingerprint` apply.
+        """
+        return None
+
+    def create_fingerprint_version(self, params):
+        """
+        Adds a fingerprint version built with `params` and creates the
+        shadow table its hashes are stored in. Returns the new version.
+        """
+        raise NotImplementedError("%s does not support fingerprint versions"
+                                  % self.__class__.__name__)
+
+    def get_version_song_ids(self, version):
+        """
+        Returns the identifiers of the songs whose hashes are stored in the
+        shadow table of a version being built.
+        """
+        raise NotImplementedError("%s does not support fingerprint versions"
+                                  % self.__class__.__name__)
+
+    def insert_version_hashes(self, version, sid, hashes):
+        """
+        Stores the hashes of a song in the shadow table of a version being
+        built, in one transaction with the record that the song is done.
+
+        version: Fingerprint version being built
+            sid: Song identifier the fingerprints belong to
+         hashes: A sequence of tuples in the format (hash, offset)
+        """
+        raise NotImplementedError("%s does not support fingerprint versions"
+                                  % self.__class__.__name__)
+
+    def count_missing_version_songs(self, version):
+        """
+        Returns the number of fingerprinted songs without hashes in the
+        shadow table of a version being built.
+        """
+        raise NotImplementedError("%s does not support fingerprint versions"
+                                  % self.__class__.__name__)
+
+    def activate_fingerprint_version(self, version):
+        """
+        Makes a built version the one recognition is served from, in one
+        atomic swap of its shadow table with the fingerprint table. The
+        version replaced is retired. Returns it.
+        """
+        raise NotImplementedError("%s does not support fingerprint versions"
+                                  % self.__class__.__name__)
+
+    def drop_fingerprint_version(self, version):
+        """
+        Drops the table of a retired version, or of a version being built to
+        abandon it.
+        """
+        raise NotImplementedError("%s does not support fingerprint versions"
+                                  % self.__class__.__name__)
+
+    def version_table(self, version):
+        """
+        Returns the name of the table holding the hashes of a version that
+        is not active.
+        """
+        return "%s_v%d" % (self.FINGERPRINTS_TABLENAME, version)
+
     @abc.abstractmethod
     def get_song_by_id(self, sid):
         """
@@ -114,12 +319,15 @@ class Database(object):
         pass
 
     @abc.abstractmethod
-    def insert_song(self, song_name):
+    def insert_song(self, song_name, file_hash, catalog=None):
         """
         Inserts a song name into the database, returns the new
-        identifier of the song.
+        identifier of the song. Backends with an ingestion journal open the
+        song's entry in the same transaction.
 
         song_name: The name of the song.
+        file_hash: sha1 of the song's file, in hexadecimal format
+          catalog: Name of the catalog the song belongs to, or None
         """
         pass
 
@@ -153,21 +361,122 @@ class Database(object):
         pass
 
     @abc.abstractmethod
-    def return_matches(self, hashes):
+    def return_matches(self, hashes, catalog=None):
         """
         Searches the database for pairs of (hash, offset) values.
 
-        hashes: A sequence of tuples in the format (hash, offset)
+         hashes: A sequence of tuples in the format (hash, offset)
         -   hash: Part of a sha1 hash, in hexadecimal format
         - offset: Offset this hash was created from/at.
+        catalog: Only match songs of this catalog, all songs when None
+
+        Songs not fingerprinted completely are never matched.
 
-        Returns a sequence of (sid, offset_difference) tuples.
+        Returns a sequence of (sid, offset_difference) tuples, a hash given
+        at several offsets matches at each of them.
 
                       sid: Song identifier
         offset_difference: (offset - database_offset)
         """
         pass
 
+    def return_matches_chunks(self, hashes, chunk_size=1000, catalog=None):
+        """
+        Same as `return_matches`, but looks the hashes up `chunk_size` at a
+        time in the given order and yields a list of matches per chunk.
+        This lets callers stop early once the answer is clear.
+        """
+        # backends without catalogs keep working unscoped
+        kwargs = {} if catalog is None else {"catalog": catalog}
+        hashes = list(hashes)
+        for i in xrange(0, len(hashes), chunk_size):
+            yield list(self.return_matches(hashes[i:i + chunk_size], **kwargs))
+
+    def lookup_hashes_chunks(self, hashes, chunk_size=1000, catalog=None):
+        """
+        Looks distinct hashes up `chunk_size` at a time and yields a list of
+        (hash, sid, database_offset) rows per chunk, the hash upper case.
+        Unlike `return_matches_chunks` the rows say which hash they are for,
+        so the hashes of several queries can share one lookup.
+
+        The default asks `query` for one hash at a time and ignores
+        `catalog`, backends should look a chunk up in one round trip.
+        """
+        hashes = [h.upper() for h in hashes]
+        for i in xrange(0, len(hashes), chunk_size):
+            yield [(h, sid, offset) for h in hashes[i:i + chunk_size]
+                   for sid, offset in self.query(h)]
+
+    def get_common_hashes(self, min_rows):
+        """
+        Returns the hashes stored at least `min_rows` times, in hexadecimal
+        format and upper case. Queries skip them when a hash budget is set,
+        see `fingerprint.select_hashes`.
+
+        Backends that can't count them return nothing and no hash is
+        skipped.
+        """
+        return iter(())
+
+
+class SongHashSet(object):
+    """
+    Compact set of file sha1s. Hashes are kept as raw 20 byte digests in a
+    sorted numpy array with a small python set for the ones added later, and
+    are looked up and added as hexadecimal strings.
+    """
+
+    def __init__(self, digests=()):
+        super(SongHashSet, self).__init__()
+        self._sorted = np.sort(np.fromiter(digests, dtype='S20'))
+        self._added = set()
+
+    def __contains__(self, file_sha1):
+        digest = binascii.unhexlify(file_sha1)
+        if digest in self._added:
+            return True
+        i = np.searchsorted(self._sorted, digest)
+        # numpy drops trailing NUL bytes of fixed size strings, all digests
+        # are 20 bytes long so the stripped form is still unique
+        return (i < len(self._sorted) and
+                self._sorted[i] == digest.rstrip('\x00'))
+
+    def __len__(self):
+        return len(self._sorted) + len(self._added)
+
+    def add(self, file_sha1):
+        if file_sha1 not in self:
+            self._added.add(binascii.unhexlify(file_sha1))
+
+    def update(self, digests):
+        """
+        Adds raw 20 byte digests.
+        """
+        for digest in digests:
+            if binascii.hexlify(digest) not in self:
+                self._added.add(digest)
+        # keep the python set small, it costs several times the array
+        if len(self._added) > max(1024, len(self._sorted) // 8):
+            added = np.fromiter(self._added, dtype='S20')
+            self._sorted = np.sort(np.concatenate((self._sorted, added)))
+            self._added = set()
+
+
+def encode_params(params):
+    """
+    Returns fingerprint parameters as stored with a fingerprint version.
+    """
+    return json.dumps(params, sort_keys=True)
+
+
+def decode_params(text):
+    """
+    Returns the fingerprint parameters stored by `encode_params`, with byte
+    string keys so they can be passed as keyword arguments.
+    """
+    return dict((str(name), value)
+                for name, value in json.loads(text).iteritems())
+
 
 def get_database(database_type=None):
     # Default to using the mysql database
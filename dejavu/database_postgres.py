@@ -3,6 +3,7 @@
 from itertools import izip_longest
 import Queue
 import sys
+import logging
 import binascii
 
 try:
@@ -12,7 +13,10 @@ except ImportError as err:
     sys.exit(1)
 
 from psycopg2.extras import DictCursor, RealDictCursor, wait_select
-from dejavu.database import Database
+from dejavu.database import Database, encode_params, decode_params
+from dejavu.fingerprint import DEFAULT_PARAMS
+
+logger = logging.getLogger(__name__)
 
 class PostgresDatabase(Database):
     """ Class to interact with Postgres databases.
@@ -48,15 +52,132 @@ class PostgresDatabase(Database):
                Database.FIELD_HASH
               )
 
-    INSERT_FINGERPRINT_BASIC = """
-        INSERT INTO %s (%s, %s, %s) VALUES
+    # Files linked to an existing song instead of being fingerprinted.
+    CREATE_ALIASES_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s bytea PRIMARY KEY,
+            %s integer NOT NULL REFERENCES %s (%s) ON DELETE CASCADE
+        );
+        """ % (
+            Database.ALIASES_TABLENAME,
+            Database.FIELD_FILE_SHA1,
+            Database.FIELD_SONG_ID,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_SONG_ID
+        )
+
+    # Adds the catalog songs are scoped by, indexed for scoped lookups.
+    CREATE_CATALOG_COLUMN = """
+        ALTER TABLE %s ADD COLUMN IF NOT EXISTS %s varchar(64);
+        CREATE INDEX IF NOT EXISTS %s_%s_index ON %s (%s);
+        """ % (
+            Database.SONGS_TABLENAME,
+            Database.FIELD_CATALOG,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_CATALOG,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_CATALOG
+        )
+
+    # Fingerprint versions, see `activate_fingerprint_version`.
+    CREATE_VERSIONS_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s integer PRIMARY KEY,
+            %s text NOT NULL,
+            %s varchar(10) NOT NULL
+        );
+        """ % (
+            Database.VERSIONS_TABLENAME,
+            Database.FIELD_VERSION,
+            Database.FIELD_PARAMS,
+            Database.FIELD_STATE
+        )
+
+    # Songs stored so far in the shadow table of a version being built.
+    CREATE_VERSION_SONGS_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s integer NOT NULL,
+            %s integer NOT NULL REFERENCES %s (%s) ON DELETE CASCADE,
+            PRIMARY KEY (%s, %s)
+        );
+        """ % (
+            Database.VERSION_SONGS_TABLENAME,
+            Database.FIELD_VERSION,
+            Database.FIELD_SONG_ID,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_VERSION,
+            Database.FIELD_SONG_ID
+        )
+
+    # How far the hashes of every song being fingerprinted are stored.
+    CREATE_JOURNAL_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s integer PRIMARY KEY REFERENCES %s (%s) ON DELETE CASCADE,
+            %s integer,
+            %s integer NOT NULL DEFAULT 0,
+            %s timestamp NOT NULL DEFAULT now()
+        );
+        """ % (
+            Database.JOURNAL_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_VERSION,
+            Database.FIELD_OFFSET,
+            Database.FIELD_UPDATED
+        )
+
+    # Adds the time of the last move to journals created before it existed.
+    CREATE_JOURNAL_UPDATED_COLUMN = """
+        ALTER TABLE %s ADD COLUMN IF NOT EXISTS %s timestamp NOT NULL
+            DEFAULT now();
+        """ % (
+            Database.JOURNAL_TABLENAME,
+            Database.FIELD_UPDATED
+        )
+
+    # Creates the shadow table of a version alike the fingerprint table,
+    # the table name is filled in last.
+    CREATE_VERSION_TABLE = """
+        CREATE TABLE %%(table)s (
+            LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+        ALTER TABLE %%(table)s ADD FOREIGN KEY (%s)
+            REFERENCES %s (%s) ON DELETE CASCADE;
+        CREATE INDEX %%(table)s_index ON %%(table)s (%s);
         """ % (
             Database.FINGERPRINTS_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_HASH
+        )
+
+    # Swaps the fingerprint table and its index with the ones of another
+    # version, in the transaction that updates the version states.
+    SWAP_FINGERPRINTS = """
+        ALTER TABLE %s RENAME TO %%(retired)s;
+        ALTER INDEX fingerprint_index RENAME TO %%(retired)s_index;
+        ALTER TABLE %%(table)s RENAME TO %s;
+        ALTER INDEX %%(table)s_index RENAME TO fingerprint_index;
+        """ % (
+            Database.FINGERPRINTS_TABLENAME,
+            Database.FINGERPRINTS_TABLENAME
+        )
+
+    # The table name is filled in first, for shadow tables of versions.
+    INSERT_FINGERPRINT_INTO = """
+        INSERT INTO %%s (%s, %s, %s) VALUES
+        """ % (
             Database.FIELD_HASH,
             Database.FIELD_SONG_ID,
             Database.FIELD_OFFSET,
         )
-    # Inserts (ignores duplicates)
+
+    INSERT_FINGERPRINT_BASIC = (INSERT_FINGERPRINT_INTO %
+                                Database.FINGERPRINTS_TABLENAME)
+    # Inserts fingerprints, duplicates included: the table has no unique
+    # key, a batch and its journal entry are written in one transaction
     INSERT_FINGERPRINT = """
         %s (decode(%%s, 'hex'), %%s, %%s);
         """ % (
@@ -65,13 +186,93 @@ class PostgresDatabase(Database):
 
     # Inserts song information.
     INSERT_SONG = """
-        INSERT INTO %s (%s, %s)
-        values (%%s, decode(%%s, 'hex'))
+        INSERT INTO %s (%s, %s, %s)
+        values (%%s, decode(%%s, 'hex'), %%s)
         RETURNING %s;
         """ % (
             Database.SONGS_TABLENAME,
             Database.FIELD_SONGNAME,
             Database.FIELD_FILE_SHA1,
+            Database.FIELD_CATALOG,
+            Database.FIELD_SONG_ID
+        )
+
+    # Opens the journal entry of a new song.
+    INSERT_JOURNAL = """
+        INSERT INTO %s (%s)
+        values (%%s);
+        """ % (
+            Database.JOURNAL_TABLENAME,
+            Database.FIELD_SONG_ID
+        )
+
+    # Moves the journal entry of a song past a stored batch of hashes.
+    UPSERT_JOURNAL = """
+        INSERT INTO %s (%s, %s, %s)
+        values (%%s, %%s, %%s)
+        ON CONFLICT (%s) DO UPDATE
+        SET %s = EXCLUDED.%s, %s = EXCLUDED.%s, %s = now();
+        """ % (
+            Database.JOURNAL_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_VERSION,
+            Database.FIELD_OFFSET,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_VERSION,
+            Database.FIELD_VERSION,
+            Database.FIELD_OFFSET,
+            Database.FIELD_OFFSET,
+            Database.FIELD_UPDATED
+        )
+
+    # The fingerprint table in use when versions were introduced.
+    INSERT_FIRST_VERSION = """
+        INSERT INTO %s (%s, %s, %s)
+        values (1, %%s, '%s')
+        ON CONFLICT DO NOTHING;
+        """ % (
+            Database.VERSIONS_TABLENAME,
+            Database.FIELD_VERSION,
+            Database.FIELD_PARAMS,
+            Database.FIELD_STATE,
+            Database.VERSION_ACTIVE
+        )
+
+    # Adds a version being built.
+    INSERT_VERSION = """
+        INSERT INTO %s (%s, %s, %s)
+        SELECT MAX(%s) + 1, %%s, '%s' FROM %s
+        RETURNING %s;
+        """ % (
+            Database.VERSIONS_TABLENAME,
+            Database.FIELD_VERSION,
+            Database.FIELD_PARAMS,
+            Database.FIELD_STATE,
+            Database.FIELD_VERSION,
+            Database.VERSION_BUILDING,
+            Database.VERSIONS_TABLENAME,
+            Database.FIELD_VERSION
+        )
+
+    # Records a song as stored in the shadow table of a version.
+    INSERT_VERSION_SONG = """
+        INSERT INTO %s (%s, %s)
+        values (%%s, %%s)
+        ON CONFLICT DO NOTHING;
+        """ % (
+            Database.VERSION_SONGS_TABLENAME,
+            Database.FIELD_VERSION,
+            Database.FIELD_SONG_ID
+        )
+
+    # Links a file to a song, ignores files already linked.
+    INSERT_ALIAS = """
+        INSERT INTO %s (%s, %s)
+        values (decode(%%s, 'hex'), %%s)
+        ON CONFLICT DO NOTHING;
+        """ % (
+            Database.ALIASES_TABLENAME,
+            Database.FIELD_FILE_SHA1,
             Database.FIELD_SONG_ID
         )
 
@@ -87,16 +288,53 @@ class PostgresDatabase(Database):
             Database.FIELD_HASH
         )
 
+    # Selects the hashes stored at least a given number of times.
+    SELECT_COMMON_HASHES = """
+        SELECT %s
+        FROM %s
+        GROUP BY %s
+        HAVING COUNT(*) >= %%s;
+        """ % (
+            Database.FIELD_HASH,
+            Database.FINGERPRINTS_TABLENAME,
+            Database.FIELD_HASH
+        )
+
     # Selects multiple fingerprints based on hashes
+    # Songs still being fingerprinted, or left unfinished by an interrupted
+    # ingestion, must not match with part of their hashes.
     SELECT_MULTIPLE = """
-        SELECT %s, %s, %s
-        FROM %s
-        WHERE %s IN (%%s);
+        SELECT f.%s, f.%s, f.%s
+        FROM %s f JOIN %s s ON s.%s = f.%s
+        WHERE s.%s = True AND f.%s IN (%%s);
         """ % (
             Database.FIELD_HASH,
             Database.FIELD_SONG_ID,
             Database.FIELD_OFFSET,
             Database.FINGERPRINTS_TABLENAME,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_FINGERPRINTED,
+            Database.FIELD_HASH
+        )
+
+    # Selects multiple fingerprints of the songs of a catalog, the IN part
+    # is filled in first.
+    SELECT_MULTIPLE_IN_CATALOG = """
+        SELECT f.%s, f.%s, f.%s
+        FROM %s f JOIN %s s ON s.%s = f.%s
+        WHERE s.%s = True AND s.%s = %%%%s AND f.%s IN (%%s);
+        """ % (
+            Database.FIELD_HASH,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_OFFSET,
+            Database.FINGERPRINTS_TABLENAME,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_FINGERPRINTED,
+            Database.FIELD_CATALOG,
             Database.FIELD_HASH
         )
 
@@ -153,6 +391,169 @@ class PostgresDatabase(Database):
             Database.FIELD_FINGERPRINTED
         )
 
+    # Selects the sha1 of all FINGERPRINTED songs.
+    SELECT_SONG_HASHES = """
+        SELECT %s
+        FROM %s WHERE %s = True;
+        """ % (
+            Database.FIELD_FILE_SHA1,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_FINGERPRINTED
+        )
+
+    # Selects songs, FINGERPRINTED or not, above a given id.
+    SELECT_SONGS_AFTER = """
+        SELECT %s, %s, %s
+        FROM %s
+        WHERE %s > %%s
+        ORDER BY %s;
+        """ % (
+            Database.FIELD_SONG_ID,
+            Database.FIELD_FILE_SHA1,
+            Database.FIELD_FINGERPRINTED,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_SONG_ID
+        )
+
+    # Selects which of the given sha1s are FINGERPRINTED songs.
+    SELECT_FINGERPRINTED_HASHES = """
+        SELECT %s
+        FROM %s
+        WHERE %s = True AND %s IN (%%s);
+        """ % (
+            Database.FIELD_FILE_SHA1,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_FINGERPRINTED,
+            Database.FIELD_FILE_SHA1
+        )
+
+    # Selects which of the given sha1s are FINGERPRINTED songs of a catalog.
+    SELECT_FINGERPRINTED_HASHES_IN_CATALOG = """
+        SELECT %s
+        FROM %s
+        WHERE %s = True AND %s = %%%%s AND %s IN (%%s);
+        """ % (
+            Database.FIELD_FILE_SHA1,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_FINGERPRINTED,
+            Database.FIELD_CATALOG,
+            Database.FIELD_FILE_SHA1
+        )
+
+    # Selects the sha1 of all aliases.
+    SELECT_ALIAS_HASHES = """
+        SELECT %s
+        FROM %s;
+        """ % (
+            Database.FIELD_FILE_SHA1,
+            Database.ALIASES_TABLENAME
+        )
+
+    # Selects which of the given sha1s are aliases.
+    SELECT_ALIASED_HASHES = """
+        SELECT %s
+        FROM %s
+        WHERE %s IN (%%s);
+        """ % (
+            Database.FIELD_FILE_SHA1,
+            Database.ALIASES_TABLENAME,
+            Database.FIELD_FILE_SHA1
+        )
+
+    # Selects which of the given sha1s are aliases of songs of a catalog.
+    SELECT_ALIASED_HASHES_IN_CATALOG = """
+        SELECT a.%s
+        FROM %s a JOIN %s s ON s.%s = a.%s
+        WHERE s.%s = %%%%s AND a.%s IN (%%s);
+        """ % (
+            Database.FIELD_FILE_SHA1,
+            Database.ALIASES_TABLENAME,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_CATALOG,
+            Database.FIELD_FILE_SHA1
+        )
+
+    # Selects every fingerprint version.
+    SELECT_VERSIONS = """
+        SELECT %s, %s, %s
+        FROM %s
+        ORDER BY %s;
+        """ % (
+            Database.FIELD_VERSION,
+            Database.FIELD_PARAMS,
+            Database.FIELD_STATE,
+            Database.VERSIONS_TABLENAME,
+            Database.FIELD_VERSION
+        )
+
+    # Selects the version recognition is served from.
+    SELECT_ACTIVE_VERSION = """
+        SELECT %s, %s, %s
+        FROM %s
+        WHERE %s = '%s';
+        """ % (
+            Database.FIELD_VERSION,
+            Database.FIELD_PARAMS,
+            Database.FIELD_STATE,
+            Database.VERSIONS_TABLENAME,
+            Database.FIELD_STATE,
+            Database.VERSION_ACTIVE
+        )
+
+    # Selects the unfinished songs of the journal.
+    SELECT_UNFINISHED_SONGS = """
+        SELECT s.%s, s.%s, s.%s, j.%s, j.%s
+        FROM %s j JOIN %s s ON s.%s = j.%s
+        WHERE s.%s = False;
+        """ % (
+            Database.FIELD_SONG_ID,
+            Database.FIELD_FILE_SHA1,
+            Database.FIELD_CATALOG,
+            Database.FIELD_VERSION,
+            Database.FIELD_OFFSET,
+            Database.JOURNAL_TABLENAME,
+            Database.SONGS_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_FINGERPRINTED
+        )
+
+    # Selects the songs stored so far in the shadow table of a version.
+    SELECT_VERSION_SONGS = """
+        SELECT %s
+        FROM %s
+        WHERE %s = %%s;
+        """ % (
+            Database.FIELD_SONG_ID,
+            Database.VERSION_SONGS_TABLENAME,
+            Database.FIELD_VERSION
+        )
+
+    # Counts the FINGERPRINTED songs missing from a version.
+    SELECT_NUM_MISSING_VERSION_SONGS = """
+        SELECT COUNT(*)
+        FROM %s s
+        WHERE s.%s = True AND NOT EXISTS (
+            SELECT 1 FROM %s v WHERE v.%s = %%s AND v.%s = s.%s);
+        """ % (
+            Database.SONGS_TABLENAME,
+            Database.FIELD_FINGERPRINTED,
+            Database.VERSION_SONGS_TABLENAME,
+            Database.FIELD_VERSION,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_SONG_ID
+        )
+
+    # Drops the aliases table
+    DROP_ALIASES = """
+        DROP TABLE IF EXISTS %s;
+        """ % (
+            Database.ALIASES_TABLENAME
+        )
+
     # Drops the fingerprints table (removes EVERYTHING!)
     DROP_FINGERPRINTS = """
         DROP TABLE IF EXISTS %s;""" % (
@@ -166,6 +567,39 @@ class PostgresDatabase(Database):
             Database.SONGS_TABLENAME
         )
 
+    # Drops the fingerprint version tables
+    DROP_VERSIONS = """
+        DROP TABLE IF EXISTS %s;
+        DROP TABLE IF EXISTS %s;
+        """ % (
+            Database.VERSION_SONGS_TABLENAME,
+            Database.VERSIONS_TABLENAME
+        )
+
+    # Drops the ingestion journal
+    DROP_JOURNAL = """
+        DROP TABLE IF EXISTS %s;
+        """ % (
+            Database.JOURNAL_TABLENAME
+        )
+
+    # Drops the shadow table of a version.
+    DROP_TABLE = """
+        DROP TABLE IF EXISTS %s;
+        """
+
+    # Moves a version from one state to another.
+    UPDATE_VERSION_STATE = """
+        UPDATE %s
+        SET %s = %%s
+        WHERE %s = %%s AND %s = %%s
+        """ % (
+            Database.VERSIONS_TABLENAME,
+            Database.FIELD_STATE,
+            Database.FIELD_VERSION,
+            Database.FIELD_STATE
+        )
+
     # Updates a fingerprinted song
     UPDATE_SONG_FINGERPRINTED = """
         UPDATE %s
@@ -177,6 +611,26 @@ class PostgresDatabase(Database):
             Database.FIELD_SONG_ID
         )
 
+    # Closes the journal entry of a fingerprinted song.
+    DELETE_JOURNAL = """
+        DELETE
+        FROM %s
+        WHERE %s = %%s;
+        """ % (
+            Database.JOURNAL_TABLENAME,
+            Database.FIELD_SONG_ID
+        )
+
+    # Forgets the songs of a version once it is active or dropped.
+    DELETE_VERSION_SONGS = """
+        DELETE
+        FROM %s
+        WHERE %s = %%s;
+        """ % (
+            Database.VERSION_SONGS_TABLENAME,
+            Database.FIELD_VERSION
+        )
+
     # Deletes all unfingerprinted songs.
     DELETE_UNFINGERPRINTED = """
         DELETE
@@ -187,6 +641,23 @@ class PostgresDatabase(Database):
             Database.FIELD_FINGERPRINTED
         )
 
+    # Deletes the unfingerprinted songs whose journal entry was not moved
+    # for a while, or which have none (left over from before the journal).
+    DELETE_STALE_SONGS = """
+        DELETE
+        FROM %s s
+        WHERE s.%s = False AND NOT EXISTS (
+            SELECT 1 FROM %s j WHERE j.%s = s.%s
+            AND j.%s >= now() - %%s * interval '1 second');
+        """ % (
+            Database.SONGS_TABLENAME,
+            Database.FIELD_FINGERPRINTED,
+            Database.JOURNAL_TABLENAME,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_SONG_ID,
+            Database.FIELD_UPDATED
+        )
+
     def __init__(self, **options):
         """ Creates the DB layout, creates connection, etc.
         """
@@ -205,11 +676,19 @@ class PostgresDatabase(Database):
         """
         Creates any non-existing tables required for dejavu to function.
 
-        This also removes all songs that have been added but have no
-        fingerprints associated with them.
+        Songs left unfinished by an interrupted ingestion are kept, their
+        ingestion resumes where the journal says it stopped.
         """
         with self.cursor() as cur:
             cur.execute(self.CREATE_FINGERPRINT_INDEX)
+            cur.execute(self.CREATE_CATALOG_COLUMN)
+            cur.execute(self.CREATE_ALIASES_TABLE)
+            cur.execute(self.CREATE_VERSIONS_TABLE)
+            cur.execute(self.CREATE_VERSION_SONGS_TABLE)
+            cur.execute(self.CREATE_JOURNAL_TABLE)
+            cur.execute(self.CREATE_JOURNAL_UPDATED_COLUMN)
+            cur.execute(self.INSERT_FIRST_VERSION,
+                        (encode_params(DEFAULT_PARAMS),))
 
     def empty(self):
         """
@@ -219,7 +698,14 @@ class PostgresDatabase(Database):
         This will result in a loss of data, so this might not
         be what you want.
         """
+        versions = self.get_fingerprint_versions()
         with self.cursor() as cur:
+            for version, _, state in versions:
+                if state != Database.VERSION_ACTIVE:
+                    cur.execute(self.DROP_TABLE % self.version_table(version))
+            cur.execute(self.DROP_VERSIONS)
+            cur.execute(self.DROP_JOURNAL)
+            cur.execute(self.DROP_ALIASES)
             cur.execute(self.DROP_FINGERPRINTS)
             cur.execute(self.DROP_SONGS)
         self.setup()
@@ -232,6 +718,14 @@ class PostgresDatabase(Database):
         with self.cursor() as cur:
             cur.execute(self.DELETE_UNFINGERPRINTED)
 
+    def delete_stale_songs(self, max_age):
+        """
+        Removes the songs whose journal entry was last moved more than
+        `max_age` seconds ago, their hashes go with them.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.DELETE_STALE_SONGS, (max_age,))
+
     def get_num_songs(self):
         """
         Returns number of songs the database has fingerprinted.
@@ -260,6 +754,7 @@ class PostgresDatabase(Database):
         """
         with self.cursor() as cur:
             cur.execute(self.UPDATE_SONG_FINGERPRINTED, (sid,))
+            cur.execute(self.DELETE_JOURNAL, (sid,))
 
     def get_songs(self):
         """
@@ -272,6 +767,190 @@ class PostgresDatabase(Database):
                 (song_id, song_name, file_sha1) = (row['song_id'], row['song_name'], row['file_sha1'])
                 yield Database.Song(song_id, song_name, binascii.hexlify(file_sha1).upper())
 
+    def get_song_hashes(self):
+        """
+        Generator returning the raw sha1 of every FINGERPRINTED song.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_SONG_HASHES)
+            for file_sha1, in cur:
+                yield bytes(file_sha1)
+
+    def get_songs_after(self, sid):
+        """
+        Generator returning (song_id, raw sha1, fingerprinted) of the songs
+        with an ID above `sid`.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_SONGS_AFTER, (sid,))
+            for song_id, file_sha1, fingerprinted in cur:
+                yield song_id, bytes(file_sha1), bool(fingerprinted)
+
+    def filter_fingerprinted(self, file_hashes, catalog=None):
+        """
+        Returns which of the given sha1s belong to FINGERPRINTED songs, of
+        `catalog` when given.
+        """
+        if catalog is None:
+            queries = (self.SELECT_FINGERPRINTED_HASHES,
+                       self.SELECT_ALIASED_HASHES)
+            params = ()
+        else:
+            queries = (self.SELECT_FINGERPRINTED_HASHES_IN_CATALOG,
+                       self.SELECT_ALIASED_HASHES_IN_CATALOG)
+            params = (catalog,)
+
+        found = set()
+        with self.cursor() as cur:
+            for split_values in grouper(file_hashes, self.NUM_HASHES):
+                in_values = ', '.join(["decode(%s, 'hex')"] * len(split_values))
+                for query in queries:
+                    cur.execute(query % in_values, params + tuple(split_values))
+                    for file_sha1, in cur:
+                        found.add(binascii.hexlify(file_sha1).upper())
+        return found
+
+    def get_song_aliases(self):
+        """
+        Generator returning the raw sha1 of every alias.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_ALIAS_HASHES)
+            for file_sha1, in cur:
+                yield bytes(file_sha1)
+
+    def insert_alias(self, file_hash, sid):
+        """
+        Links a file sha1 to an existing song.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_ALIAS, (file_hash, sid))
+
+    def get_unfinished_songs(self):
+        """
+        Returns the songs of the ingestion journal that are not
+        FINGERPRINTED.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_UNFINISHED_SONGS)
+            return [Database.UnfinishedSong(
+                        song_id, binascii.hexlify(file_sha1).upper(), catalog,
+                        version, offset)
+                    for song_id, file_sha1, catalog, version, offset in cur]
+
+    def insert_hash_batch(self, sid, hashes, offset, version=None):
+        """
+        Inserts a batch of hashes of a song and moves its journal entry to
+        `offset`, in one transaction.
+        """
+        values = [(bhash, sid, hash_offset) for bhash, hash_offset in hashes]
+        with self.cursor() as cur:
+            for split_values in grouper(values, self.NUM_HASHES):
+                args_str = ','.join(cur.mogrify("(decode(%s, 'hex'), %s, %s)", x) for x in split_values)
+                cur.execute(self.INSERT_FINGERPRINT_BASIC + " " + args_str + ";")
+            cur.execute(self.UPSERT_JOURNAL, (sid, version, offset))
+
+    def get_fingerprint_versions(self):
+        """
+        Returns every fingerprint version in version order.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_VERSIONS)
+            return [Database.FingerprintVersion(version, decode_params(params),
+                                                state)
+                    for version, params, state in cur]
+
+    def get_active_fingerprint_version(self):
+        """
+        Returns the version recognition is served from.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_ACTIVE_VERSION)
+            for version, params, state in cur:
+                return Database.FingerprintVersion(version,
+                                                   decode_params(params), state)
+            return None
+
+    def create_fingerprint_version(self, params):
+        """
+        Adds a version being built and its shadow table.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_VERSION, (encode_params(params),))
+            version = cur.fetchone()[0]
+            cur.execute(self.CREATE_VERSION_TABLE
+                        % {"table": self.version_table(version)})
+        return version
+
+    def get_version_song_ids(self, version):
+        """
+        Returns the songs stored so far in the shadow table of `version`.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_VERSION_SONGS, (version,))
+            return set(song_id for song_id, in cur)
+
+    def insert_version_hashes(self, version, sid, hashes):
+        """
+        Inserts the hashes of a song into the shadow table of `version` and
+        records the song as done, in one transaction.
+        """
+        query = self.INSERT_FINGERPRINT_INTO % self.version_table(version)
+        values = [(bhash, sid, offset) for bhash, offset in hashes]
+        with self.cursor() as cur:
+            for split_values in grouper(values, self.NUM_HASHES):
+                args_str = ','.join(cur.mogrify("(decode(%s, 'hex'), %s, %s)", x) for x in split_values)
+                cur.execute(query + " " + args_str + ";")
+            cur.execute(self.INSERT_VERSION_SONG, (version, sid))
+
+    def count_missing_version_songs(self, version):
+        """
+        Returns the number of FINGERPRINTED songs not in the shadow table of
+        `version` yet.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_NUM_MISSING_VERSION_SONGS, (version,))
+            for count, in cur:
+                return count
+            return 0
+
+    def activate_fingerprint_version(self, version):
+        """
+        Swaps the shadow table of `version` with the fingerprint table and
+        updates the version states, all in one transaction.
+        """
+        active = self.get_active_fingerprint_version()
+        with self.cursor() as cur:
+            cur.execute(self.UPDATE_VERSION_STATE, (
+                Database.VERSION_ACTIVE, version, Database.VERSION_BUILDING))
+            if cur.rowcount != 1:
+                raise ValueError("Fingerprint version %s is not being built"
+                                 % version)
+            cur.execute(self.UPDATE_VERSION_STATE, (
+                Database.VERSION_RETIRED, active.version,
+                Database.VERSION_ACTIVE))
+            cur.execute(self.SWAP_FINGERPRINTS % {
+                "retired": self.version_table(active.version),
+                "table": self.version_table(version)})
+            cur.execute(self.DELETE_VERSION_SONGS, (version,))
+        return active.version
+
+    def drop_fingerprint_version(self, version):
+        """
+        Drops the table of a retired version or of a version being built.
+        """
+        with self.cursor() as cur:
+            for state in (Database.VERSION_RETIRED, Database.VERSION_BUILDING):
+                cur.execute(self.UPDATE_VERSION_STATE, (
+                    Database.VERSION_DROPPED, version, state))
+                if cur.rowcount == 1:
+                    break
+            else:
+                raise ValueError("Fingerprint version %s is neither retired "
+                                 "nor being built" % version)
+            cur.execute(self.DROP_TABLE % self.version_table(version))
+            cur.execute(self.DELETE_VERSION_SONGS, (version,))
+
     def get_song_by_id(self, song_id):
         """
         Returns song by its ID.
@@ -296,13 +975,15 @@ class PostgresDatabase(Database):
         with self.cursor() as cur:
             cur.execute(self.INSERT_FINGERPRINT, bhash, song_id, offset)
 
-    def insert_song(self, songname, file_hash):
+    def insert_song(self, songname, file_hash, catalog=None):
         """
         Inserts song in the database and returns the ID of the inserted record.
         """
         with self.cursor() as cur:
-            cur.execute(self.INSERT_SONG, (songname, file_hash))
-            return cur.fetchone()[0]
+            cur.execute(self.INSERT_SONG, (songname, file_hash, catalog))
+            sid = cur.fetchone()[0]
+            cur.execute(self.INSERT_JOURNAL, (sid,))
+            return sid
 
     def query(self, bhash):
         """
@@ -332,7 +1013,7 @@ class PostgresDatabase(Database):
         Insert series of hash => song_id, offset
         values into the database.
         """
-        print "Inserting %s hashes for song_id %s" % (len(hashes), sid)
+        logger.debug("Inserting %s hashes for song_id %s", len(hashes), sid)
 
         values = []
         for bhash, offset in hashes:
@@ -343,31 +1024,66 @@ class PostgresDatabase(Database):
                 args_str = ','.join(cur.mogrify("(decode(%s, 'hex'), %s, %s)", x) for x in split_values)
                 cur.execute(self.INSERT_FINGERPRINT_BASIC + " " + args_str + ";")
 
-    def return_matches(self, hashes):
+    def return_matches(self, hashes, catalog=None):
         """
         Return the (song_id, offset_diff) tuples associated with
-        a list of (sha1, sample_offset) values as a generator.
+        a list of (sha1, sample_offset) values as a generator, only songs
+        of `catalog` when it is given.
+        """
+        for matches in self.return_matches_chunks(hashes, catalog=catalog):
+            for match in matches:
+                yield match
+
+    def return_matches_chunks(self, hashes, chunk_size=None, catalog=None):
         """
-        # Create a dictionary of hash => offset pairs for later lookups
+        Generator returning the matches of every query of `chunk_size`
+        (default `NUM_HASHES`) hashes as a list, hashes are queried in the
+        given order.
+        """
+        # Every hash is sent once, its rows are matched against all the
+        # offsets it was sampled at, e.g. in several channels
         mapper = {}
+        values = []
         for bhash, offset in hashes:
-            mapper[bhash.upper()] = offset
-
-        # Get an iteratable of all the hashes we need
-        values = mapper.keys()
+            bhash = bhash.upper()
+            if bhash not in mapper:
+                values.append(bhash)
+                mapper[bhash] = []
+            mapper[bhash].append(offset)
+
+        for rows in self.lookup_hashes_chunks(values, chunk_size, catalog):
+            # (sid, db_offset - song_sampled_offset)
+            yield [(sid, offset - sampled) for bhash, sid, offset in rows
+                   for sampled in mapper[bhash]]
+
+    def lookup_hashes_chunks(self, hashes, chunk_size=None, catalog=None):
+        """
+        Generator returning the (hash, sid, offset) rows of every query of
+        `chunk_size` (default `NUM_HASHES`) distinct hashes as a list,
+        fingerprinted songs only.
+        """
+        if catalog is None:
+            query, params = self.SELECT_MULTIPLE, ()
+        else:
+            query, params = self.SELECT_MULTIPLE_IN_CATALOG, (catalog,)
 
         with self.cursor() as cur:
-            for split_values in grouper(values, self.NUM_HASHES):
+            for split_values in grouper([h.upper() for h in hashes],
+                                        chunk_size or self.NUM_HASHES):
                 # Create our IN part of the query
-                query = self.SELECT_MULTIPLE
-                query = query % ', '.join(["decode(%s, 'hex')"] * len(split_values))
+                in_values = ', '.join(["decode(%s, 'hex')"] * len(split_values))
 
-                cur.execute(query, split_values)
+                cur.execute(query % in_values, params + tuple(split_values))
+                yield [(binascii.hexlify(bhash).upper(), sid, offset)
+                       for bhash, sid, offset in cur]
 
-                for bhash, sid, offset in cur:
-                    bhash = binascii.hexlify(bhash).upper()
-                    # (sid, db_offset - song_sampled_offset)
-                    yield (sid, offset - mapper[bhash])
+    def get_common_hashes(self, min_rows):
+        """
+        Returns the hashes stored at least `min_rows` times, upper case.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_COMMON_HASHES, (min_rows,))
+            return [binascii.hexlify(bhash).upper() for bhash, in cur]
 
     def __getstate__(self):
         return (self._options,)
@@ -451,12 +1167,14 @@ class Cursor(object):
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a Postgres related error we try to rollback the cursor.
-        if extype in [psycopg2.DatabaseError, psycopg2.InternalError]:
-            self.conn.rollback()
-
+        # whatever interrupted the block (a database error, an interrupt...)
+        # none of its statements are kept, e.g. hashes without their journal
+        # entry
         self.cursor.close()
-        self.conn.commit()
+        if extype is not None:
+            self.conn.rollback()
+        else:
+            self.conn.commit()
 
         # Put it back on the queue
         try:
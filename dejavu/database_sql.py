@@ -3,9 +3,10 @@ from itertools import izip_longest
 import Queue
 
 import MySQLdb as mysql
-from MySQLdb.cursors import DictCursor
+from MySQLdb.cursors import DictCursor, SSCursor
 
-from dejavu.database import Database
+from dejavu.database import Database, encode_params, decode_params
+from dejavu.fingerprint import DEFAULT_PARAMS
 
 
 class SQLDatabase(Database):
@@ -46,9 +47,10 @@ class SQLDatabase(Database):
 
     type = "mysql"
 
-    # creates
-    CREATE_FINGERPRINTS_TABLE = """
-        CREATE TABLE IF NOT EXISTS `%s` (
+    # creates, the table name of fingerprint tables is filled in last so the
+    # shadow tables of fingerprint versions are created alike
+    CREATE_FINGERPRINTS_TABLE_NAMED = """
+        CREATE TABLE IF NOT EXISTS `%%s` (
              `%s` binary(10) not null,
              `%s` mediumint unsigned not null,
              `%s` int unsigned not null,
@@ -56,49 +58,180 @@ class SQLDatabase(Database):
          UNIQUE KEY `unique_constraint` (%s, %s, %s),
          FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE
     ) ENGINE=INNODB;""" % (
-        Database.FINGERPRINTS_TABLENAME, Database.FIELD_HASH,
+        Database.FIELD_HASH,
         Database.FIELD_SONG_ID, Database.FIELD_OFFSET, Database.FIELD_HASH,
         Database.FIELD_SONG_ID, Database.FIELD_OFFSET, Database.FIELD_HASH,
         Database.FIELD_SONG_ID, Database.SONGS_TABLENAME, Database.FIELD_SONG_ID
     )
 
+    CREATE_FINGERPRINTS_TABLE = (CREATE_FINGERPRINTS_TABLE_NAMED %
+                                 Database.FINGERPRINTS_TABLENAME)
+
     CREATE_SONGS_TABLE = """
         CREATE TABLE IF NOT EXISTS `%s` (
             `%s` mediumint unsigned not null auto_increment,
             `%s` varchar(250) not null,
             `%s` tinyint default 0,
             `%s` binary(20) not null,
+            `%s` varchar(64) default null,
         PRIMARY KEY (`%s`),
-        UNIQUE KEY `%s` (`%s`)
+        UNIQUE KEY `%s` (`%s`),
+        INDEX (`%s`)
     ) ENGINE=INNODB;""" % (
         Database.SONGS_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_SONGNAME, Database.FIELD_FINGERPRINTED,
-        Database.FIELD_FILE_SHA1,
+        Database.FIELD_FILE_SHA1, Database.FIELD_CATALOG,
         Database.FIELD_SONG_ID, Database.FIELD_SONG_ID, Database.FIELD_SONG_ID,
+        Database.FIELD_CATALOG,
     )
 
-    # inserts (ignores duplicates)
-    INSERT_FINGERPRINT = """
-        INSERT IGNORE INTO %s (%s, %s, %s) values
-            (UNHEX(%%s), %%s, %%s);
-    """ % (Database.FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET)
+    # adds the catalog column to song tables created before it existed
+    SELECT_CATALOG_COLUMN = """
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = '%s' AND column_name = '%s';
+    """ % (Database.SONGS_TABLENAME, Database.FIELD_CATALOG)
+
+    ADD_CATALOG_COLUMN = """
+        ALTER TABLE `%s` ADD COLUMN `%s` varchar(64) default null, ADD INDEX (`%s`);
+    """ % (Database.SONGS_TABLENAME, Database.FIELD_CATALOG, Database.FIELD_CATALOG)
+
+    CREATE_ALIASES_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` binary(20) not null,
+            `%s` mediumint unsigned not null,
+        PRIMARY KEY (`%s`),
+        FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE
+    ) ENGINE=INNODB;""" % (
+        Database.ALIASES_TABLENAME, Database.FIELD_FILE_SHA1, Database.FIELD_SONG_ID,
+        Database.FIELD_FILE_SHA1, Database.FIELD_SONG_ID, Database.SONGS_TABLENAME,
+        Database.FIELD_SONG_ID,
+    )
 
-    INSERT_SONG = "INSERT INTO %s (%s, %s) values (%%s, UNHEX(%%s));" % (
-        Database.SONGS_TABLENAME, Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1)
+    # fingerprint versions and the songs stored so far in the shadow table
+    # of a version being built
+    CREATE_VERSIONS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` int unsigned not null auto_increment,
+            `%s` text not null,
+            `%s` varchar(10) not null,
+        PRIMARY KEY (`%s`)
+    ) ENGINE=INNODB;""" % (
+        Database.VERSIONS_TABLENAME, Database.FIELD_VERSION, Database.FIELD_PARAMS,
+        Database.FIELD_STATE, Database.FIELD_VERSION,
+    )
+
+    CREATE_VERSION_SONGS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` int unsigned not null,
+            `%s` mediumint unsigned not null,
+        PRIMARY KEY (`%s`, `%s`),
+        FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE
+    ) ENGINE=INNODB;""" % (
+        Database.VERSION_SONGS_TABLENAME, Database.FIELD_VERSION, Database.FIELD_SONG_ID,
+        Database.FIELD_VERSION, Database.FIELD_SONG_ID, Database.FIELD_SONG_ID,
+        Database.SONGS_TABLENAME, Database.FIELD_SONG_ID,
+    )
+
+    # how far the hashes of every song being fingerprinted are stored
+    CREATE_JOURNAL_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` mediumint unsigned not null,
+            `%s` int unsigned default null,
+            `%s` int unsigned not null default 0,
+            `%s` timestamp not null default CURRENT_TIMESTAMP,
+        PRIMARY KEY (`%s`),
+        FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE
+    ) ENGINE=INNODB;""" % (
+        Database.JOURNAL_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_VERSION,
+        Database.FIELD_OFFSET, Database.FIELD_UPDATED, Database.FIELD_SONG_ID,
+        Database.FIELD_SONG_ID, Database.SONGS_TABLENAME, Database.FIELD_SONG_ID,
+    )
+
+    # adds the updated column to journals created before it existed
+    SELECT_JOURNAL_UPDATED_COLUMN = """
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = '%s' AND column_name = '%s';
+    """ % (Database.JOURNAL_TABLENAME, Database.FIELD_UPDATED)
+
+    ADD_JOURNAL_UPDATED_COLUMN = """
+        ALTER TABLE `%s` ADD COLUMN `%s` timestamp not null default CURRENT_TIMESTAMP;
+    """ % (Database.JOURNAL_TABLENAME, Database.FIELD_UPDATED)
+
+    # inserts (ignores duplicates)
+    INSERT_FINGERPRINT_INTO = """
+        INSERT IGNORE INTO %%s (%s, %s, %s) values
+            (UNHEX(%%%%s), %%%%s, %%%%s);
+    """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET)
+
+    INSERT_FINGERPRINT = INSERT_FINGERPRINT_INTO % Database.FINGERPRINTS_TABLENAME
+
+    # the fingerprint table in use when versions were introduced
+    INSERT_FIRST_VERSION = """
+        INSERT IGNORE INTO %s (%s, %s, %s) values (1, %%s, '%s');
+    """ % (Database.VERSIONS_TABLENAME, Database.FIELD_VERSION, Database.FIELD_PARAMS,
+           Database.FIELD_STATE, Database.VERSION_ACTIVE)
+
+    INSERT_VERSION = """
+        INSERT INTO %s (%s, %s) values (%%s, '%s');
+    """ % (Database.VERSIONS_TABLENAME, Database.FIELD_PARAMS, Database.FIELD_STATE,
+           Database.VERSION_BUILDING)
+
+    INSERT_VERSION_SONG = """
+        INSERT IGNORE INTO %s (%s, %s) values (%%s, %%s);
+    """ % (Database.VERSION_SONGS_TABLENAME, Database.FIELD_VERSION, Database.FIELD_SONG_ID)
+
+    INSERT_SONG = "INSERT INTO %s (%s, %s, %s) values (%%s, UNHEX(%%s), %%s);" % (
+        Database.SONGS_TABLENAME, Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1,
+        Database.FIELD_CATALOG)
+
+    INSERT_JOURNAL = "INSERT INTO %s (%s) values (%%s);" % (
+        Database.JOURNAL_TABLENAME, Database.FIELD_SONG_ID)
+
+    UPSERT_JOURNAL = """
+        INSERT INTO %s (%s, %s, %s) values (%%s, %%s, %%s)
+        ON DUPLICATE KEY UPDATE %s = VALUES(%s), %s = VALUES(%s),
+            %s = CURRENT_TIMESTAMP;
+    """ % (Database.JOURNAL_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_VERSION,
+           Database.FIELD_OFFSET, Database.FIELD_VERSION, Database.FIELD_VERSION,
+           Database.FIELD_OFFSET, Database.FIELD_OFFSET, Database.FIELD_UPDATED)
+
+    INSERT_ALIAS = "INSERT IGNORE INTO %s (%s, %s) values (UNHEX(%%s), %%s);" % (
+        Database.ALIASES_TABLENAME, Database.FIELD_FILE_SHA1, Database.FIELD_SONG_ID)
 
     # selects
     SELECT = """
         SELECT %s, %s FROM %s WHERE %s = UNHEX(%%s);
     """ % (Database.FIELD_SONG_ID, Database.FIELD_OFFSET, Database.FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
 
+    # songs still being fingerprinted, or left unfinished by an interrupted
+    # ingestion, must not match with part of their hashes
     SELECT_MULTIPLE = """
-        SELECT HEX(%s), %s, %s FROM %s WHERE %s IN (%%s);
+        SELECT HEX(f.%s), f.%s, f.%s FROM %s f JOIN %s s ON s.%s = f.%s
+        WHERE s.%s = 1 AND f.%s IN (%%s);
     """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
-           Database.FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
+           Database.FINGERPRINTS_TABLENAME, Database.SONGS_TABLENAME,
+           Database.FIELD_SONG_ID, Database.FIELD_SONG_ID,
+           Database.FIELD_FINGERPRINTED, Database.FIELD_HASH)
+
+    # the catalog is filtered in the join so only the scoped songs' rows
+    # come back, the IN list is filled in first, hence the `%%%%s`
+    SELECT_MULTIPLE_IN_CATALOG = """
+        SELECT HEX(f.%s), f.%s, f.%s FROM %s f JOIN %s s ON s.%s = f.%s
+        WHERE s.%s = 1 AND s.%s = %%%%s AND f.%s IN (%%s);
+    """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
+           Database.FINGERPRINTS_TABLENAME, Database.SONGS_TABLENAME,
+           Database.FIELD_SONG_ID, Database.FIELD_SONG_ID,
+           Database.FIELD_FINGERPRINTED, Database.FIELD_CATALOG,
+           Database.FIELD_HASH)
 
     SELECT_ALL = """
         SELECT %s, %s FROM %s;
     """ % (Database.FIELD_SONG_ID, Database.FIELD_OFFSET, Database.FINGERPRINTS_TABLENAME)
 
+    SELECT_COMMON_HASHES = """
+        SELECT HEX(%s) FROM %s GROUP BY %s HAVING COUNT(*) >= %%s;
+    """ % (Database.FIELD_HASH, Database.FINGERPRINTS_TABLENAME,
+           Database.FIELD_HASH)
+
     SELECT_SONG = """
         SELECT %s, HEX(%s) as %s FROM %s WHERE %s = %%s;
     """ % (Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.FIELD_FILE_SHA1, Database.SONGS_TABLENAME, Database.FIELD_SONG_ID)
@@ -116,11 +249,94 @@ class SQLDatabase(Database):
     """ % (Database.FIELD_SONG_ID, Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.FIELD_FILE_SHA1,
            Database.SONGS_TABLENAME, Database.FIELD_FINGERPRINTED)
 
+    SELECT_SONG_HASHES = """
+        SELECT %s FROM %s WHERE %s = 1;
+    """ % (Database.FIELD_FILE_SHA1, Database.SONGS_TABLENAME, Database.FIELD_FINGERPRINTED)
+
+    SELECT_SONGS_AFTER = """
+        SELECT %s, %s, %s FROM %s WHERE %s > %%s ORDER BY %s;
+    """ % (Database.FIELD_SONG_ID, Database.FIELD_FILE_SHA1, Database.FIELD_FINGERPRINTED,
+           Database.SONGS_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_SONG_ID)
+
+    SELECT_FINGERPRINTED_HASHES = """
+        SELECT HEX(%s) FROM %s WHERE %s = 1 AND %s IN (%%s);
+    """ % (Database.FIELD_FILE_SHA1, Database.SONGS_TABLENAME, Database.FIELD_FINGERPRINTED,
+           Database.FIELD_FILE_SHA1)
+
+    SELECT_FINGERPRINTED_HASHES_IN_CATALOG = """
+        SELECT HEX(%s) FROM %s WHERE %s = 1 AND %s = %%%%s AND %s IN (%%s);
+    """ % (Database.FIELD_FILE_SHA1, Database.SONGS_TABLENAME, Database.FIELD_FINGERPRINTED,
+           Database.FIELD_CATALOG, Database.FIELD_FILE_SHA1)
+
+    SELECT_ALIAS_HASHES = """
+        SELECT %s FROM %s;
+    """ % (Database.FIELD_FILE_SHA1, Database.ALIASES_TABLENAME)
+
+    SELECT_ALIASED_HASHES = """
+        SELECT HEX(%s) FROM %s WHERE %s IN (%%s);
+    """ % (Database.FIELD_FILE_SHA1, Database.ALIASES_TABLENAME, Database.FIELD_FILE_SHA1)
+
+    SELECT_ALIASED_HASHES_IN_CATALOG = """
+        SELECT HEX(a.%s) FROM %s a JOIN %s s ON s.%s = a.%s
+        WHERE s.%s = %%%%s AND a.%s IN (%%s);
+    """ % (Database.FIELD_FILE_SHA1, Database.ALIASES_TABLENAME, Database.SONGS_TABLENAME,
+           Database.FIELD_SONG_ID, Database.FIELD_SONG_ID, Database.FIELD_CATALOG,
+           Database.FIELD_FILE_SHA1)
+
+    SELECT_UNFINISHED_SONGS = """
+        SELECT s.%s, HEX(s.%s), s.%s, j.%s, j.%s FROM %s j
+        JOIN %s s ON s.%s = j.%s WHERE s.%s = 0;
+    """ % (Database.FIELD_SONG_ID, Database.FIELD_FILE_SHA1, Database.FIELD_CATALOG,
+           Database.FIELD_VERSION, Database.FIELD_OFFSET, Database.JOURNAL_TABLENAME,
+           Database.SONGS_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_SONG_ID,
+           Database.FIELD_FINGERPRINTED)
+
+    SELECT_VERSIONS = """
+        SELECT %s, %s, %s FROM %s ORDER BY %s;
+    """ % (Database.FIELD_VERSION, Database.FIELD_PARAMS, Database.FIELD_STATE,
+           Database.VERSIONS_TABLENAME, Database.FIELD_VERSION)
+
+    SELECT_ACTIVE_VERSION = """
+        SELECT %s, %s, %s FROM %s WHERE %s = '%s';
+    """ % (Database.FIELD_VERSION, Database.FIELD_PARAMS, Database.FIELD_STATE,
+           Database.VERSIONS_TABLENAME, Database.FIELD_STATE, Database.VERSION_ACTIVE)
+
+    SELECT_VERSION_SONGS = """
+        SELECT %s FROM %s WHERE %s = %%s;
+    """ % (Database.FIELD_SONG_ID, Database.VERSION_SONGS_TABLENAME, Database.FIELD_VERSION)
+
+    SELECT_NUM_MISSING_VERSION_SONGS = """
+        SELECT COUNT(*) FROM %s s WHERE s.%s = 1 AND NOT EXISTS (
+            SELECT 1 FROM %s v WHERE v.%s = %%s AND v.%s = s.%s);
+    """ % (Database.SONGS_TABLENAME, Database.FIELD_FINGERPRINTED,
+           Database.VERSION_SONGS_TABLENAME, Database.FIELD_VERSION,
+           Database.FIELD_SONG_ID, Database.FIELD_SONG_ID)
+
+    SELECT_TABLE_EXISTS = """
+        SELECT COUNT(*) FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_name = %s;
+    """
+
     # drops
+    DROP_ALIASES = "DROP TABLE IF EXISTS %s;" % Database.ALIASES_TABLENAME
     DROP_FINGERPRINTS = "DROP TABLE IF EXISTS %s;" % Database.FINGERPRINTS_TABLENAME
     DROP_SONGS = "DROP TABLE IF EXISTS %s;" % Database.SONGS_TABLENAME
+    DROP_VERSIONS = "DROP TABLE IF EXISTS %s;" % Database.VERSIONS_TABLENAME
+    DROP_JOURNAL = "DROP TABLE IF EXISTS %s;" % Database.JOURNAL_TABLENAME
+    DROP_VERSION_SONGS = "DROP TABLE IF EXISTS %s;" % Database.VERSION_SONGS_TABLENAME
+    DROP_TABLE = "DROP TABLE IF EXISTS `%s`;"
+
+    # swaps the fingerprint table with the shadow table of another version,
+    # a multi-table rename is atomic
+    RENAME_FINGERPRINTS = "RENAME TABLE `%s` TO `%%s`, `%%s` TO `%s`;" % (
+        Database.FINGERPRINTS_TABLENAME, Database.FINGERPRINTS_TABLENAME)
 
     # update
+    UPDATE_VERSION_STATE = """
+        UPDATE %s SET %s = %%s WHERE %s = %%s AND %s = %%s
+    """ % (Database.VERSIONS_TABLENAME, Database.FIELD_STATE, Database.FIELD_VERSION,
+           Database.FIELD_STATE)
+
     UPDATE_SONG_FINGERPRINTED = """
         UPDATE %s SET %s = 1 WHERE %s = %%s
     """ % (Database.SONGS_TABLENAME, Database.FIELD_FINGERPRINTED, Database.FIELD_SONG_ID)
@@ -130,6 +346,25 @@ class SQLDatabase(Database):
         DELETE FROM %s WHERE %s = 0;
     """ % (Database.SONGS_TABLENAME, Database.FIELD_FINGERPRINTED)
 
+    # unfinished songs whose journal entry was not moved for a while, or
+    # which have none (left over from before the journal)
+    DELETE_STALE_SONGS = """
+        DELETE FROM %s WHERE %s = 0 AND NOT EXISTS (
+            SELECT 1 FROM %s j WHERE j.%s = %s.%s
+            AND j.%s >= NOW() - INTERVAL %%s SECOND);
+    """ % (Database.SONGS_TABLENAME, Database.FIELD_FINGERPRINTED,
+           Database.JOURNAL_TABLENAME, Database.FIELD_SONG_ID,
+           Database.SONGS_TABLENAME, Database.FIELD_SONG_ID,
+           Database.FIELD_UPDATED)
+
+    DELETE_JOURNAL = """
+        DELETE FROM %s WHERE %s = %%s;
+    """ % (Database.JOURNAL_TABLENAME, Database.FIELD_SONG_ID)
+
+    DELETE_VERSION_SONGS = """
+        DELETE FROM %s WHERE %s = %%s;
+    """ % (Database.VERSION_SONGS_TABLENAME, Database.FIELD_VERSION)
+
     def __init__(self, **options):
         super(SQLDatabase, self).__init__()
         self.cursor = cursor_factory(**options)
@@ -144,13 +379,25 @@ class SQLDatabase(Database):
         """
         Creates any non-existing tables required for dejavu to function.
 
-        This also removes all songs that have been added but have no
-        fingerprints associated with them.
+        Songs left unfinished by an interrupted ingestion are kept, their
+        ingestion resumes where the journal says it stopped.
         """
         with self.cursor() as cur:
             cur.execute(self.CREATE_SONGS_TABLE)
+            cur.execute(self.SELECT_CATALOG_COLUMN)
+            if not cur.fetchone()[0]:
+                cur.execute(self.ADD_CATALOG_COLUMN)
             cur.execute(self.CREATE_FINGERPRINTS_TABLE)
-            cur.execute(self.DELETE_UNFINGERPRINTED)
+            cur.execute(self.CREATE_ALIASES_TABLE)
+            cur.execute(self.CREATE_VERSIONS_TABLE)
+            cur.execute(self.CREATE_VERSION_SONGS_TABLE)
+            cur.execute(self.CREATE_JOURNAL_TABLE)
+            cur.execute(self.SELECT_JOURNAL_UPDATED_COLUMN)
+            if not cur.fetchone()[0]:
+                cur.execute(self.ADD_JOURNAL_UPDATED_COLUMN)
+            cur.execute(self.INSERT_FIRST_VERSION,
+                        (encode_params(DEFAULT_PARAMS),))
+        self._recover_switch()
 
     def empty(self):
         """
@@ -160,7 +407,15 @@ class SQLDatabase(Database):
         .. warning:
             This will result in a loss of data
         """
+        versions = self.get_fingerprint_versions()
         with self.cursor() as cur:
+            for version, _, state in versions:
+                if state != Database.VERSION_ACTIVE:
+                    cur.execute(self.DROP_TABLE % self.version_table(version))
+            cur.execute(self.DROP_VERSION_SONGS)
+            cur.execute(self.DROP_VERSIONS)
+            cur.execute(self.DROP_JOURNAL)
+            cur.execute(self.DROP_ALIASES)
             cur.execute(self.DROP_FINGERPRINTS)
             cur.execute(self.DROP_SONGS)
 
@@ -173,6 +428,14 @@ class SQLDatabase(Database):
         with self.cursor() as cur:
             cur.execute(self.DELETE_UNFINGERPRINTED)
 
+    def delete_stale_songs(self, max_age):
+        """
+        Removes the songs whose journal entry was last moved more than
+        `max_age` seconds ago, their hashes go with them.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.DELETE_STALE_SONGS, (int(max_age),))
+
     def get_num_songs(self):
         """
         Returns number of songs the database has fingerprinted.
@@ -202,6 +465,7 @@ class SQLDatabase(Database):
         """
         with self.cursor() as cur:
             cur.execute(self.UPDATE_SONG_FINGERPRINTED, (sid,))
+            cur.execute(self.DELETE_JOURNAL, (sid,))
 
     def get_songs(self):
         """
@@ -210,7 +474,220 @@ class SQLDatabase(Database):
         with self.cursor(cursor_type=DictCursor) as cur:
             cur.execute(self.SELECT_SONGS)
             for row in cur:
-                yield row
+                yield Database.Song(row[Database.FIELD_SONG_ID],
+                                    row[Database.FIELD_SONGNAME],
+                                    row[Database.FIELD_FILE_SHA1])
+
+    def get_song_hashes(self):
+        """
+        Return the raw sha1 of songs that have the fingerprinted flag set,
+        streamed from the server.
+        """
+        with self.cursor(cursor_type=SSCursor) as cur:
+            cur.execute(self.SELECT_SONG_HASHES)
+            for file_sha1, in cur:
+                yield file_sha1
+
+    def get_songs_after(self, sid):
+        """
+        Return (song_id, raw sha1, fingerprinted) of songs with an ID above
+        `sid`, streamed from the server.
+        """
+        with self.cursor(cursor_type=SSCursor) as cur:
+            cur.execute(self.SELECT_SONGS_AFTER, (sid,))
+            for song_id, file_sha1, fingerprinted in cur:
+                yield song_id, file_sha1, bool(fingerprinted)
+
+    def filter_fingerprinted(self, file_hashes, catalog=None):
+        """
+        Return which of the given sha1s belong to fingerprinted songs, of
+        `catalog` when given, looked up 1000 at a time.
+        """
+        if catalog is None:
+            queries = (self.SELECT_FINGERPRINTED_HASHES,
+                       self.SELECT_ALIASED_HASHES)
+            params = ()
+        else:
+            queries = (self.SELECT_FINGERPRINTED_HASHES_IN_CATALOG,
+                       self.SELECT_ALIASED_HASHES_IN_CATALOG)
+            params = (catalog,)
+
+        found = set()
+        with self.cursor() as cur:
+            for split_values in grouper(file_hashes, 1000):
+                in_values = ', '.join(['UNHEX(%s)'] * len(split_values))
+                for query in queries:
+                    cur.execute(query % in_values, params + tuple(split_values))
+                    for file_sha1, in cur:
+                        found.add(file_sha1)
+        return found
+
+    def get_song_aliases(self):
+        """
+        Return the raw sha1 of every file linked to another song.
+        """
+        with self.cursor(cursor_type=SSCursor) as cur:
+            cur.execute(self.SELECT_ALIAS_HASHES)
+            for file_sha1, in cur:
+                yield file_sha1
+
+    def insert_alias(self, file_hash, sid):
+        """
+        Links a file sha1 to an existing song.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_ALIAS, (file_hash, sid))
+
+    def get_unfinished_songs(self):
+        """
+        Return the songs of the ingestion journal that are not fingerprinted.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_UNFINISHED_SONGS)
+            return [Database.UnfinishedSong(*row) for row in cur]
+
+    def insert_hash_batch(self, sid, hashes, offset, version=None):
+        """
+        Insert a batch of hashes of a song and move its journal entry to
+        `offset`, in one transaction.
+        """
+        values = [(hash, sid, hash_offset) for hash, hash_offset in hashes]
+        with self.cursor() as cur:
+            for split_values in grouper(values, 1000):
+                cur.executemany(self.INSERT_FINGERPRINT, split_values)
+            cur.execute(self.UPSERT_JOURNAL, (sid, version, offset))
+
+    def get_fingerprint_versions(self):
+        """
+        Returns every fingerprint version in version order.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_VERSIONS)
+            return [Database.FingerprintVersion(version, decode_params(params),
+                                                state)
+                    for version, params, state in cur]
+
+    def get_active_fingerprint_version(self):
+        """
+        Returns the version recognition is served from.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_ACTIVE_VERSION)
+            for version, params, state in cur:
+                return Database.FingerprintVersion(version,
+                                                   decode_params(params), state)
+            return None
+
+    def create_fingerprint_version(self, params):
+        """
+        Adds a version being built and its shadow table.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_VERSION, (encode_params(params),))
+            version = cur.lastrowid
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_FINGERPRINTS_TABLE_NAMED
+                        % self.version_table(version))
+        return version
+
+    def get_version_song_ids(self, version):
+        """
+        Returns the songs stored so far in the shadow table of `version`.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_VERSION_SONGS, (version,))
+            return set(sid for sid, in cur)
+
+    def insert_version_hashes(self, version, sid, hashes):
+        """
+        Inserts the hashes of a song into the shadow table of `version` and
+        records the song as done, in one transaction.
+        """
+        query = self.INSERT_FINGERPRINT_INTO % self.version_table(version)
+        values = [(hash, sid, offset) for hash, offset in hashes]
+        with self.cursor() as cur:
+            for split_values in grouper(values, 1000):
+                cur.executemany(query, split_values)
+            cur.execute(self.INSERT_VERSION_SONG, (version, sid))
+
+    def count_missing_version_songs(self, version):
+        """
+        Returns the number of fingerprinted songs not in the shadow table of
+        `version` yet.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_NUM_MISSING_VERSION_SONGS, (version,))
+            for count, in cur:
+                return count
+            return 0
+
+    def activate_fingerprint_version(self, version):
+        """
+        Swaps the shadow table of `version` with the fingerprint table in a
+        single rename. The version is marked as switching first so `setup`
+        can finish or undo a swap interrupted by a crash, the rename commits
+        on its own.
+        """
+        active = self.get_active_fingerprint_version()
+        with self.cursor() as cur:
+            cur.execute(self.UPDATE_VERSION_STATE, (
+                Database.VERSION_SWITCHING, version, Database.VERSION_BUILDING))
+            if cur.rowcount != 1:
+                raise ValueError("Fingerprint version %s is not being built"
+                                 % version)
+        with self.cursor() as cur:
+            cur.execute(self.RENAME_FINGERPRINTS % (
+                self.version_table(active.version), self.version_table(version)))
+        self._finish_switch(version, active.version)
+        return active.version
+
+    def _finish_switch(self, version, retired):
+        with self.cursor() as cur:
+            cur.execute(self.UPDATE_VERSION_STATE, (
+                Database.VERSION_RETIRED, retired, Database.VERSION_ACTIVE))
+            cur.execute(self.UPDATE_VERSION_STATE, (
+                Database.VERSION_ACTIVE, version, Database.VERSION_SWITCHING))
+            cur.execute(self.DELETE_VERSION_SONGS, (version,))
+
+    def _recover_switch(self):
+        """
+        Finishes a swap of fingerprint tables that was interrupted after the
+        rename, or puts the version back to building when it was before.
+        """
+        versions = self.get_fingerprint_versions()
+        for version, _, state in versions:
+            if state != Database.VERSION_SWITCHING:
+                continue
+            with self.cursor() as cur:
+                cur.execute(self.SELECT_TABLE_EXISTS,
+                            (self.version_table(version),))
+                renamed = not cur.fetchone()[0]
+            if not renamed:
+                with self.cursor() as cur:
+                    cur.execute(self.UPDATE_VERSION_STATE, (
+                        Database.VERSION_BUILDING, version,
+                        Database.VERSION_SWITCHING))
+                continue
+            for retired, _, retired_state in versions:
+                if retired_state == Database.VERSION_ACTIVE:
+                    self._finish_switch(version, retired)
+
+    def drop_fingerprint_version(self, version):
+        """
+        Drops the table of a retired version or of a version being built.
+        """
+        for state in (Database.VERSION_RETIRED, Database.VERSION_BUILDING):
+            with self.cursor() as cur:
+                cur.execute(self.UPDATE_VERSION_STATE, (
+                    Database.VERSION_DROPPED, version, state))
+                if cur.rowcount == 1:
+                    break
+        else:
+            raise ValueError("Fingerprint version %s is neither retired nor "
+                             "being built" % version)
+        with self.cursor() as cur:
+            cur.execute(self.DROP_TABLE % self.version_table(version))
+            cur.execute(self.DELETE_VERSION_SONGS, (version,))
 
     def get_song_by_id(self, sid):
         """
@@ -218,7 +695,11 @@ class SQLDatabase(Database):
         """
         with self.cursor(cursor_type=DictCursor) as cur:
             cur.execute(self.SELECT_SONG, (sid,))
-            return cur.fetchone()
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return Database.Song(sid, row[Database.FIELD_SONGNAME],
+                                 row[Database.FIELD_FILE_SHA1])
 
     def insert(self, hash, sid, offset):
         """
@@ -227,13 +708,15 @@ class SQLDatabase(Database):
         with self.cursor() as cur:
             cur.execute(self.INSERT_FINGERPRINT, (hash, sid, offset))
 
-    def insert_song(self, songname, file_hash):
+    def insert_song(self, songname, file_hash, catalog=None):
         """
         Inserts song in the database and returns the ID of the inserted record.
         """
         with self.cursor() as cur:
-            cur.execute(self.INSERT_SONG, (songname, file_hash))
-            return cur.lastrowid
+            cur.execute(self.INSERT_SONG, (songname, file_hash, catalog))
+            sid = cur.lastrowid
+            cur.execute(self.INSERT_JOURNAL, (sid,))
+            return sid
 
     def query(self, hash):
         """
@@ -269,30 +752,63 @@ class SQLDatabase(Database):
             for split_values in grouper(values, 1000):
                 cur.executemany(self.INSERT_FINGERPRINT, split_values)
 
-    def return_matches(self, hashes):
+    def return_matches(self, hashes, catalog=None):
         """
         Return the (song_id, offset_diff) tuples associated with
-        a list of (sha1, sample_offset) values.
+        a list of (sha1, sample_offset) values, only songs of `catalog`
+        when it is given.
+        """
+        for matches in self.return_matches_chunks(hashes, catalog=catalog):
+            for match in matches:
+                yield match
+
+    def return_matches_chunks(self, hashes, chunk_size=1000, catalog=None):
+        """
+        Same as `return_matches` but yields the matches of every query of
+        `chunk_size` hashes as a list, hashes are queried in the given order.
         """
-        # Create a dictionary of hash => offset pairs for later lookups
+        # Every hash is sent once, its rows are matched against all the
+        # offsets it was sampled at, e.g. in several channels
         mapper = {}
+        values = []
         for hash, offset in hashes:
-            mapper[hash.upper()] = offset
-
-        # Get an iteratable of all the hashes we need
-        values = mapper.keys()
+            hash = hash.upper()
+            if hash not in mapper:
+                values.append(hash)
+                mapper[hash] = []
+            mapper[hash].append(offset)
+
+        for rows in self.lookup_hashes_chunks(values, chunk_size, catalog):
+            # (sid, db_offset - song_sampled_offset)
+            yield [(sid, offset - sampled) for hash, sid, offset in rows
+                   for sampled in mapper[hash]]
+
+    def lookup_hashes_chunks(self, hashes, chunk_size=1000, catalog=None):
+        """
+        Yields the (hash, sid, offset) rows of every query of `chunk_size`
+        distinct hashes as a list, fingerprinted songs only.
+        """
+        if catalog is None:
+            query, params = self.SELECT_MULTIPLE, ()
+        else:
+            query, params = self.SELECT_MULTIPLE_IN_CATALOG, (catalog,)
 
         with self.cursor() as cur:
-            for split_values in grouper(values, 1000):
+            for split_values in grouper([h.upper() for h in hashes],
+                                        chunk_size):
                 # Create our IN part of the query
-                query = self.SELECT_MULTIPLE
-                query = query % ', '.join(['UNHEX(%s)'] * len(split_values))
+                in_values = ', '.join(['UNHEX(%s)'] * len(split_values))
 
-                cur.execute(query, split_values)
+                cur.execute(query % in_values, params + tuple(split_values))
+                yield list(cur)
 
-                for hash, sid, offset in cur:
-                    # (sid, db_offset - song_sampled_offset)
-                    yield (sid, offset - mapper[hash])
+    def get_common_hashes(self, min_rows):
+        """
+        Returns the hashes stored at least `min_rows` times, upper case.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_COMMON_HASHES, (min_rows,))
+            return [hash for hash, in cur]
 
     def __getstate__(self):
         return (self._options,)
@@ -352,12 +868,14 @@ class Cursor(object):
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a MySQL related error we try to rollback the cursor.
-        if extype is mysql.MySQLError:
-            self.cursor.rollback()
-
+        # whatever interrupted the block (a database error, an interrupt...)
+        # none of its statements are kept, e.g. hashes without their journal
+        # entry
         self.cursor.close()
-        self.conn.commit()
+        if extype is not None:
+            self.conn.rollback()
+        else:
+            self.conn.commit()
 
         # Put it back on the queue
         try:
@@ -1,8 +1,12 @@
 import os
+import wave
 import fnmatch
+import threading
+import subprocess
 import numpy as np
 from pydub import AudioSegment
-from pydub.utils import audioop
+from pydub.exceptions import CouldntDecodeError
+from pydub.utils import audioop, mediainfo
 import wavio
 from hashlib import sha1
 
@@ -90,6 +94,171 @@ def read(file_or_segment, limit=None, file_format="wav"):
 
     return channels, fs, file_sha1
 
+def read_chunks(filename, seconds=10, limit=None):
+    """
+    Decodes an audio file `seconds` at a time instead of all at once, e.g.
+    a recording of several hours. 16-bit WAV files are read directly,
+    anything else is decoded by ffmpeg into a pipe. Stops after `limit`
+    seconds when given.
+
+    returns: a generator of (channels, samplerate) like `read`, every chunk
+    holding the samples that follow the previous one.
+    """
+    try:
+        f = wave.open(filename, "rb")
+    except (wave.Error, EOFError):
+        f = None
+    if f is not None and f.getsampwidth() != 2:
+        f.close()
+        f = None
+    if f is None:
+        return _read_chunks_ffmpeg(filename, seconds, limit)
+    return _read_chunks_wave(f, seconds, limit)
+
+def _read_chunks_wave(f, seconds, limit):
+    try:
+        fs, nchannels = f.getframerate(), f.getnchannels()
+        remaining = int(limit * fs) if limit else None
+        while remaining is None or remaining > 0:
+            n = int(seconds * fs)
+            if remaining is not None:
+                n = min(n, remaining)
+                remaining -= n
+            data = f.readframes(n)
+            if not data:
+                return
+            yield _split_channels(data, nchannels), fs
+    finally:
+        f.close()
+
+def _read_chunks_ffmpeg(filename, seconds, limit):
+    info = get_audio_info(filename)
+    if info is None:
+        raise CouldntDecodeError("Could not probe %s" % filename)
+    _, fs, nchannels = info
+    command = [AudioSegment.converter, "-v", "quiet", "-i", filename]
+    if limit:
+        command += ["-t", str(limit)]
+    command += ["-f", "s16le", "-acodec", "pcm_s16le",
+                "-ar", str(fs), "-ac", str(nchannels), "-"]
+    with open(os.devnull, "wb") as devnull:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=devnull)
+    try:
+        for chunk in _read_pcm(process.stdout.read, fs, nchannels, seconds):
+            yield chunk
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    if process.returncode:
+        raise CouldntDecodeError("ffmpeg failed to decode %s" % filename)
+
+def read_stream(source, samplerate, channels, seconds=1, file_format=None):
+    """
+    Decodes live audio read from `source`, a file-like object, a socket or
+    a file descriptor, e.g. a pipe or a radio stream. The audio is raw
+    16-bit little-endian PCM of `samplerate` and `channels` when
+    `file_format` is None, otherwise it is in that ffmpeg input format,
+    e.g. "mp3", and ffmpeg decodes it into `samplerate` and `channels`.
+
+    returns: a generator of (channels, samplerate) like `read_chunks`, a
+    chunk every `seconds` of audio read. It ends when `source` does.
+    """
+    read = _reader(source)
+    if file_format is None:
+        return _read_pcm(read, samplerate, channels, seconds)
+    return _read_stream_ffmpeg(read, samplerate, channels, seconds,
+                               file_format)
+
+def _reader(source):
+    """
+    Returns a function reading up to n bytes of `source`, "" at its end.
+    """
+    if isinstance(source, (int, long)):
+        return lambda n: os.read(source, n)
+    if hasattr(source, "recv"):
+        return source.recv
+    return source.read
+
+def _read_pcm(read, fs, nchannels, seconds):
+    """
+    Splits raw 16-bit PCM returned by `read` into chunks of `seconds`,
+    the last one possibly shorter.
+    """
+    frame_bytes = 2 * nchannels
+    size = max(int(seconds * fs), 1) * frame_bytes
+    pending = b""
+    while True:
+        data = read(size - len(pending))
+        if data:
+            pending += data
+            if len(pending) < size:
+                continue
+        usable = len(pending) - len(pending) % frame_bytes
+        if usable:
+            yield _split_channels(pending[:usable], nchannels), fs
+        pending = pending[usable:]
+        if not data:
+            return
+
+def _read_stream_ffmpeg(read, fs, nchannels, seconds, file_format):
+    command = [AudioSegment.converter, "-v", "quiet", "-f", file_format,
+               "-i", "pipe:0", "-f", "s16le", "-acodec", "pcm_s16le",
+               "-ar", str(fs), "-ac", str(nchannels), "-"]
+    with open(os.devnull, "wb") as devnull:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=devnull)
+    # ffmpeg blocks on whichever pipe is not served, so the input is copied
+    # by a thread while this one reads the decoded audio
+    feeder = threading.Thread(target=_feed_pipe, args=(read, process.stdin))
+    feeder.daemon = True
+    feeder.start()
+    try:
+        for chunk in _read_pcm(process.stdout.read, fs, nchannels, seconds):
+            yield chunk
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    if process.returncode:
+        raise CouldntDecodeError("ffmpeg failed to decode the stream")
+
+def _feed_pipe(read, pipe, blocksize=2**16):
+    try:
+        while True:
+            data = read(blocksize)
+            if not data:
+                break
+            pipe.write(data)
+    except (IOError, OSError):
+        pass  # ffmpeg went away, the reader reports it
+    finally:
+        try:
+            pipe.close()
+        except (IOError, OSError):
+            pass
+
+def _split_channels(data, nchannels):
+    samples = np.frombuffer(data, np.int16)
+    return [samples[chn::nchannels] for chn in xrange(nchannels)]
+
+def get_audio_info(filename):
+    """
+    Probes an audio file with ffprobe without decoding it.
+
+    returns: (duration in seconds, samplerate, channels) or None when the
+    file can't be probed.
+    """
+    try:
+        info = mediainfo(filename)
+        return (float(info["duration"]), int(info["sample_rate"]),
+                int(info["channels"]))
+    except Exception:
+        return None
+
 def path_to_songname(path):
     """
     Extracts song name from a filepath. Used to identify which songs
@@ -5,10 +5,16 @@ from scipy.ndimage.filters import maximum_filter
 from scipy.ndimage.morphology import (generate_binary_structure,
                                       iterate_structure, binary_erosion)
 import hashlib
+import logging
 from operator import itemgetter
 
 import warnings
 
+from dejavu.timing import (NULL_TIMER, STAGE_SPECGRAM, STAGE_PEAKS,
+                           STAGE_HASH, COUNT_PEAKS, COUNT_HASHES)
+
+logger = logging.getLogger(__name__)
+
 IDX_FREQ_I = 0
 IDX_TIME_J = 1
 
@@ -63,24 +69,154 @@ PEAK_SORT = True
 # potentially higher collisions and misclassifications when identifying songs.
 FINGERPRINT_REDUCTION = 22
 
+######################################################################
+# Keyword arguments of `fingerprint`, the parameters a fingerprint version
+# is built with. Hashes made with other parameters never match these ones.
+DEFAULT_PARAMS = {
+    "wsize": DEFAULT_WINDOW_SIZE,
+    "wratio": DEFAULT_OVERLAP_RATIO,
+    "fan_value": DEFAULT_FAN_VALUE,
+    "amp_min": DEFAULT_AMP_MIN,
+    "neighborhood_size": PEAK_NEIGHBORHOOD_SIZE,
+    "min_time_delta": MIN_HASH_TIME_DELTA,
+    "max_time_delta": MAX_HASH_TIME_DELTA,
+    "peak_sort": PEAK_SORT,
+    "reduction": FINGERPRINT_REDUCTION,
+}
+
+######################################################################
+# Bytes held per spectrogram cell while fingerprinting a channel: the complex
+# FFT output, the magnitude, its log, the maximum filter output and the
+# boolean peak masks.
+SPECGRAM_BYTES_PER_CELL = 48
+
+######################################################################
+# Rough size of one (hash, offset) tuple kept in a python set.
+HASH_BYTES = 150
+
+######################################################################
+# Hashes per time slot when a query is cut down to a budget, see
+# `select_hashes`. Smaller slots spread the picks more evenly, larger ones
+# leave more room to prefer strong peaks.
+BUDGET_SLOT_HASHES = 10
+
+def estimate_memory(duration, Fs, channels,
+                    wsize=DEFAULT_WINDOW_SIZE,
+                    wratio=DEFAULT_OVERLAP_RATIO,
+                    fan_value=DEFAULT_FAN_VALUE):
+    """
+    Estimates the memory needed to fingerprint `duration` seconds of audio.
+
+    returns: (decoded, working) bytes, what the decoded int16 samples take and
+    what fingerprinting them takes on top of that.
+    """
+    samples = int(duration * Fs)
+    # raw bytes from ffmpeg plus the numpy copy of them
+    decoded = 2 * 2 * samples * channels
+    frames = samples / (wsize * (1 - wratio))
+    specgram = frames * (wsize / 2 + 1) * SPECGRAM_BYTES_PER_CELL
+    # the hash set of all channels is kept, about one peak per frame
+    hashes = frames * fan_value * HASH_BYTES * channels
+    return decoded, int(specgram + hashes)
+
 def fingerprint(channel_samples, song_name=None, 
                 Fs=DEFAULT_FS,
                 wsize=DEFAULT_WINDOW_SIZE,
                 wratio=DEFAULT_OVERLAP_RATIO,
                 fan_value=DEFAULT_FAN_VALUE,
-                amp_min=DEFAULT_AMP_MIN):
+                amp_min=DEFAULT_AMP_MIN,
+                timer=None,
+                neighborhood_size=PEAK_NEIGHBORHOOD_SIZE,
+                min_time_delta=MIN_HASH_TIME_DELTA,
+                max_time_delta=MAX_HASH_TIME_DELTA,
+                peak_sort=PEAK_SORT,
+                reduction=FINGERPRINT_REDUCTION,
+                strength=False):
     """
     FFT the channel, log transform output, find local maxima, then return
     locally sensitive hashes.
+
+    The parameters default to the module constants, see `DEFAULT_PARAMS`.
+    With `strength` every hash comes with the amplitude of the weaker of its
+    two peaks, as (hash, offset, strength), see `select_hashes`.
+
+    With a `StageTimer` as `timer` the time of every step and the number of
+    peaks and hashes are recorded in it, and the hashes are returned as a
+    list instead of a generator so hashing is timed too.
     """
+    measured = timer is not None
+    timer = timer or NULL_TIMER
+
     # FFT the signal and extract frequency components
-    arr2D = mlab.specgram(
-        channel_samples,
-        NFFT=wsize,
-        Fs=Fs,
-        window=mlab.window_hanning,
-        noverlap=int(wsize * wratio))[0]
+    with timer.stage(STAGE_SPECGRAM):
+        arr2D = mlab.specgram(
+            channel_samples,
+            NFFT=wsize,
+            Fs=Fs,
+            window=mlab.window_hanning,
+            noverlap=int(wsize * wratio))[0]
+
+    with timer.stage(STAGE_SPECGRAM):
+        arr2D = log_specgram(arr2D, song_name=song_name)
+
+    # find local maxima
+    with timer.stage(STAGE_PEAKS):
+        local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min,
+                                    neighborhood_size=neighborhood_size,
+                                    with_amps=strength)
+    timer.count(COUNT_PEAKS, len(local_maxima))
+
+    # return hashes
+    hashes = generate_hashes(local_maxima, fan_value=fan_value,
+                             min_time_delta=min_time_delta,
+                             max_time_delta=max_time_delta,
+                             peak_sort=peak_sort, reduction=reduction,
+                             strength=strength)
+    if not measured:
+        return hashes
+    with timer.stage(STAGE_HASH):
+        hashes = list(hashes)
+    timer.count(COUNT_HASHES, len(hashes))
+    return hashes
 
+def fingerprint_from(channel_samples, offset, **kwargs):
+    """
+    Same as `fingerprint` with `kwargs`, but only returns the hashes at
+    `offset` (in spectrogram frames) or later and skips most of the audio
+    before it: a peak only depends on the frames within its neighborhood,
+    and is only paired with later peaks.
+    """
+    if offset <= 0:
+        return fingerprint(channel_samples, **kwargs)
+    wsize = kwargs.get("wsize", DEFAULT_WINDOW_SIZE)
+    hop = wsize - int(wsize * kwargs.get("wratio", DEFAULT_OVERLAP_RATIO))
+    first = max(offset - kwargs.get("neighborhood_size",
+                                    PEAK_NEIGHBORHOOD_SIZE) - 1, 0)
+    hashes = fingerprint(channel_samples[first * hop:], **kwargs)
+    return [(h, t + first) for h, t in hashes if t + first >= offset]
+
+def frames_specgram(frames, Fs=DEFAULT_FS):
+    """
+    Spectrogram of the windows held in the columns of `frames`, the same
+    values `mlab.specgram` gives for them. The columns may come from
+    several signals of one sampling rate, so many streams are transformed
+    in one call.
+    """
+    wsize = frames.shape[0]
+    window = mlab.window_hanning(np.ones(wsize))
+    spec = np.fft.fft(frames * window[:, np.newaxis], n=wsize,
+                      axis=0)[:wsize // 2 + 1, :]
+    spec = np.conj(spec) * spec
+    # one-sided density: every frequency but DC and Nyquist counts twice
+    spec[1:-1 if not wsize % 2 else None] *= 2.
+    spec /= Fs
+    spec /= (np.abs(window) ** 2).sum()
+    return spec.real
+
+def log_specgram(arr2D, song_name=None):
+    """
+    Log transform of a linear spectrogram, every cell on its own.
+    """
     with warnings.catch_warnings():
         warnings.filterwarnings('error')
         try:
@@ -91,20 +227,21 @@ def fingerprint(channel_samples, song_name=None,
                 arr2D[arr2D == 0] = 10**-10  # replace 0's with 10**-10
                 arr2D = 10 * np.log10(arr2D)
             except RuntimeWarning as e2:
-                print "Fingerprinting Error:", song_name, "has error", e2
+                logger.warning("Fingerprinting Error: %s has error %s",
+                               song_name, e2)
         finally:
             arr2D[arr2D == -np.inf] = 0  # replace infs with zeros
+    return arr2D
 
-    # find local maxima
-    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
-
-    # return hashes
-    return generate_hashes(local_maxima, fan_value=fan_value)
-
-def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
+def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN,
+                 neighborhood_size=PEAK_NEIGHBORHOOD_SIZE, with_amps=False):
+    """
+    Returns the (frequency, time) of the peaks of `arr2D`, with `with_amps`
+    (frequency, time, amplitude).
+    """
     # http://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.morphology.iterate_structure.html#scipy.ndimage.morphology.iterate_structure
     struct = generate_binary_structure(2, 1)
-    neighborhood = iterate_structure(struct, PEAK_NEIGHBORHOOD_SIZE)
+    neighborhood = iterate_structure(struct, neighborhood_size)
 
     # find local maxima using our fliter shape
     local_max = maximum_filter(arr2D, footprint=neighborhood) == arr2D
@@ -139,15 +276,25 @@ def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
         plt.gca().invert_yaxis()
         plt.show()
 
+    if with_amps:
+        return zip(frequency_idx, time_idx, [x[2] for x in peaks_filtered])
     return zip(frequency_idx, time_idx)
 
-def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
+def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE,
+                    min_time_delta=MIN_HASH_TIME_DELTA,
+                    max_time_delta=MAX_HASH_TIME_DELTA,
+                    peak_sort=PEAK_SORT,
+                    reduction=FINGERPRINT_REDUCTION,
+                    strength=False):
     """
     Hash list structure:
        sha1_hash[0:20]    time_offset
     [(e05b341a9b77a51fd26, 32), ... ]
+
+    With `strength` the peaks carry their amplitude and the amplitude of the
+    weaker peak of every pair is added to its hash.
     """
-    if PEAK_SORT:
+    if peak_sort:
         peaks.sort(key=itemgetter(1))
 
     for i in range(len(peaks)):
@@ -160,7 +307,188 @@ def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
                 t2 = peaks[i + j][IDX_TIME_J]
                 t_delta = t2 - t1
 
-                if t_delta >= MIN_HASH_TIME_DELTA and t_delta <= MAX_HASH_TIME_DELTA:
-                    h = hashlib.sha1(
-                        "%s|%s|%s" % (str(freq1), str(freq2), str(t_delta)))
-                    yield (h.hexdigest()[0:FINGERPRINT_REDUCTION], t1)
+                if t_delta >= min_time_delta and t_delta <= max_time_delta:
+                    h = peak_hash(freq1, freq2, t_delta, reduction)
+                    if strength:
+                        yield (h, t1, min(peaks[i][2], peaks[i + j][2]))
+                    else:
+                        yield (h, t1)
+
+def select_hashes(hashes, budget, common=None,
+                  slot_hashes=BUDGET_SLOT_HASHES):
+    """
+    Picks at most `budget` of the (hash, offset, strength) `hashes` of a
+    query and returns them as (hash, offset) pairs. Hashes in `common`
+    (upper case), which match too many songs to tell them apart, are left
+    out. The query is cut into slots of equal length, about `slot_hashes`
+    picks each, and every slot gives its strongest hash in turn, so the
+    picks are spread over the whole clip and favor the peaks most likely to
+    survive noise. `budget` None keeps every hash.
+    """
+    if common:
+        hashes = [h for h in hashes if h[0].upper() not in common]
+    if budget is None or len(hashes) <= budget:
+        return [(h, offset) for h, offset, _ in hashes]
+
+    first = min(h[1] for h in hashes)
+    span = max(h[1] for h in hashes) - first + 1
+    nslots = max(budget // slot_hashes, 1)
+    slots = {}
+    for h in hashes:
+        slots.setdefault((h[1] - first) * nslots // span, []).append(h)
+
+    ranked = []
+    for slot in slots.itervalues():
+        slot.sort(key=itemgetter(2), reverse=True)
+        ranked.extend((rank, -h[2], h) for rank, h in enumerate(slot))
+    ranked.sort(key=itemgetter(0, 1))
+    return [(h, offset) for _, _, (h, offset, _) in ranked[:budget]]
+
+def peak_hash(freq1, freq2, t_delta, reduction=FINGERPRINT_REDUCTION):
+    """
+    Hash of a pair of peaks `t_delta` frames apart.
+    """
+    h = hashlib.sha1("%s|%s|%s" % (str(freq1), str(freq2), str(t_delta)))
+    return h.hexdigest()[0:reduction]
+
+
+class StreamFingerprinter(object):
+    """
+    Fingerprints a channel fed a block of samples at a time, e.g. a
+    recording too long to hold in memory or live audio. Every spectrogram
+    frame is computed once and its peaks are found once, and the hashes are
+    the ones `fingerprint` gives for the whole stream at once, with their
+    offset counted in frames from the start of the stream. Peaks are always
+    paired in time order, as with `peak_sort`.
+
+    A hash is final once the frames its peaks depend on have been fed, so
+    hashes lag the audio by `neighborhood_size` plus up to `max_time_delta`
+    frames; `flush` returns the rest at the end of the stream.
+    """
+
+    def __init__(self, Fs=DEFAULT_FS,
+                 wsize=DEFAULT_WINDOW_SIZE,
+                 wratio=DEFAULT_OVERLAP_RATIO,
+                 fan_value=DEFAULT_FAN_VALUE,
+                 amp_min=DEFAULT_AMP_MIN,
+                 neighborhood_size=PEAK_NEIGHBORHOOD_SIZE,
+                 min_time_delta=MIN_HASH_TIME_DELTA,
+                 max_time_delta=MAX_HASH_TIME_DELTA,
+                 peak_sort=PEAK_SORT,
+                 reduction=FINGERPRINT_REDUCTION):
+        super(StreamFingerprinter, self).__init__()
+        self.Fs = Fs
+        self.wsize = wsize
+        self.noverlap = int(wsize * wratio)
+        # samples between the starts of two frames
+        self.hop = wsize - self.noverlap
+        self.fan_value = fan_value
+        self.amp_min = amp_min
+        self.neighborhood_size = neighborhood_size
+        self.min_time_delta = min_time_delta
+        self.max_time_delta = max_time_delta
+        self.reduction = reduction
+        # spectrogram frames computed so far
+        self.frames = 0
+        # every hash with an offset below this frame has been returned
+        self.hashed = 0
+        self._samples = np.zeros(0, dtype=np.int16)
+        # log spectrogram columns from frame `_spec_start` on, kept as the
+        # context of the peaks still to find
+        self._spec = None
+        self._spec_start = 0
+        # peaks of the frames below `_peaks_done` are known, the ones not
+        # hashed as the first of a pair yet are kept in time order
+        self._peaks_done = 0
+        self._peaks = []
+
+    def frame_seconds(self):
+        """
+        Seconds between the starts of two frames, the unit of hash offsets.
+        """
+        return float(self.hop) / self.Fs
+
+    def feed(self, samples):
+        """
+        Adds the next samples of the channel, returns the (hash, offset)
+        pairs that became final.
+        """
+        return self.add_specgram(frames_specgram(self.take_frames(samples),
+                                                 self.Fs))
+
+    def take_frames(self, samples):
+        """
+        Adds the next samples of the channel and returns the windows that
+        are complete, one per column, to be transformed by
+        `frames_specgram` and handed to `add_specgram`.
+        """
+        samples = np.concatenate((self._samples, samples))
+        nframes = 0
+        if len(samples) >= self.wsize:
+            nframes = (len(samples) - self.wsize) // self.hop + 1
+        index = (np.arange(self.wsize)[:, np.newaxis] +
+                 self.hop * np.arange(nframes)[np.newaxis, :])
+        frames = samples[index]
+        self._samples = samples[nframes * self.hop:]
+        return frames
+
+    def add_specgram(self, spec):
+        """
+        Adds the spectrogram of the windows `take_frames` returned, returns
+        the (hash, offset) pairs that became final.
+        """
+        if spec.shape[1]:
+            spec = log_specgram(spec)
+            if self._spec is None:
+                self._spec = spec
+            else:
+                self._spec = np.hstack((self._spec, spec))
+            self.frames += spec.shape[1]
+        return self._advance(final=False)
+
+    def flush(self):
+        """
+        Ends the stream, returns the remaining hashes.
+        """
+        return self._advance(final=True)
+
+    def _advance(self, final):
+        n = self.neighborhood_size
+        # a peak depends on the frames within its neighborhood
+        end = self.frames if final else self.frames - n
+        if end > self._peaks_done:
+            first = max(self._peaks_done - n, self._spec_start)
+            window = self._spec[:, first - self._spec_start:]
+            peaks = [(freq, t + first) for freq, t in
+                     get_2D_peaks(window, amp_min=self.amp_min,
+                                  neighborhood_size=n)
+                     if self._peaks_done <= t + first < end]
+            peaks.sort(key=lambda peak: (peak[IDX_TIME_J], peak[IDX_FREQ_I]))
+            self._peaks.extend(peaks)
+            self._peaks_done = end
+            keep = max(end - n, self._spec_start)
+            self._spec = self._spec[:, keep - self._spec_start:]
+            self._spec_start = keep
+
+        # a peak is paired with the next `fan_value - 1` peaks, which are
+        # known once enough peaks are or once they would be too far apart
+        peaks = self._peaks
+        hashes = []
+        i = 0
+        while i < len(peaks):
+            freq1, t1 = peaks[i]
+            if not (final or i + self.fan_value - 1 < len(peaks) or
+                    t1 + self.max_time_delta < self._peaks_done):
+                break
+            for j in range(1, self.fan_value):
+                if i + j >= len(peaks):
+                    break
+                freq2, t2 = peaks[i + j]
+                t_delta = t2 - t1
+                if self.min_time_delta <= t_delta <= self.max_time_delta:
+                    hashes.append((peak_hash(freq1, freq2, t_delta,
+                                             self.reduction), t1))
+            i += 1
+        del peaks[:i]
+        self.hashed = peaks[0][IDX_TIME_J] if peaks else self._peaks_done
+        return hashes
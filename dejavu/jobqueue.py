@@ -0,0 +1,635 @@
+""" Ingestion job queue shared by any number of dejavu processes and hosts.
+
+Files are enqueued once per catalog, then every process claims a few at a time with a
+lease it keeps renewing while they are fingerprinted. A process that dies
+stops renewing, its files are claimed again once their leases expire.
+
+The queue lives in a SQLite file for processes of a single host (SQLite
+locking is not reliable over NFS), or in a table of the dejavu database
+for processes spread over several hosts.
+"""
+from __future__ import absolute_import
+
+import abc
+import os
+import uuid
+import socket
+import logging
+import sqlite3
+import threading
+
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import izip_longest
+
+logger = logging.getLogger(__name__)
+
+# Seconds a claimed file stays owned without its lease being renewed.
+DEFAULT_LEASE = 300
+
+# Claims of a file before it is given up on, crashes included.
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Seconds between two claims of a worker waiting for files.
+DEFAULT_POLL = 10
+
+# job states
+STATE_PENDING = "pending"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+Job = namedtuple('Job', ('file_sha1', 'filename', 'catalog', 'attempts'))
+
+
+class LeaseLost(Exception):
+    """
+    A file was claimed again by another worker after its lease expired, its
+    result must not be stored.
+    """
+    pass
+
+
+def default_worker():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+class JobQueue(object):
+    """
+    Queue of files to fingerprint, keyed by file sha1 and catalog so a file
+    enqueued twice for a catalog, even under another path, is only
+    fingerprinted once into it. Jobs are identified by their
+    (file_sha1, catalog) key.
+
+    ```python
+    queue = SQLiteJobQueue("/var/lib/dejavu/jobs.sqlite")
+    queue.setup()
+    queue.enqueue([(filename, file_sha1)])
+    for job in queue.claim(10, lease=300):
+        ...
+        queue.complete((job.file_sha1, job.catalog))
+    ```
+
+    Leases are timed by the clock of the backend so hosts don't need
+    synchronized clocks.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    TABLENAME = "ingest_job"
+
+    FIELD_FILE_SHA1 = "file_sha1"
+    FIELD_FILENAME = "filename"
+    FIELD_CATALOG = "catalog"
+    FIELD_STATE = "state"
+    FIELD_OWNER = "owner"
+    FIELD_TOKEN = "claim_token"
+    FIELD_LEASE_EXPIRES = "lease_expires"
+    FIELD_ATTEMPTS = "attempts"
+    FIELD_ERROR = "error"
+
+    # Name of the database type whose table this queue uses, see
+    # `open_queue`. None for queues with their own storage.
+    type = None
+
+    # current time in seconds, as an SQL expression of the backend
+    NOW = None
+
+    def __init__(self, worker=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        super(JobQueue, self).__init__()
+        self.worker = worker or default_worker()
+        self.max_attempts = max_attempts
+
+    @abc.abstractmethod
+    def cursor(self):
+        """
+        Returns a context manager yielding a cursor with `%s` placeholders,
+        committing on exit.
+        """
+        pass
+
+    @abc.abstractmethod
+    def setup(self):
+        """
+        Creates the job table when missing.
+        """
+        pass
+
+    def enqueue(self, files, catalog=None):
+        """
+        Adds (filename, file_sha1) pairs to fingerprint into `catalog`.
+        Files already pending or running for `catalog` are left alone, done
+        or failed ones are queued again, e.g. after their song was deleted.
+        """
+        catalog = _catalog_param(catalog)
+        with self.cursor() as cur:
+            for split_values in grouper(files, 1000):
+                cur.executemany(self.REQUEUE_JOB, [
+                    (filename, file_sha1, catalog)
+                    for filename, file_sha1 in split_values])
+                cur.executemany(self.INSERT_JOB, [
+                    (file_sha1, filename, catalog, STATE_PENDING)
+                    for filename, file_sha1 in split_values])
+
+    def claim(self, n, lease=DEFAULT_LEASE):
+        """
+        Claims up to `n` pending files, or files whose lease expired, for
+        `lease` seconds. Returns them as `Job`s.
+        """
+        token = uuid.uuid4().hex
+        with self.cursor() as cur:
+            # files that keep losing their worker, e.g. by crashing it
+            cur.execute(self.FAIL_EXHAUSTED, (self.max_attempts,))
+            cur.execute(self.CLAIM_JOBS, (self.worker, token, lease,
+                                          self.max_attempts, n))
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_CLAIMED, (token,))
+            return [Job(file_sha1, filename, catalog or None, attempts)
+                    for file_sha1, filename, catalog, attempts in cur]
+
+    def renew(self, keys, lease=DEFAULT_LEASE):
+        """
+        Extends the lease of the jobs with the given keys for another
+        `lease` seconds. Returns the keys this worker still owns, the others
+        were claimed by someone else after their lease expired.
+        """
+        owned = set()
+        with self.cursor() as cur:
+            for split_values in grouper(keys, 500):
+                where, params = _keys_clause(split_values)
+                params = (self.worker,) + params
+                cur.execute(self.RENEW_LEASES % where, (lease,) + params)
+                cur.execute(self.SELECT_OWNED % where, params)
+                owned.update((file_sha1, catalog or None)
+                             for file_sha1, catalog in cur)
+        return owned
+
+    def complete(self, key):
+        """
+        Marks a job this worker owns as done. Returns False when the lease
+        was lost in the meantime.
+        """
+        file_sha1, catalog = key
+        with self.cursor() as cur:
+            cur.execute(self.COMPLETE_JOB, (file_sha1, _catalog_param(catalog),
+                                            self.worker))
+            return cur.rowcount == 1
+
+    def fail(self, key, error):
+        """
+        Gives a job back after a failed attempt, it is claimed again until
+        it has failed `max_attempts` times.
+        """
+        file_sha1, catalog = key
+        with self.cursor() as cur:
+            cur.execute(self.FAIL_JOB, (self.max_attempts, str(error)[:1000],
+                                        file_sha1, _catalog_param(catalog),
+                                        self.worker))
+            return cur.rowcount == 1
+
+    def release(self, keys):
+        """
+        Gives jobs back untouched, e.g. on shutdown, without counting an
+        attempt.
+        """
+        with self.cursor() as cur:
+            for split_values in grouper(keys, 500):
+                where, params = _keys_clause(split_values)
+                cur.execute(self.RELEASE_JOBS % where,
+                            (self.worker,) + params)
+
+    def retry_failed(self):
+        """
+        Makes the files that failed `max_attempts` times pending again.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.RETRY_FAILED)
+
+    def counts(self):
+        """
+        Returns the number of files in every state.
+        """
+        counts = dict.fromkeys((STATE_PENDING, STATE_RUNNING, STATE_DONE,
+                                STATE_FAILED), 0)
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_COUNTS)
+            for state, count in cur:
+                counts[state] = count
+        return counts
+
+    def _queries(self):
+        """
+        Returns the queries shared by all backends, filled in with the
+        backend's clock. Queries taking a list of keys get their condition
+        first, see `_keys_clause`, hence the `%%%%s` of their other
+        parameters.
+        """
+        fields = dict(
+            table=self.TABLENAME, sha1=self.FIELD_FILE_SHA1,
+            filename=self.FIELD_FILENAME, catalog=self.FIELD_CATALOG,
+            state=self.FIELD_STATE, owner=self.FIELD_OWNER,
+            token=self.FIELD_TOKEN, expires=self.FIELD_LEASE_EXPIRES,
+            attempts=self.FIELD_ATTEMPTS, error=self.FIELD_ERROR,
+            now=self.NOW, pending=STATE_PENDING, running=STATE_RUNNING,
+            done=STATE_DONE, failed=STATE_FAILED)
+        return dict((name, query % fields) for name, query in (
+            ("FAIL_EXHAUSTED", """
+                UPDATE %(table)s
+                SET %(state)s = '%(failed)s', %(owner)s = NULL,
+                    %(error)s = 'lease expired'
+                WHERE %(state)s = '%(running)s' AND %(expires)s < %(now)s
+                AND %(attempts)s >= %%s;
+            """),
+            ("REQUEUE_JOB", """
+                UPDATE %(table)s
+                SET %(state)s = '%(pending)s', %(filename)s = %%s,
+                    %(attempts)s = 0, %(error)s = NULL
+                WHERE %(sha1)s = %%s AND %(catalog)s = %%s
+                AND %(state)s IN ('%(done)s', '%(failed)s');
+            """),
+            ("SELECT_CLAIMED", """
+                SELECT %(sha1)s, %(filename)s, %(catalog)s, %(attempts)s
+                FROM %(table)s WHERE %(token)s = %%s;
+            """),
+            ("RENEW_LEASES", """
+                UPDATE %(table)s SET %(expires)s = %(now)s + %%%%s
+                WHERE %(state)s = '%(running)s' AND %(owner)s = %%%%s
+                AND (%%s);
+            """),
+            ("SELECT_OWNED", """
+                SELECT %(sha1)s, %(catalog)s FROM %(table)s
+                WHERE %(state)s = '%(running)s' AND %(owner)s = %%%%s
+                AND (%%s);
+            """),
+            ("COMPLETE_JOB", """
+                UPDATE %(table)s
+                SET %(state)s = '%(done)s', %(owner)s = NULL, %(error)s = NULL
+                WHERE %(sha1)s = %%s AND %(catalog)s = %%s
+                AND %(state)s = '%(running)s' AND %(owner)s = %%s;
+            """),
+            ("FAIL_JOB", """
+                UPDATE %(table)s
+                SET %(state)s = CASE WHEN %(attempts)s >= %%s
+                                THEN '%(failed)s' ELSE '%(pending)s' END,
+                    %(owner)s = NULL, %(error)s = %%s
+                WHERE %(sha1)s = %%s AND %(catalog)s = %%s
+                AND %(state)s = '%(running)s' AND %(owner)s = %%s;
+            """),
+            ("RELEASE_JOBS", """
+                UPDATE %(table)s
+                SET %(state)s = '%(pending)s', %(owner)s = NULL,
+                    %(attempts)s = %(attempts)s - 1
+                WHERE %(state)s = '%(running)s' AND %(owner)s = %%%%s
+                AND (%%s);
+            """),
+            ("RETRY_FAILED", """
+                UPDATE %(table)s
+                SET %(state)s = '%(pending)s', %(attempts)s = 0
+                WHERE %(state)s = '%(failed)s';
+            """),
+            ("SELECT_COUNTS", """
+                SELECT %(state)s, COUNT(*) FROM %(table)s GROUP BY %(state)s;
+            """)))
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Queue in a SQLite file, for the processes of one host.
+    """
+
+    NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+    CREATE_JOBS_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s text NOT NULL,
+            %s text NOT NULL,
+            %s text NOT NULL DEFAULT '',
+            %s text NOT NULL,
+            %s text,
+            %s text,
+            %s real,
+            %s integer NOT NULL DEFAULT 0,
+            %s text,
+            PRIMARY KEY (%s, %s)
+        );""" % (
+        JobQueue.TABLENAME, JobQueue.FIELD_FILE_SHA1, JobQueue.FIELD_FILENAME,
+        JobQueue.FIELD_CATALOG, JobQueue.FIELD_STATE, JobQueue.FIELD_OWNER,
+        JobQueue.FIELD_TOKEN, JobQueue.FIELD_LEASE_EXPIRES,
+        JobQueue.FIELD_ATTEMPTS, JobQueue.FIELD_ERROR,
+        JobQueue.FIELD_FILE_SHA1, JobQueue.FIELD_CATALOG)
+
+    CREATE_STATE_INDEX = """
+        CREATE INDEX IF NOT EXISTS %s_%s_index ON %s (%s, %s);
+    """ % (JobQueue.TABLENAME, JobQueue.FIELD_STATE, JobQueue.TABLENAME,
+           JobQueue.FIELD_STATE, JobQueue.FIELD_LEASE_EXPIRES)
+
+    CREATE_TOKEN_INDEX = """
+        CREATE INDEX IF NOT EXISTS %s_%s_index ON %s (%s);
+    """ % (JobQueue.TABLENAME, JobQueue.FIELD_TOKEN, JobQueue.TABLENAME,
+           JobQueue.FIELD_TOKEN)
+
+    INSERT_JOB = """
+        INSERT OR IGNORE INTO %s (%s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s);
+    """ % (JobQueue.TABLENAME, JobQueue.FIELD_FILE_SHA1,
+           JobQueue.FIELD_FILENAME, JobQueue.FIELD_CATALOG,
+           JobQueue.FIELD_STATE)
+
+    # writers are serialized by SQLite, the subquery can't race
+    CLAIM_JOBS = """
+        UPDATE %s
+        SET %s = '%s', %s = %%s, %s = %%s, %s = %s + %%s, %s = %s + 1
+        WHERE rowid IN (
+            SELECT rowid FROM %s
+            WHERE %s = '%s' OR (%s = '%s' AND %s < %s AND %s < %%s)
+            LIMIT %%s);
+    """ % (JobQueue.TABLENAME,
+           JobQueue.FIELD_STATE, STATE_RUNNING, JobQueue.FIELD_OWNER,
+           JobQueue.FIELD_TOKEN, JobQueue.FIELD_LEASE_EXPIRES, NOW,
+           JobQueue.FIELD_ATTEMPTS, JobQueue.FIELD_ATTEMPTS,
+           JobQueue.TABLENAME, JobQueue.FIELD_STATE, STATE_PENDING,
+           JobQueue.FIELD_STATE, STATE_RUNNING, JobQueue.FIELD_LEASE_EXPIRES,
+           NOW, JobQueue.FIELD_ATTEMPTS)
+
+    def __init__(self, path, **options):
+        super(SQLiteJobQueue, self).__init__(**options)
+        self.path = path
+        self.__dict__.update(self._queries())
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+
+    @contextmanager
+    def cursor(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=60)
+            # filenames are byte strings like everywhere else
+            conn.text_factory = str
+        try:
+            yield _QmarkCursor(conn.cursor())
+        except Exception:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    def setup(self):
+        with self.cursor() as cur:
+            # readers don't block the writer
+            cur.execute("PRAGMA journal_mode=WAL;")
+            cur.execute(self.CREATE_JOBS_TABLE)
+            cur.execute(self.CREATE_STATE_INDEX)
+            cur.execute(self.CREATE_TOKEN_INDEX)
+
+    def __getstate__(self):
+        return (self.path, self.worker, self.max_attempts)
+
+    def __setstate__(self, state):
+        path, worker, max_attempts = state
+        self.__init__(path, worker=worker, max_attempts=max_attempts)
+
+
+class _QmarkCursor(object):
+    """
+    sqlite3 cursor taking the `%s` placeholders of the other backends.
+    """
+
+    def __init__(self, cursor):
+        super(_QmarkCursor, self).__init__()
+        self._cursor = cursor
+
+    def execute(self, query, params=()):
+        return self._cursor.execute(query.replace("%s", "?"), params)
+
+    def executemany(self, query, rows):
+        return self._cursor.executemany(query.replace("%s", "?"), rows)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _DatabaseJobQueue(JobQueue):
+    """
+    Queue in a table of the dejavu database, for processes on any number of
+    hosts.
+    """
+
+    def __init__(self, db, **options):
+        super(_DatabaseJobQueue, self).__init__(**options)
+        self.db = db
+        self.__dict__.update(self._queries())
+
+    def cursor(self):
+        return self.db.cursor()
+
+    def setup(self):
+        with self.cursor() as cur:
+            for query in self.CREATE_JOBS_TABLE:
+                cur.execute(query)
+
+
+class MySQLJobQueue(_DatabaseJobQueue):
+
+    type = "mysql"
+
+    NOW = "UNIX_TIMESTAMP()"
+
+    CREATE_JOBS_TABLE = ("""
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` char(40) not null,
+            `%s` varchar(1024) not null,
+            `%s` varchar(64) not null default '',
+            `%s` varchar(8) not null,
+            `%s` varchar(128) default null,
+            `%s` char(32) default null,
+            `%s` double default null,
+            `%s` int unsigned not null default 0,
+            `%s` text,
+        PRIMARY KEY (`%s`, `%s`),
+        INDEX (`%s`, `%s`),
+        INDEX (`%s`)
+    ) ENGINE=INNODB;""" % (
+        JobQueue.TABLENAME, JobQueue.FIELD_FILE_SHA1, JobQueue.FIELD_FILENAME,
+        JobQueue.FIELD_CATALOG, JobQueue.FIELD_STATE, JobQueue.FIELD_OWNER,
+        JobQueue.FIELD_TOKEN, JobQueue.FIELD_LEASE_EXPIRES,
+        JobQueue.FIELD_ATTEMPTS, JobQueue.FIELD_ERROR,
+        JobQueue.FIELD_FILE_SHA1, JobQueue.FIELD_CATALOG, JobQueue.FIELD_STATE,
+        JobQueue.FIELD_LEASE_EXPIRES, JobQueue.FIELD_TOKEN),)
+
+    INSERT_JOB = """
+        INSERT IGNORE INTO %s (%s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s);
+    """ % (JobQueue.TABLENAME, JobQueue.FIELD_FILE_SHA1,
+           JobQueue.FIELD_FILENAME, JobQueue.FIELD_CATALOG,
+           JobQueue.FIELD_STATE)
+
+    # a single statement, rows are locked while updated so two workers
+    # never claim the same file
+    CLAIM_JOBS = """
+        UPDATE %s
+        SET %s = '%s', %s = %%s, %s = %%s, %s = %s + %%s, %s = %s + 1
+        WHERE %s = '%s' OR (%s = '%s' AND %s < %s AND %s < %%s)
+        LIMIT %%s;
+    """ % (JobQueue.TABLENAME,
+           JobQueue.FIELD_STATE, STATE_RUNNING, JobQueue.FIELD_OWNER,
+           JobQueue.FIELD_TOKEN, JobQueue.FIELD_LEASE_EXPIRES, NOW,
+           JobQueue.FIELD_ATTEMPTS, JobQueue.FIELD_ATTEMPTS,
+           JobQueue.FIELD_STATE, STATE_PENDING, JobQueue.FIELD_STATE,
+           STATE_RUNNING, JobQueue.FIELD_LEASE_EXPIRES, NOW,
+           JobQueue.FIELD_ATTEMPTS)
+
+
+class PostgresJobQueue(_DatabaseJobQueue):
+
+    type = "postgresql"
+
+    NOW = "extract(epoch from clock_timestamp())"
+
+    CREATE_JOBS_TABLE = ("""
+        CREATE TABLE IF NOT EXISTS %s (
+            %s char(40) NOT NULL,
+            %s varchar(1024) NOT NULL,
+            %s varchar(64) NOT NULL DEFAULT '',
+            %s varchar(8) NOT NULL,
+            %s varchar(128),
+            %s char(32),
+            %s double precision,
+            %s integer NOT NULL DEFAULT 0,
+            %s text,
+            PRIMARY KEY (%s, %s)
+        );""" % (
+        JobQueue.TABLENAME, JobQueue.FIELD_FILE_SHA1, JobQueue.FIELD_FILENAME,
+        JobQueue.FIELD_CATALOG, JobQueue.FIELD_STATE, JobQueue.FIELD_OWNER,
+        JobQueue.FIELD_TOKEN, JobQueue.FIELD_LEASE_EXPIRES,
+        JobQueue.FIELD_ATTEMPTS, JobQueue.FIELD_ERROR,
+        JobQueue.FIELD_FILE_SHA1, JobQueue.FIELD_CATALOG), """
+        CREATE INDEX IF NOT EXISTS %s_%s_index ON %s (%s, %s);
+        """ % (JobQueue.TABLENAME, JobQueue.FIELD_STATE, JobQueue.TABLENAME,
+               JobQueue.FIELD_STATE, JobQueue.FIELD_LEASE_EXPIRES), """
+        CREATE INDEX IF NOT EXISTS %s_%s_index ON %s (%s);
+        """ % (JobQueue.TABLENAME, JobQueue.FIELD_TOKEN, JobQueue.TABLENAME,
+               JobQueue.FIELD_TOKEN))
+
+    INSERT_JOB = """
+        INSERT INTO %s (%s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s)
+        ON CONFLICT DO NOTHING;
+    """ % (JobQueue.TABLENAME, JobQueue.FIELD_FILE_SHA1,
+           JobQueue.FIELD_FILENAME, JobQueue.FIELD_CATALOG,
+           JobQueue.FIELD_STATE)
+
+    # rows locked by a concurrent claim are skipped instead of waited for
+    CLAIM_JOBS = """
+        UPDATE %s
+        SET %s = '%s', %s = %%s, %s = %%s, %s = %s + %%s, %s = %s + 1
+        WHERE (%s, %s) IN (
+            SELECT %s, %s FROM %s
+            WHERE %s = '%s' OR (%s = '%s' AND %s < %s AND %s < %%s)
+            LIMIT %%s FOR UPDATE SKIP LOCKED);
+    """ % (JobQueue.TABLENAME,
+           JobQueue.FIELD_STATE, STATE_RUNNING, JobQueue.FIELD_OWNER,
+           JobQueue.FIELD_TOKEN, JobQueue.FIELD_LEASE_EXPIRES, NOW,
+           JobQueue.FIELD_ATTEMPTS, JobQueue.FIELD_ATTEMPTS,
+           JobQueue.FIELD_FILE_SHA1, JobQueue.FIELD_CATALOG,
+           JobQueue.FIELD_FILE_SHA1, JobQueue.FIELD_CATALOG,
+           JobQueue.TABLENAME, JobQueue.FIELD_STATE, STATE_PENDING,
+           JobQueue.FIELD_STATE, STATE_RUNNING, JobQueue.FIELD_LEASE_EXPIRES,
+           NOW, JobQueue.FIELD_ATTEMPTS)
+
+
+class LeaseKeeper(object):
+    """
+    Renews the leases of the files a worker holds from a background thread,
+    every third of the lease.
+
+    ```python
+    keeper = LeaseKeeper(queue, lease=300)
+    keeper.hold(keys)
+    ...
+    keeper.drop(key)
+    keeper.stop()
+    ```
+    """
+
+    def __init__(self, queue, lease=DEFAULT_LEASE):
+        super(LeaseKeeper, self).__init__()
+        self.queue = queue
+        self.lease = lease
+        self.held = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def hold(self, keys):
+        with self._lock:
+            self.held.update(keys)
+
+    def drop(self, key):
+        with self._lock:
+            self.held.discard(key)
+
+    def _run(self):
+        while not self._stopped.wait(self.lease / 3.0):
+            with self._lock:
+                held = list(self.held)
+            if not held:
+                continue
+            try:
+                owned = self.queue.renew(held, self.lease)
+            except Exception:
+                # the next renewal may get through before the leases expire
+                logger.exception("Cannot renew %d leases", len(held))
+                continue
+            for file_sha1, catalog in set(held) - owned:
+                logger.warning("Lost the lease of %s (catalog %s)", file_sha1,
+                               catalog)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+def open_queue(options, db=None):
+    """
+    Returns the job queue described by the `queue` configuration option,
+    set up: `{"path": ...}` for a SQLite file, otherwise a table in `db`.
+    """
+    kwargs = dict(worker=options.get("worker"),
+                  max_attempts=options.get("max_attempts",
+                                           DEFAULT_MAX_ATTEMPTS))
+    if options.get("path"):
+        queue = SQLiteJobQueue(options["path"], **kwargs)
+    else:
+        for queue_cls in _DatabaseJobQueue.__subclasses__():
+            if db is not None and queue_cls.type == db.type:
+                queue = queue_cls(db, **kwargs)
+                break
+        else:
+            raise TypeError("No job queue for the database type %s, set a "
+                            "queue path" % getattr(db, "type", None))
+    queue.setup()
+    return queue
+
+
+def _catalog_param(catalog):
+    # NULL can't be part of a primary key, no catalog is stored as ''
+    return catalog or ""
+
+
+def _keys_clause(keys):
+    """
+    Returns the condition matching the jobs of the (file_sha1, catalog)
+    `keys` and its parameters.
+    """
+    where = " OR ".join(["(%s = %%s AND %s = %%s)" % (
+        JobQueue.FIELD_FILE_SHA1, JobQueue.FIELD_CATALOG)] * len(keys))
+    params = tuple(value for file_sha1, catalog in keys
+                   for value in (file_sha1, _catalog_param(catalog)))
+    return where, params
+
+
+def grouper(iterable, n, fillvalue=None):
+    args = [iter(iterable)] * n
+    return (filter(None, values) for values
+            in izip_longest(fillvalue=fillvalue, *args))
@@ -0,0 +1,437 @@
+""" Process wide metrics, exported in the Prometheus text format.
+
+Metrics are always collected, exporting them is enabled with the `metrics`
+configuration option: over HTTP on a local port, or written to a file for
+node_exporter's textfile collector.
+"""
+import os
+import math
+import time
+import socket
+import logging
+import tempfile
+import threading
+import BaseHTTPServer
+
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Default upper bounds of latency histograms, in seconds.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0, 60.0)
+
+# Quantiles reported by summaries, over their last `SUMMARY_WINDOW`
+# observations.
+SUMMARY_QUANTILES = (0.5, 0.9, 0.99)
+SUMMARY_WINDOW = 1024
+
+# Seconds between two writes of the metrics file.
+DEFAULT_FILE_INTERVAL = 15
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Registry(object):
+    """
+    Set of metrics exported together.
+    """
+
+    def __init__(self):
+        super(Registry, self).__init__()
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    """
+    Base of all metrics. Metrics with `labelnames` hold one child per
+    combination of label values, see `labels`.
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        super(_Metric, self).__init__()
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # exported as zero before the first observation
+            self.labels()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError("%s needs the labels %s"
+                             % (self.name, ", ".join(self.labelnames)))
+        return self.labels()
+
+    def samples(self):
+        with self._lock:
+            children = sorted(self._children.items())
+        lines = []
+        for key, child in children:
+            labels = zip(self.labelnames, key)
+            lines.extend(child.samples(self.name, labels))
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS,
+                 registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _Histogram(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+
+class Summary(_Metric):
+    """
+    Count and sum of observations plus quantiles over the most recent
+    `window` of them, e.g. recent latency percentiles.
+    """
+    type = "summary"
+
+    def __init__(self, name, help, labelnames=(), quantiles=SUMMARY_QUANTILES,
+                 window=SUMMARY_WINDOW, registry=REGISTRY):
+        self.quantiles = quantiles
+        self.window = window
+        super(Summary, self).__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _Summary(self.quantiles, self.window)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+
+class _Value(object):
+
+    def __init__(self):
+        super(_Value, self).__init__()
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = float(value)
+
+    def samples(self, name, labels):
+        return [_sample(name, labels, self.value)]
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        super(_Histogram, self).__init__()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(_sample(name + "_bucket", labels + [("le", bound)],
+                                 cumulative))
+        lines.append(_sample(name + "_bucket", labels + [("le", "+Inf")],
+                             count))
+        lines.append(_sample(name + "_sum", labels, total))
+        lines.append(_sample(name + "_count", labels, count))
+        return lines
+
+
+class _Summary(object):
+
+    def __init__(self, quantiles, window):
+        super(_Summary, self).__init__()
+        self.quantiles = quantiles
+        self.recent = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.recent.append(value)
+            self.count += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self._lock:
+            recent, count, total = sorted(self.recent), self.count, self.sum
+        lines = []
+        for q in self.quantiles:
+            if recent:
+                # nearest rank
+                value = recent[max(int(math.ceil(q * len(recent))) - 1, 0)]
+            else:
+                value = float("nan")
+            lines.append(_sample(name, labels + [("quantile", q)], value))
+        lines.append(_sample(name + "_sum", labels, total))
+        lines.append(_sample(name + "_count", labels, count))
+        return lines
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += "{%s}" % ",".join('%s="%s"' % (label, _escape(label_value))
+                                  for label, label_value in labels)
+    return "%s %s" % (name, _format(value))
+
+
+def _escape(value):
+    if isinstance(value, float):
+        value = _format(value)
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def _format(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+class Timer(object):
+    """
+    Context manager observing the seconds its block took in a histogram or
+    summary.
+
+    ```python
+    with Timer(DB_INSERT_SECONDS):
+        db.insert_hashes(sid, hashes)
+    ```
+    """
+
+    def __init__(self, metric):
+        super(Timer, self).__init__()
+        self.metric = metric
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        self.metric.observe(time.time() - self.started)
+
+
+# ingestion
+SONGS_INGESTED = Counter(
+    "dejavu_songs_ingested_total",
+    "Files processed by fingerprint_directory and fingerprint_file.",
+    ("result",))
+SONG_HASHES = Histogram(
+    "dejavu_song_hashes", "Hashes stored per fingerprinted song.",
+    buckets=(100, 1000, 5000, 10000, 50000, 100000, 500000, 1000000))
+INGEST_STAGE_SECONDS = Histogram(
+    "dejavu_ingest_stage_seconds",
+    "Seconds spent per song in every ingestion stage.", ("stage",))
+INGEST_WORKERS = Gauge(
+    "dejavu_ingest_workers", "Worker processes of the ingestion pool.")
+INGEST_WORKERS_BUSY = Gauge(
+    "dejavu_ingest_workers_busy", "Ingestion workers processing a file.")
+INGEST_FILES_WAITING = Gauge(
+    "dejavu_ingest_files_waiting",
+    "Files of the current run not handed to a worker yet.")
+
+# database
+DB_INSERT_SECONDS = Histogram(
+    "dejavu_db_insert_seconds",
+    "Seconds taken to store a song and its hashes.")
+DB_QUERY_SECONDS = Histogram(
+    "dejavu_db_query_seconds",
+    "Seconds taken by a single hash lookup round trip.")
+DB_QUERY_ROWS = Histogram(
+    "dejavu_db_query_rows", "Rows returned by a single hash lookup.",
+    buckets=(0, 10, 100, 1000, 10000, 100000, 1000000))
+
+# recognition
+ALIGN_SECONDS = Histogram(
+    "dejavu_align_seconds", "Seconds spent aligning the matches of a query.")
+CACHE_REQUESTS = Counter(
+    "dejavu_cache_requests_total", "Result cache lookups.", ("result",))
+RECOGNITIONS = Counter(
+    "dejavu_recognitions_total", "Recognition requests.", ("result",))
+RECOGNITION_SECONDS = Summary(
+    "dejavu_recognition_seconds",
+    "Seconds taken by a recognition request, decoding included.")
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.registry.expose()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics request: " + format, *args)
+
+
+def start_http_server(port, addr="127.0.0.1", registry=REGISTRY):
+    """
+    Serves the metrics of `registry` on http://addr:port/ from a daemon
+    thread. Returns the server, None when the port is already taken, e.g.
+    by another `Dejavu` instance of this process.
+    """
+    try:
+        server = BaseHTTPServer.HTTPServer((addr, port), _Handler)
+    except socket.error as err:
+        logger.warning("Cannot serve metrics on %s:%s: %s", addr, port, err)
+        return None
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on http://%s:%d/", addr, port)
+    return server
+
+
+def write_to_file(path, registry=REGISTRY):
+    """
+    Writes the metrics of `registry` to `path`, atomically so readers never
+    see a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+    with os.fdopen(fd, "w") as f:
+        f.write(registry.expose())
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
+
+
+class FileExporter(object):
+    """
+    Writes the metrics to `path` every `interval` seconds from a daemon
+    thread, and once more on `close`.
+    """
+
+    def __init__(self, path, interval=DEFAULT_FILE_INTERVAL,
+                 registry=REGISTRY):
+        super(FileExporter, self).__init__()
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            write_to_file(self.path, self.registry)
+        except (IOError, OSError) as err:
+            logger.warning("Cannot write metrics to %s: %s", self.path, err)
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self.write()
+
+
+def start_exporter(options):
+    """
+    Starts the exporter described by the `metrics` configuration option,
+    `{"port": 9100}` (and optionally "addr") or `{"file": path}` (and
+    optionally "interval"). Returns it, or None.
+    """
+    if not options:
+        return None
+    if "file" in options:
+        return FileExporter(options["file"],
+                            options.get("interval", DEFAULT_FILE_INTERVAL))
+    if "port" in options:
+        return start_http_server(options["port"],
+                                 options.get("addr", "127.0.0.1"))
+    raise ValueError("metrics needs a port or a file")
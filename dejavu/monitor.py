@@ -0,0 +1,195 @@
+""" Monitoring of many live streams in one process.
+"""
+import time
+import Queue
+import logging
+import threading
+
+from collections import namedtuple
+
+import numpy as np
+
+import dejavu.decoder as decoder
+import dejavu.fingerprint as fingerprint
+import dejavu.stream as stream
+
+logger = logging.getLogger(__name__)
+
+# Seconds `Monitor.events` waits for more audio once a chunk arrived, so the
+# chunks of streams read at the same pace are fingerprinted and looked up
+# together.
+DEFAULT_GATHER = 0.5
+
+# Chunks a watched stream may read ahead of the monitor, bounds memory when
+# recognition falls behind.
+DEFAULT_BACKLOG = 8
+
+# A window of stream `stream` a song was recognized in, `match` is its
+# `stream.WindowMatch`.
+MonitorEvent = namedtuple('MonitorEvent', ('stream', 'match'))
+
+
+class Monitor(object):
+    """
+    Recognizes many live streams, e.g. radio stations, in one process. Every
+    stream has a `stream.SlidingMatcher`, but the work is batched across
+    streams: the new spectrogram windows of all of them are transformed in
+    one `fingerprint.frames_specgram` call and the hashes of the hops due in
+    all of them are looked up together with `Dejavu.lookup_hashes`, then the
+    matches are handed back to their streams.
+
+    Audio is either pushed with `feed`, or read from sources added with
+    `watch` and handled by `events`.
+    """
+
+    def __init__(self, dejavu, hop=stream.DEFAULT_HOP,
+                 window=stream.DEFAULT_WINDOW,
+                 min_confidence=stream.DEFAULT_MIN_CONFIDENCE,
+                 margin=stream.DEFAULT_MARGIN, catalog=None,
+                 gather=DEFAULT_GATHER, backlog=DEFAULT_BACKLOG):
+        super(Monitor, self).__init__()
+        self.dejavu = dejavu
+        self.hop = hop
+        self.window = window
+        self.min_confidence = min_confidence
+        self.margin = margin
+        self.catalog = catalog
+        self.gather = gather
+        self.backlog = backlog
+        self.matchers = {}  # stream name => SlidingMatcher
+        self._queue = Queue.Queue()
+        self._slots = {}  # watched stream name => semaphore of its backlog
+
+    def add_stream(self, name, samplerate=fingerprint.DEFAULT_FS, channels=1):
+        """
+        Starts monitoring stream `name`, whose audio is passed to `feed`.
+        """
+        if name in self.matchers:
+            raise ValueError("Stream %s is already monitored" % name)
+        self.dejavu.maybe_refresh_fingerprint_version()
+        self.matchers[name] = stream.SlidingMatcher(
+            self.dejavu, samplerate, channels, window=self.window,
+            hop=self.hop, min_confidence=self.min_confidence,
+            margin=self.margin, catalog=self.catalog)
+
+    def remove_stream(self, name):
+        """
+        Ends stream `name`, returns the events of its remaining windows.
+        """
+        return self._events(name, self.matchers.pop(name).flush())
+
+    def feed(self, chunks):
+        """
+        Adds the next samples of several streams, `chunks` maps the name of
+        a stream to the samples of each of its channels. Returns the
+        `MonitorEvent`s of the windows recognized.
+        """
+        # one transform per sampling rate for every channel of every stream
+        pending = {}  # Fs => [(fingerprinter, matcher, frames)]
+        for name, channels in chunks.iteritems():
+            matcher = self.matchers[name]
+            for fingerprinter, samples in zip(matcher.fingerprinters,
+                                              channels):
+                pending.setdefault(fingerprinter.Fs, []).append(
+                    (fingerprinter, matcher, fingerprinter.take_frames(samples)))
+        for Fs, items in pending.iteritems():
+            spec = fingerprint.frames_specgram(
+                np.hstack([frames for _, _, frames in items]), Fs)
+            start = 0
+            for fingerprinter, matcher, frames in items:
+                end = start + frames.shape[1]
+                matcher.collect(fingerprinter.add_specgram(spec[:, start:end]))
+                start = end
+
+        # one lookup for the hops due in every stream
+        taken = [(name, self.matchers[name].take_hops()) for name in chunks]
+        hashes = set(h.upper() for _, hops in taken
+                     for _, hop_hashes in hops for h, _ in hop_hashes)
+        rows = self.dejavu.lookup_hashes(hashes, catalog=self.catalog) \
+            if hashes else {}
+
+        events = []
+        for name, hops in taken:
+            hop_matches = [
+                (hop, [(sid, offset - t) for h, t in hop_hashes
+                       for sid, offset in rows.get(h.upper(), ())])
+                for hop, hop_hashes in hops]
+            events.extend(self._events(
+                name, self.matchers[name].add_matches(hop_matches)))
+        return events
+
+    def _events(self, name, windows):
+        return [MonitorEvent(name, match) for match in windows
+                if match.song_id is not None]
+
+    def watch(self, name, source, samplerate=fingerprint.DEFAULT_FS,
+              channels=1, file_format=None):
+        """
+        Monitors stream `name` read from `source` by a thread, see
+        `decoder.read_stream` for the arguments. Its events are returned by
+        `events`.
+        """
+        self.add_stream(name, samplerate, channels)
+        slots = threading.BoundedSemaphore(self.backlog)
+        self._slots[name] = slots
+        reader = threading.Thread(
+            target=self._read,
+            args=(name, source, samplerate, channels, file_format, slots))
+        reader.daemon = True
+        reader.start()
+
+    def _read(self, name, source, samplerate, channels, file_format, slots):
+        try:
+            for samples, _ in decoder.read_stream(
+                    source, samplerate, channels, seconds=self.hop,
+                    file_format=file_format):
+                slots.acquire()
+                self._queue.put((name, samples))
+        except Exception:
+            logger.exception("Reading stream %s failed", name)
+        finally:
+            # tells `events` the stream ended
+            self._queue.put((name, None))
+
+    def events(self):
+        """
+        Yields the `MonitorEvent`s of the watched streams as their windows
+        are recognized, until every watched stream ended.
+        """
+        while self._slots:
+            chunks, ended = {}, []
+            item = self._queue.get()
+            deadline = time.time() + self.gather
+            # bounded even when the sources are read faster than real time
+            limit = len(self._slots) * self.backlog
+            while item is not None:
+                name, samples = item
+                if samples is None:
+                    ended.append(name)
+                else:
+                    self._slots[name].release()
+                    if name in chunks:
+                        samples = [np.concatenate((a, b)) for a, b
+                                   in zip(chunks[name], samples)]
+                    chunks[name] = samples
+                limit -= 1
+                item = self._next(deadline) if limit > 0 else None
+
+            for event in self.feed(chunks):
+                yield event
+            for name in ended:
+                del self._slots[name]
+                for event in self.remove_stream(name):
+                    yield event
+
+    def _next(self, deadline):
+        """
+        Returns the next item of the queue, None once `deadline` passed.
+        """
+        remaining = deadline - time.time()
+        try:
+            if remaining <= 0:
+                return self._queue.get_nowait()
+            return self._queue.get(timeout=remaining)
+        except Queue.Empty:
+            return None
@@ -0,0 +1,227 @@
+""" Profiling of a whole run, parent and ingestion workers included.
+
+Every process profiled writes its own files into a shared directory,
+`merge_profiles` combines them into:
+
+* `<output>.pstats`: cProfile statistics, for `pstats`/snakeviz.
+* `<output>.collapsed`: sampled stacks, one `frame;frame;... count` line
+  each, for flamegraph.pl or speedscope.
+* `<output>.memory.txt`: memory per stage, with `memory` enabled.
+"""
+import os
+import sys
+import glob
+import time
+import pstats
+import cPickle
+import cProfile
+import threading
+
+from collections import Counter
+
+import dejavu.timing as timing
+from dejavu.scheduler import process_rss
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 only has it with a patched interpreter, stages are measured
+    # by resident memory instead
+    tracemalloc = None
+
+# Seconds between two stack samples.
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Allocation sites listed in the memory report when tracemalloc is there.
+TOP_ALLOCATIONS = 25
+
+
+class Profiler(object):
+    """
+    Profiles the current process: cProfile for call statistics, of the
+    calling thread and of the threads started while running, a thread
+    sampling the stacks of every thread for flame graphs and, when `memory`
+    is set, the memory every `StageTimer` stage allocates.
+
+    ```python
+    profiler = Profiler(memory=True)
+    profiler.start()
+    ...
+    profiler.stop()
+    profiler.save(directory, "main")
+    ```
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL, memory=False):
+        super(Profiler, self).__init__()
+        self.interval = interval
+        self.memory = memory
+        self.stacks = Counter()
+        self.stages = {}  # name => [calls, bytes allocated, peak bytes]
+        self._profile = cProfile.Profile()
+        # profiles of the threads started while running, cProfile only
+        # sees the thread that enables it
+        self._thread_profiles = []
+        self._running = False
+        self._sampler = None
+        # memory at the start of the stages open in every thread
+        self._local = threading.local()
+
+    def start(self):
+        self._running = True
+        self._sampler = threading.Thread(target=self._sample)
+        self._sampler.daemon = True
+        self._sampler.start()
+        if self.memory:
+            if tracemalloc is not None:
+                tracemalloc.start()
+            timing.set_stage_hook(self)
+        threading.setprofile(self._profile_thread)
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        threading.setprofile(None)
+        self._running = False
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+        if self.memory:
+            timing.set_stage_hook(None)
+
+    def save(self, directory, name):
+        """
+        Writes what was collected so far to `directory`, as files starting
+        with `name`. Can be called while running, e.g. by workers after
+        every task since they may be replaced at any time.
+        """
+        prefix = os.path.join(directory, name)
+        # collecting the statistics of a profile disables it in this thread
+        running = self._running
+        stats = None
+        for profile in list(self._thread_profiles) + [self._profile]:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if running:
+            self._profile.enable()
+        if stats is not None:
+            stats.dump_stats(prefix + ".prof")
+
+        memory = {"stages": dict(self.stages), "allocations": None}
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            stats = tracemalloc.take_snapshot().statistics("lineno")
+            memory["allocations"] = [
+                (str(stat.traceback), stat.size, stat.count)
+                for stat in stats[:TOP_ALLOCATIONS]]
+        with open(prefix + ".samples", "wb") as f:
+            cPickle.dump((dict(self.stacks), memory), f,
+                         cPickle.HIGHEST_PROTOCOL)
+
+    def _profile_thread(self, frame, event, arg):
+        # `threading` hook, called first thing in every new thread: gives
+        # the thread a profile of its own, which replaces the hook
+        profile = cProfile.Profile()
+        self._thread_profiles.append(profile)
+        profile.enable()
+
+    # `dejavu.timing` stage hook
+
+    def enter(self, name):
+        if not hasattr(self._local, "open"):
+            self._local.open = []
+        self._local.open.append(_memory_usage())
+
+    def exit(self, name):
+        before, _ = self._local.open.pop()
+        after, peak = _memory_usage()
+        stage = self.stages.setdefault(name, [0, 0, 0])
+        stage[0] += 1
+        stage[1] += max(after - before, 0)
+        stage[2] = max(stage[2], peak - before)
+
+    def _sample(self):
+        own = threading.current_thread().ident
+        while self._running:
+            for ident, frame in sys._current_frames().iteritems():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+            time.sleep(self.interval)
+
+
+def _memory_usage():
+    """
+    Returns (current, peak) bytes: traced by tracemalloc when it runs, the
+    resident set size (which has no peak to offer) otherwise.
+    """
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()
+    rss = process_rss(os.getpid()) or 0
+    return rss, rss
+
+
+def merge_profiles(directory, output):
+    """
+    Combines the files every profiled process saved in `directory` and
+    writes the `<output>.*` reports. Returns the merged `pstats.Stats`.
+    """
+    stats = None
+    stacks = Counter()
+    stages = {}
+    allocations = Counter()
+    for profile in sorted(glob.glob(os.path.join(directory, "*.prof"))):
+        name = os.path.splitext(profile)[0]
+        if stats is None:
+            stats = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+
+        with open(name + ".samples", "rb") as f:
+            process_stacks, memory = cPickle.load(f)
+        # the first frame tells the parent and the workers apart
+        process = os.path.basename(name).split("-")[0]
+        for stack, count in process_stacks.iteritems():
+            stacks[(process,) + stack] += count
+        for stage, (calls, allocated, peak) in memory["stages"].iteritems():
+            merged = stages.setdefault(stage, [0, 0, 0])
+            merged[0] += calls
+            merged[1] += allocated
+            merged[2] = max(merged[2], peak)
+        for site, size, count in memory["allocations"] or ():
+            allocations[site] += size
+
+    if stats is None:
+        return None
+
+    stats.dump_stats(output + ".pstats")
+    with open(output + ".collapsed", "w") as f:
+        for stack, count in sorted(stacks.iteritems()):
+            f.write("%s %d\n" % (";".join(stack), count))
+    if stages:
+        with open(output + ".memory.txt", "w") as f:
+            f.write("memory per stage, %s\n\n" % (
+                "traced by tracemalloc" if tracemalloc is not None
+                else "resident set size"))
+            f.write("%-10s %8s %14s %14s\n" % (
+                "stage", "calls", "allocated", "peak"))
+            for stage, (calls, allocated, peak) in sorted(stages.iteritems()):
+                f.write("%-10s %8d %14d %14d\n" % (stage, calls, allocated,
+                                                   peak))
+            if allocations:
+                f.write("\ntop allocation sites\n\n")
+                for site, size in allocations.most_common(TOP_ALLOCATIONS):
+                    f.write("%14d %s\n" % (size, site))
+    return stats
@@ -1,22 +1,139 @@
 import dejavu.fingerprint as fingerprint
 import dejavu.decoder as decoder
+from dejavu.cache import samples_key
+from dejavu.database import Database
+import dejavu.metrics as metrics
+import dejavu.stream as stream
+from dejavu.align import Aligner
+from dejavu.timing import (StageTimer, NULL_TIMER, STAGE_DECODE, STAGE_CACHE,
+                           COUNT_SAMPLES)
 import numpy as np
-import pyaudio
+import copy
+import itertools
+import sys
+import threading
 import time
 
-from tqdm import trange
+from multiprocessing.pool import ThreadPool
+from tqdm import tqdm
 from pydub.audio_segment import AudioSegment
 
+try:
+    import pyaudio
+except ImportError:
+    # only the microphone needs it, streams and files are read headless
+    pyaudio = None
+
+# Seconds of audio an adaptive query starts with, and the longest window it
+# grows to before moving on to the next part of the file, see
+# `FileRecognizer.recognize_adaptive`.
+DEFAULT_ADAPTIVE_START = 5
+DEFAULT_ADAPTIVE_WINDOW = 30
+
+# Segments of a long file recognized at once by `FileRecognizer`, every
+# thread looks its segment up over its own pooled database connection.
+DEFAULT_SEGMENT_THREADS = 4
+
 class BaseRecognizer(object):
     def __init__(self, dejavu):
         self.dejavu = dejavu
         self.Fs = fingerprint.DEFAULT_FS
+        # query chunk by chunk and stop early, see
+        # `Dejavu.find_match_progressive`
+        self.progressive = bool(dejavu.config.get("progressive"))
+        # `time.time()` by which the current query must be answered, None
+        # for no limit
+        self.deadline = None
+        # only songs of this catalog are matched, None matches every song
+        self.catalog = None
+        # add per-stage timings and counts to results, measured by the
+        # `StageTimer` of the current query
+        self.timings = bool(dejavu.config.get("timings"))
+        self.timer = None
 
     def _recognize(self, *data):
-        matches = []
-        for d in data:
-            matches.extend(self.dejavu.find_matches(d, Fs=self.Fs))
-        return self.dejavu.align_matches(matches)
+        return self._cached(lambda: samples_key(data, self.Fs),
+                            self._recognize_uncached, *data)
+
+    def _recognize_uncached(self, *data):
+        timer = self.timer
+        if timer is not None:
+            timer.count(COUNT_SAMPLES, sum(len(d) for d in data))
+
+        # the channels share most hashes, so they are looked up in one pass
+        # and every hit is counted at each channel's offsets
+        hashes = self.dejavu.query_hashes(data, Fs=self.Fs, timer=timer)
+
+        if self.progressive or self.deadline is not None:
+            return self.dejavu.find_match_progressive(hashes,
+                                                      deadline=self.deadline,
+                                                      catalog=self.catalog,
+                                                      timer=timer)
+
+        matches = self.dejavu.find_hash_matches(hashes, catalog=self.catalog,
+                                                timer=timer)
+        return self.dejavu.align_matches(matches, timer=timer)
+
+    def _start_timer(self):
+        """
+        Starts measuring a new query when `timings` is enabled.
+        """
+        self.timer = StageTimer() if self.timings else None
+
+    def _stage(self, name):
+        return (self.timer or NULL_TIMER).stage(name)
+
+    def _observe(self, started, match):
+        """
+        Updates the recognition metrics with a request started at `started`.
+        """
+        metrics.RECOGNITION_SECONDS.observe(time.time() - started)
+        metrics.RECOGNITIONS.labels(
+            result="match" if match else "no_match").inc()
+
+    def _add_timings(self, match):
+        """
+        Adds what `self.timer` measured to a match.
+        """
+        if self.timer is not None and isinstance(match, dict):
+            match['timings'] = dict(self.timer.timings)
+            match['counts'] = dict(self.timer.counts)
+
+    def _set_deadline(self, deadline):
+        """
+        Starts the clock on a query that must be answered within `deadline`
+        seconds, None for no limit.
+        """
+        self.deadline = time.time() + deadline if deadline is not None else None
+
+    def _cached(self, make_key, func, *args, **kwargs):
+        """
+        Returns the result cached for the key `make_key()` returns when the
+        result cache is enabled and has it, otherwise calls `func` and caches
+        its result. The key is only computed with the cache enabled, it
+        hashes the query audio or file.
+        """
+        # follow switches of the fingerprint version made elsewhere
+        self.dejavu.maybe_refresh_fingerprint_version()
+        cache = self.dejavu.result_cache
+        if cache is None:
+            return func(*args, **kwargs)
+        key = make_key()
+        if self.catalog is not None:
+            key = "catalog|%s|%s" % (self.catalog, key)
+
+        version = self.dejavu.get_songs_version()
+        with self._stage(STAGE_CACHE):
+            result = cache.get(key, version, _MISSING)
+        if result is not _MISSING:
+            # report this lookup, not the one that filled the cache
+            self._add_timings(result)
+        else:
+            result = func(*args, **kwargs)
+            # an answer cut short by a deadline is not worth keeping
+            if self.deadline is None or time.time() < self.deadline:
+                cache.put(key, version, result)
+        return result
 
     def recognize(self):
         pass  # base class does nothing
@@ -25,16 +142,15 @@ class FileRecognizer(BaseRecognizer):
     def __init__(self, dejavu):
         super(FileRecognizer, self).__init__(dejavu)
 
-    def recognize_segment(self, segment, segment_size=30):
+    def recognize_segment(self, segment, segment_size=30, threads=None):
         duration = segment.duration_seconds
         if duration > segment_size:
-            matches = []
-            for i in trange(int(duration/segment_size), desc=("Recognizing each %ss segment" % segment_size)):
-                seg = segment[i * segment_size * 1000:(i+1)* segment_size * 1000]
-                matches.append(self.recognize_segment(seg, segment_size=segment_size))
-            return matches
+            return self._recognize_segments(segment, segment_size, threads)
 
-        frames, self.Fs, file_hash = decoder.read(segment)
+        if self.timer is None:
+            self._start_timer()
+        with self._stage(STAGE_DECODE):
+            frames, self.Fs, file_hash = decoder.read(segment)
 
         t = time.time()
         match = self._recognize(*frames)
@@ -42,23 +158,289 @@ class FileRecognizer(BaseRecognizer):
 
         if match:
             match['match_time'] = t
+            self._add_timings(match)
 
+        # every segment gets its own timings
+        self.timer = None
         return match
 
-    def recognize_file(self, filename, file_type="wav"):
-        return self.recognize_segment(AudioSegment.from_file(filename, format=file_type))
+    def _recognize_segments(self, segment, segment_size, threads):
+        """
+        Recognizes every `segment_size` seconds of `segment` on a pool of
+        `threads` threads, by default the `segment_threads` configuration,
+        so the database round trips of several segments overlap. Returns
+        the matches in segment order.
+        """
+        if threads is None:
+            threads = self.dejavu.config.get("segment_threads",
+                                             DEFAULT_SEGMENT_THREADS)
+        nsegments = int(segment.duration_seconds / segment_size)
+        timer = self.timer
+
+        def recognize(i):
+            seg = segment[i * segment_size * 1000:(i+1)* segment_size * 1000]
+            # every segment has its own query state, the decode of the
+            # whole file is counted in the first one
+            worker = copy.copy(self)
+            worker.timer = timer if i == 0 else None
+            return worker.recognize_segment(seg, segment_size=segment_size)
+
+        pool = ThreadPool(min(threads, nsegments)) if threads > 1 else None
+        imap = pool.imap if pool is not None else itertools.imap
+        try:
+            matches = list(tqdm(imap(recognize, xrange(nsegments)),
+                                total=nsegments,
+                                desc=("Recognizing each %ss segment" %
+                                      segment_size)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.timer = None
+        return matches
+
+    def recognize_file(self, filename, file_type="wav", deadline=None,
+                       catalog=None, adaptive=None):
+        """
+        `deadline` is the number of seconds the lookup may take, the best
+        match found by then is returned. `catalog` limits matching to the
+        songs of that catalog. `adaptive` stops at the first confident
+        window, see `recognize_adaptive`; it defaults to the `adaptive`
+        configuration.
+        """
+        if adaptive is None:
+            adaptive = self.dejavu.config.get("adaptive")
+        if adaptive:
+            options = adaptive if isinstance(adaptive, dict) else {}
+            return self.recognize_adaptive(filename, deadline=deadline,
+                                           catalog=catalog, **options)
+        started = time.time()
+        self._set_deadline(deadline)
+        self.catalog = catalog
+        self._start_timer()
+        # keyed on the file content so repeated queries skip decoding too
+        key = lambda: "file|%s|%s" % (file_type, decoder.unique_hash(filename))
+        match = self._cached(key, self._recognize_file, filename, file_type)
+        self._observe(started, match)
+        return match
+
+    def _recognize_file(self, filename, file_type):
+        # the decode of the whole file is counted in the first segment
+        with self._stage(STAGE_DECODE):
+            segment = AudioSegment.from_file(filename, format=file_type)
+        return self.recognize_segment(segment)
+
+    def recognize_adaptive(self, filename, start=DEFAULT_ADAPTIVE_START,
+                           window=DEFAULT_ADAPTIVE_WINDOW,
+                           min_confidence=stream.DEFAULT_MIN_CONFIDENCE,
+                           margin=stream.DEFAULT_MARGIN, deadline=None,
+                           catalog=None):
+        """
+        Answers "which song is this file" from as little of it as possible.
+        The first `start` seconds are decoded and looked up, and while no
+        song leads with `min_confidence` aligned matches and `margin` times
+        the runner-up's, the window doubles up to `window` seconds, then
+        starts over on the audio that follows. Only the new audio is decoded,
+        fingerprinted and looked up at every step.
+
+        Returns one match, the most confident one when none settled it,
+        with the seconds of audio consumed as `audio_seconds`.
+        """
+        started = time.time()
+        self._set_deadline(deadline)
+        self.catalog = catalog
+        self._start_timer()
+        key = lambda: "adaptive|%s|%s|%s|%s|%s" % (
+            start, window, min_confidence, margin,
+            decoder.unique_hash(filename))
+        match = self._cached(key, self._recognize_adaptive, filename, start,
+                             window, min_confidence, margin)
+        self._observe(started, match)
+        return match
+
+    def _recognize_adaptive(self, filename, start, window, min_confidence,
+                            margin):
+        t = time.time()
+        chunks = decoder.read_chunks(filename, seconds=start)
+        fingerprinters = None
+        pending = []  # hashes not looked up yet
+        aligner = best = Aligner()
+        consumed = heard = 0.0
+        checkpoint = start
+        while True:
+            with self._stage(STAGE_DECODE):
+                chunk = next(chunks, None)
+            if chunk is None:
+                for fingerprinter in fingerprinters or ():
+                    pending.extend(fingerprinter.flush())
+            else:
+                channels, Fs = chunk
+                if fingerprinters is None:
+                    fingerprinters = [fingerprint.StreamFingerprinter(
+                        Fs=Fs, **self.dejavu.fingerprint_params)
+                        for _ in channels]
+                for fingerprinter, samples in zip(fingerprinters, channels):
+                    pending.extend(fingerprinter.feed(samples))
+                seconds = len(channels[0]) / float(Fs)
+                consumed += seconds
+                heard += seconds
+                if heard < checkpoint:
+                    continue
+
+            if pending:
+                aligner.add(self.dejavu.find_hash_matches(
+                    pending, catalog=self.catalog, timer=self.timer))
+                pending = []
+            if aligner.confidence > best.confidence:
+                best = aligner
+            if (chunk is None or
+                    aligner.is_confident(min_confidence, margin) or
+                    (self.deadline is not None and
+                     time.time() >= self.deadline)):
+                break
+            if heard >= window:
+                # nothing settled in this part of the file, try the next one
+                aligner, heard, checkpoint = Aligner(), 0.0, start
+            else:
+                checkpoint = min(2 * checkpoint, window)
+        chunks.close()
+
+        match = self.dejavu._match_info(best)
+        if match:
+            match['match_time'] = time.time() - t
+            match['audio_seconds'] = consumed
+            self._add_timings(match)
+        return match
+
+    def recognize(self, filename, file_type="wav", deadline=None,
+                  catalog=None, adaptive=None):
+        return self.recognize_file(filename, file_type=file_type,
+                                   deadline=deadline, catalog=catalog,
+                                   adaptive=adaptive)
+
+class TimelineRecognizer(BaseRecognizer):
+    """
+    Logs what plays when in a long recording, e.g. a day of broadcast. The
+    file is decoded a chunk at a time and recognized in overlapping windows
+    sliding over it, see `dejavu.stream.SlidingMatcher`, and consecutive
+    windows matching the same play of a song are merged into one
+    `dejavu.stream.TimelineEntry`.
+    """
+    chunk_seconds = 30
+
+    def __init__(self, dejavu):
+        super(TimelineRecognizer, self).__init__(dejavu)
+
+    def iter_timeline(self, filename, window=stream.DEFAULT_WINDOW,
+                      hop=stream.DEFAULT_HOP,
+                      min_confidence=stream.DEFAULT_MIN_CONFIDENCE,
+                      margin=stream.DEFAULT_MARGIN,
+                      tolerance=stream.DEFAULT_TOLERANCE, catalog=None):
+        """
+        Yields the `TimelineEntry` of every song played in `filename` as
+        soon as its play ends.
+        """
+        self.dejavu.maybe_refresh_fingerprint_version()
+        matcher = None
+        timeline = stream.Timeline(self._song_name, tolerance=tolerance)
+        for channels, Fs in decoder.read_chunks(filename,
+                                                self.chunk_seconds):
+            if matcher is None:
+                matcher = stream.SlidingMatcher(
+                    self.dejavu, Fs, len(channels), window=window, hop=hop,
+                    min_confidence=min_confidence, margin=margin,
+                    catalog=catalog)
+            for match in matcher.feed(channels):
+                for entry in timeline.add(match):
+                    yield entry
+        if matcher is not None:
+            for match in matcher.flush():
+                for entry in timeline.add(match):
+                    yield entry
+        for entry in timeline.close():
+            yield entry
+
+    def _song_name(self, song_id):
+        song = self.dejavu.db.get_song_by_id(song_id)
+        return song.song_name if song else None
+
+    def recognize(self, filename, **options):
+        """
+        Returns the list of `TimelineEntry` of `filename`, see
+        `iter_timeline` for the options.
+        """
+        return list(self.iter_timeline(filename, **options))
+
+class StreamRecognizer(BaseRecognizer):
+    """
+    Monitors live audio read from a file-like object, a socket or a file
+    descriptor, e.g. a radio stream on a pipe, see `decoder.read_stream`.
+    Needs no audio device.
+
+    The stream is read `hop` seconds at a time and recognized in windows of
+    `window` seconds sliding by `hop`, see `dejavu.stream.SlidingMatcher`.
+    A window is reported once its hashes are final, at most
+    `neighborhood_size` plus `max_time_delta` spectrogram frames after its
+    audio was read and usually much sooner. Memory is bounded by the window.
+    """
+    default_hop = 2.5
+    default_window = 10
+
+    def __init__(self, dejavu):
+        super(StreamRecognizer, self).__init__(dejavu)
 
-    def recognize(self, filename, file_type="wav"):
-        return self.recognize_file(filename, file_type=file_type)
+    def iter_matches(self, source, samplerate=fingerprint.DEFAULT_FS,
+                     channels=1, file_format=None, hop=default_hop,
+                     window=default_window,
+                     min_confidence=stream.DEFAULT_MIN_CONFIDENCE,
+                     margin=stream.DEFAULT_MARGIN, catalog=None,
+                     all_windows=False):
+        """
+        Yields the `WindowMatch` of every window of `source` a song is
+        recognized in, or of every window with `all_windows`, as soon as it
+        is known. `source` holds raw 16-bit PCM of `samplerate` and
+        `channels` unless `file_format` names its encoding. `stream.Timeline`
+        merges the windows into plays of songs.
+        """
+        self.dejavu.maybe_refresh_fingerprint_version()
+        matcher = stream.SlidingMatcher(
+            self.dejavu, samplerate, channels, window=window, hop=hop,
+            min_confidence=min_confidence, margin=margin, catalog=catalog)
+        chunks = decoder.read_stream(source, samplerate, channels,
+                                     seconds=hop, file_format=file_format)
+        for samples, _ in chunks:
+            for match in matcher.feed(samples):
+                if all_windows or match.song_id is not None:
+                    yield match
+        for match in matcher.flush():
+            if all_windows or match.song_id is not None:
+                yield match
+
+    def recognize(self, source, **options):
+        """
+        Returns the first `WindowMatch` a song is recognized in, None when
+        the stream ends first. See `iter_matches` for the options.
+        """
+        for match in self.iter_matches(source, **options):
+            if match.song_id is not None:
+                return match
+        return None
 
 class MicrophoneRecognizer(BaseRecognizer):
     default_chunksize   = 8192
-    default_format      = pyaudio.paInt16
+    default_format      = pyaudio.paInt16 if pyaudio is not None else None
     default_channels    = 2
     default_samplerate  = 44100
+    # seconds between two lookups while listening, and seconds of audio each
+    # lookup covers
+    default_interval    = 2.5
+    default_window      = 10
 
     def __init__(self, dejavu):
         super(MicrophoneRecognizer, self).__init__(dejavu)
+        if pyaudio is None:
+            raise NoRecordingError("pyaudio is needed to record from a "
+                                   "microphone")
         self.audio = pyaudio.PyAudio()
         self.stream = None
         self.data = []
@@ -87,35 +469,159 @@ class MicrophoneRecognizer(BaseRecognizer):
             frames_per_buffer=chunksize,
         )
 
-        self.data = [[] for i in range(channels)]
+        self.data = [np.zeros(0, dtype=np.int16) for i in range(channels)]
+        self._blocks = []
 
     def process_recording(self):
         data = self.stream.read(self.chunksize)
-        nums = np.fromstring(data, np.int16)
-        for c in range(self.channels):
-            self.data[c].extend(nums[c::self.channels])
+        self._blocks.append(np.frombuffer(data, np.int16))
 
     def stop_recording(self):
         self.stream.stop_stream()
         self.stream.close()
         self.stream = None
         self.recorded = True
+        # one copy of the recording instead of growing a list per sample
+        if self._blocks:
+            nums = np.concatenate(self._blocks)
+            self.data = [nums[c::self.channels].copy()
+                         for c in range(self.channels)]
+        self._blocks = []
 
     def recognize_recording(self):
         if not self.recorded:
             raise NoRecordingError("Recording was not complete/begun")
-        return self._recognize(*self.data)
+        started = time.time()
+        self._start_timer()
+        match = self._recognize(*self.data)
+        self._add_timings(match)
+        self._observe(started, match)
+        return match
 
     def get_recorded_time(self):
-        return len(self.data[0]) / self.rate
+        return len(self.data[0]) / float(self.samplerate)
 
-    def recognize(self, seconds=10):
+    def recognize(self, seconds=10, deadline=None, catalog=None):
         self.start_recording()
         for i in range(0, int(self.samplerate / self.chunksize
                               * seconds)):
             self.process_recording()
         self.stop_recording()
+        self._set_deadline(deadline)
+        self.catalog = catalog
         return self.recognize_recording()
 
+    def listen(self, max_seconds=None, interval=default_interval,
+               window=default_window,
+               min_confidence=stream.DEFAULT_MIN_CONFIDENCE,
+               margin=stream.DEFAULT_MARGIN, catalog=None,
+               channels=default_channels, samplerate=default_samplerate,
+               chunksize=default_chunksize):
+        """
+        Listens until a song is recognized or `max_seconds` have passed, None
+        for no limit, and returns the match or None.
+
+        The audio is captured by a PyAudio callback into a `SampleRing` and
+        looked up every `interval` seconds on a background thread, over the
+        last `window` seconds. Audio already heard is not fingerprinted or
+        looked up again, see `dejavu.stream.SlidingMatcher`.
+        """
+        started = time.time()
+        self.dejavu.maybe_refresh_fingerprint_version()
+        self.channels = channels
+        self.samplerate = samplerate
+        self.chunksize = chunksize
+        self.recorded = False
+        self.ring = stream.SampleRing(
+            samplerate * max(window, 4 * interval), channels)
+        matcher = stream.SlidingMatcher(
+            self.dejavu, samplerate, channels, window=window, hop=interval,
+            min_confidence=min_confidence, margin=margin, catalog=catalog)
+        self._match = None
+        self._error = None
+        self._done = threading.Event()
+        self._blocks = []
+
+        if self.stream:
+            self.stream.stop_stream()
+            self.stream.close()
+        self.stream = self.audio.open(
+            format=self.default_format,
+            channels=channels,
+            rate=samplerate,
+            input=True,
+            frames_per_buffer=chunksize,
+            stream_callback=self._capture,
+        )
+        listener = threading.Thread(target=self._listen, args=(matcher,
+                                                                interval))
+        listener.daemon = True
+        listener.start()
+        try:
+            # short waits keep the main thread responsive to interrupts
+            while not self._done.wait(0.1):
+                if (max_seconds is not None and
+                        time.time() - started >= max_seconds):
+                    break
+        finally:
+            self._done.set()
+            listener.join()
+            self.stop_recording()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        if self._match:
+            self._match['match_time'] = time.time() - started
+        self._observe(started, self._match)
+        return self._match
+
+    def _capture(self, in_data, frame_count, time_info, status):
+        self.ring.write(in_data)
+        return None, pyaudio.paContinue
+
+    def _listen(self, matcher, interval):
+        """
+        Feeds what was captured to `matcher` every `interval` seconds until
+        a window is recognized or listening stops.
+        """
+        try:
+            while not self._done.wait(interval):
+                samples, dropped = self.ring.read()
+                if dropped:
+                    # keep the timing of later audio: silence has no peaks
+                    samples = [np.concatenate((np.zeros(dropped, np.int16), s))
+                               for s in samples]
+                for window in matcher.feed(samples):
+                    if window.song_id is not None:
+                        self._match = self._window_info(window)
+                        return
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def _window_info(self, window):
+        """
+        Returns the match of a recognized `WindowMatch`, with its offset
+        counted from the start of listening.
+        """
+        song = self.dejavu.db.get_song_by_id(window.song_id)
+        if song is None:
+            return None
+        position = max(window.position, 0.0)
+        return {
+            self.dejavu.SONG_ID: window.song_id,
+            self.dejavu.SONG_NAME: song.song_name,
+            self.dejavu.CONFIDENCE: window.confidence,
+            self.dejavu.OFFSET: int(round(
+                position * fingerprint.DEFAULT_FS /
+                self.dejavu.fingerprint_params["wsize"] /
+                self.dejavu.fingerprint_params["wratio"])),
+            self.dejavu.OFFSET_SECS: round(position, 5),
+            Database.FIELD_FILE_SHA1: song.file_sha1,
+        }
+
 class NoRecordingError(Exception):
     pass
+
+# Tells cached None results apart from cache misses.
+_MISSING = object()
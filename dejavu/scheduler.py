@@ -0,0 +1,665 @@
+""" Long lived process pool used to fingerprint many files.
+"""
+import os
+import sys
+import time
+import Queue
+import pickle
+import collections
+import signal
+import logging
+import threading
+import multiprocessing
+
+from collections import namedtuple
+
+import dejavu.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# Number of files a worker fingerprints before it is replaced by a fresh
+# process, this bounds the memory numpy/ffmpeg buffers can leak over time.
+DEFAULT_MAXTASKSPERCHILD = 50
+
+# Time budget of a single file is DEFAULT_TIMEOUT_BASE seconds plus
+# DEFAULT_TIMEOUT_PER_MB seconds per megabyte of input, a worker still busy
+# with a file after that is killed and the file quarantined.
+DEFAULT_TIMEOUT_BASE = 120
+DEFAULT_TIMEOUT_PER_MB = 30
+
+# How often the parent wakes up to check on running files, in seconds.
+WATCHDOG_INTERVAL = 1.0
+
+# Seconds a profiled worker past its deadline gets to save its profile
+# before it is killed.
+PROFILE_SAVE_GRACE = 2.0
+
+# Extra files handed to a worker per task so it can decode the next one
+# while fingerprinting the current one.
+DEFAULT_PREFETCH = 1
+
+# Assumed resident memory of an idle worker until one has been measured.
+DEFAULT_WORKER_BASELINE = 80 * 2 ** 20
+
+# Bounds of the factor applied to memory estimates after calibrating them
+# against measured worker RSS.
+MIN_MEMORY_SCALE = 0.5
+MAX_MEMORY_SCALE = 4.0
+
+# Messages workers send to the parent on the event queue.
+EVENT_START = "start"
+EVENT_DONE = "done"
+
+# Orders in which queued files are handed to the pool.
+ORDER_SIZE = "size"
+ORDER_WALK = "walk"
+
+IngestProgress = namedtuple('IngestProgress', (
+    'done', 'total', 'bytes_done', 'bytes_total', 'elapsed',
+    'files_per_sec', 'bytes_per_sec', 'eta'))
+
+
+def default_processes():
+    """
+    Leaves one core for the parent process which writes to the database.
+    """
+    try:
+        return max(multiprocessing.cpu_count() - 1, 1)
+    except NotImplementedError:
+        return 1
+
+
+class WorkerTimeout(Exception):
+    """
+    A file exceeded its time budget and the worker fingerprinting it was
+    killed.
+    """
+    pass
+
+
+class WorkerDied(Exception):
+    """
+    The worker fingerprinting a file exited before reporting back, e.g. it
+    was killed by the OOM killer.
+    """
+    pass
+
+
+def process_rss(pid):
+    """
+    Returns the resident set size of `pid` in bytes, None where /proc is not
+    available.
+    """
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def process_alive(pid):
+    """
+    Returns False once `pid` exited, zombies that were not reaped yet
+    included.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (IOError, OSError, IndexError):
+        return True
+
+
+def _signal(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError:
+        pass  # already gone
+
+
+def file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+class EventQueue(object):
+    """
+    Carries the events of the workers to the parent. Unlike a
+    `multiprocessing.Queue`, whose feeder thread dies with a killed worker,
+    `put` only returns once the event is in the pipe, so the parent learns
+    which file a worker was busy with however it ended.
+    """
+
+    def __init__(self):
+        super(EventQueue, self).__init__()
+        self._reader, self._writer = multiprocessing.Pipe(duplex=False)
+        # held by the parent while it decides which workers to kill, no
+        # worker can report a file done in the meantime
+        self.lock = multiprocessing.Lock()
+
+    def put(self, event):
+        with self.lock:
+            self._writer.send(event)
+
+    def get(self, timeout=None):
+        if not self._reader.poll(timeout):
+            raise Queue.Empty
+        return self._reader.recv()
+
+    def get_nowait(self):
+        return self.get(0)
+
+
+class IngestScheduler(object):
+    """
+    Keeps a `multiprocessing.Pool` alive across batches, recycles its workers
+    and feeds it the biggest files first so a single long file does not end
+    up running alone at the end of a batch.
+
+    Every file gets a time budget scaled by its size. A worker that overruns
+    it (ffmpeg hanging on a corrupt file, ...) is killed, the pool replaces
+    it and the file is added to `quarantine` so it can be retried later with
+    `retry_quarantined`. A file whose worker dies on its own fails with
+    `WorkerDied`.
+
+    `nprocesses` is the upper bound on parallelism, with a `memory_budget`
+    (in bytes) fewer files run at once when they would not fit in memory.
+
+    ```python
+    scheduler = IngestScheduler(4)
+    for filename, ok, value, progress in scheduler.run(func, filenames):
+        ...
+    scheduler.close()
+    ```
+    """
+
+    def __init__(self, nprocesses=None, maxtasksperchild=DEFAULT_MAXTASKSPERCHILD,
+                 order=ORDER_SIZE, timeout_base=DEFAULT_TIMEOUT_BASE,
+                 timeout_per_mb=DEFAULT_TIMEOUT_PER_MB,
+                 prefetch=DEFAULT_PREFETCH, memory_budget=None,
+                 profile=None):
+        super(IngestScheduler, self).__init__()
+        self.nprocesses = nprocesses or default_processes()
+        self.maxtasksperchild = maxtasksperchild
+        self.order = order
+        self.timeout_base = timeout_base
+        self.timeout_per_mb = timeout_per_mb
+        self.prefetch = prefetch
+        self.memory_budget = memory_budget
+        # {"dir": ..., "memory": bool}, workers profile themselves into
+        # "dir" when set, see `dejavu.profiling`
+        self.profile = profile
+        self.memory_scale = 1.0
+        self.worker_baseline = DEFAULT_WORKER_BASELINE
+        self.quarantine = []
+        self._pool = None
+        self._events = None
+        # set once a worker of the pool died, its task never completes and
+        # the pool can then only be terminated
+        self._lost = False
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            # workers report which file they picked up and how it went
+            # through this queue, one pool task can hold several files
+            self._events = EventQueue()
+            self._pool = multiprocessing.Pool(
+                self.nprocesses, initializer=_init_worker,
+                initargs=(self._events, self.profile),
+                maxtasksperchild=self.maxtasksperchild)
+        return self._pool
+
+    def time_budget(self, size, scale=1):
+        """
+        Returns the number of seconds a file of `size` bytes may take, or
+        None when timeouts are disabled.
+        """
+        if self.timeout_base is None:
+            return None
+        return scale * (self.timeout_base +
+                        self.timeout_per_mb * size / float(2 ** 20))
+
+    def resize(self, nprocesses):
+        """
+        Changes the number of worker processes, the pool is recreated on the
+        next batch.
+        """
+        nprocesses = nprocesses or default_processes()
+        if nprocesses != self.nprocesses:
+            self.close()
+            self.nprocesses = nprocesses
+
+    def schedule(self, filenames):
+        """
+        Returns (filename, size) pairs in the order they should be processed.
+        """
+        sized = [(filename, file_size(filename)) for filename in filenames]
+        if self.order == ORDER_SIZE:
+            sized.sort(key=lambda item: item[1], reverse=True)
+        return sized
+
+    def run(self, func, filenames, *args, **kwargs):
+        """
+        Calls `func(filename, *args)` in the pool for every filename and
+        yields `(filename, ok, value, progress)` tuples as they complete.
+        `value` is the return value of `func`, or the raised exception when
+        `ok` is False (a `WorkerTimeout` for files that were quarantined).
+
+        When a `loader` is given the work is split in two stages:
+        `loader(filename, *args)` does the I/O bound part and its result is
+        passed on as `func(filename, loaded)`. Workers then get `prefetch`
+        extra files per task and load the next one in a background thread
+        while `func` runs on the current one.
+
+        With a `memory_budget` an `estimator(filename)` returning the
+        (decoded, working) bytes a file needs should be given. Files are then
+        only handed out while the estimates of the running ones fit in the
+        budget, estimates are corrected with the RSS measured on the workers.
+
+        `timeout_scale` multiplies the time budget of every file.
+        """
+        timeout_scale = kwargs.pop("timeout_scale", 1)
+        loader = kwargs.pop("loader", None)
+        estimator = kwargs.pop("estimator", None)
+        batch_size = self.prefetch + 1 if loader is not None else 1
+        scheduled = self.schedule(filenames)
+        sizes = dict(scheduled)
+        total = len(scheduled)
+        bytes_total = sum(sizes.itervalues())
+        done = 0
+        bytes_done = 0
+        started = time.time()
+
+        pool = self.pool
+        pending = set(sizes)
+        running = {}  # filename => (pid, deadline)
+        batches = {}  # filename => files sent to the same worker
+        waiting = collections.deque()
+        inflight = {}  # batch => estimated bytes
+        estimates = {}  # filename => (decoded bytes, working bytes)
+        peak_rss = {}  # filename => largest RSS seen while it ran
+
+        def submit(batch):
+            for filename in batch:
+                batches[filename] = batch
+            inflight[batch] = self._batch_memory(batch, estimates)
+            pool.apply_async(_run_batch, ((func, loader, batch, args),))
+
+        def fill():
+            # Strictly in order, skipping ahead to smaller files would push
+            # the large ones to the end of the run.
+            while waiting:
+                if self.memory_budget is not None and inflight:
+                    if len(inflight) >= self.nprocesses:
+                        break
+                    used = sum(inflight.itervalues())
+                    if used + self._batch_memory(waiting[0], estimates) > \
+                            self._memory_available():
+                        break
+                submit(waiting.popleft())
+
+        # Consecutive files share a task so the worker can prefetch, with
+        # largest-first ordering they are of similar size. A batch size of
+        # one keeps the pool handing out files one at a time.
+        ordered = [filename for filename, _ in scheduled]
+        if self.memory_budget is not None and estimator is not None:
+            for filename in ordered:
+                estimates[filename] = estimator(filename)
+        for i in xrange(0, total, batch_size):
+            waiting.append(tuple(ordered[i:i + batch_size]))
+        fill()
+
+        def handle(event, results):
+            kind, filename = event[:2]
+            if filename not in pending:
+                # stale, the file was already reported, e.g. killed just as
+                # it finished
+                pass
+            elif kind == EVENT_START:
+                pid, start = event[2:]
+                budget = self.time_budget(sizes[filename], timeout_scale)
+                running[filename] = (
+                    pid, start + budget if budget is not None else None)
+            else:
+                running.pop(filename, None)
+                results.append(event[1:])
+
+        def drain(results):
+            # files that finished while the caller was busy with earlier
+            # results are done, not late
+            while True:
+                try:
+                    handle(self._events.get_nowait(), results)
+                except Queue.Empty:
+                    break
+
+        while pending:
+            results = []
+            try:
+                handle(self._events.get(timeout=WATCHDOG_INTERVAL), results)
+            except Queue.Empty:
+                pass
+            drain(results)
+
+            if self.memory_budget is not None:
+                self._sample_memory(running, peak_rss)
+
+            lost = []
+            if any(not process_alive(pid) for pid, _ in running.itervalues()):
+                # whatever is still running once the events the dead workers
+                # sent are read was lost with them
+                drain(results)
+                lost.extend((filename, WorkerDied(filename))
+                            for filename in self._reap(running))
+            lost.extend((filename, WorkerTimeout(filename)) for filename
+                        in self._watchdog(running, lambda: drain(results)))
+
+            for filename, err in lost:
+                self._lost = True
+                results.append((filename, False, err))
+            reported = set(filename for filename, _, _ in results)
+            for filename, _ in lost:
+                # the rest of its batch died with the worker
+                batch = batches[filename]
+                inflight.pop(batch, None)
+                retry = tuple(f for f in batch if f in pending and
+                              f not in reported and f not in running)
+                if retry:
+                    waiting.appendleft(retry)
+
+            for filename, ok, value in results:
+                pending.discard(filename)
+                running.pop(filename, None)
+                batch = batches.pop(filename)
+                if not any(f in pending for f in batch):
+                    inflight.pop(batch, None)
+                if filename in peak_rss and filename in estimates:
+                    self._calibrate(estimates[filename], peak_rss.pop(filename))
+                done += 1
+                bytes_done += sizes[filename]
+                try:
+                    yield filename, ok, value, self._progress(
+                        done, total, bytes_done, bytes_total, started)
+                except GeneratorExit:
+                    # Abandoned by the caller, the workers' pending events
+                    # would leak into the next run and block `close`.
+                    if pending:
+                        self.terminate()
+                    raise
+
+            fill()
+            metrics.INGEST_WORKERS.set(self.nprocesses)
+            metrics.INGEST_WORKERS_BUSY.set(len(running))
+            metrics.INGEST_FILES_WAITING.set(sum(len(b) for b in waiting))
+
+        metrics.INGEST_WORKERS_BUSY.set(0)
+        if self._lost:
+            # the tasks of dead workers stay in the pool forever and would
+            # block `close`, start the next run with a fresh pool
+            self.terminate()
+
+    def _memory_available(self):
+        """
+        Part of the memory budget left for audio once every worker's
+        interpreter is accounted for.
+        """
+        return self.memory_budget - self.nprocesses * self.worker_baseline
+
+    def _batch_memory(self, batch, estimates):
+        """
+        Estimated bytes a worker needs for `batch`: the most expensive file
+        plus the decoded audio of the next file it is prefetching.
+        """
+        if not estimates:
+            return 0
+        costs = [estimates.get(filename, (0, 0)) for filename in batch]
+        peak = max(decoded + working for decoded, working in costs)
+        prefetched = max([0] + [decoded for decoded, _ in costs[1:]])
+        return int(self.memory_scale * (peak + prefetched))
+
+    def _sample_memory(self, running, peak_rss):
+        """
+        Records the resident memory of the workers busy with `running` files.
+        """
+        for filename, (pid, _) in running.items():
+            rss = process_rss(pid)
+            if rss is None:
+                continue
+            self.worker_baseline = min(self.worker_baseline, rss)
+            peak_rss[filename] = max(peak_rss.get(filename, 0), rss)
+
+    def _calibrate(self, estimate, rss):
+        """
+        Moves `memory_scale` towards the ratio between the memory a file
+        actually took and what it was estimated to take.
+        """
+        decoded, working = estimate
+        if decoded + working <= 0:
+            return
+        ratio = max(rss - self.worker_baseline, 0) / float(decoded + working)
+        ratio = min(max(ratio, MIN_MEMORY_SCALE), MAX_MEMORY_SCALE)
+        self.memory_scale = 0.8 * self.memory_scale + 0.2 * ratio
+
+    def _watchdog(self, running, drain):
+        """
+        Kills the workers of files that are past their deadline and
+        quarantines those files. Returns the killed filenames.
+
+        `drain` reads the pending events into `running`. It is called with
+        the event lock held, so a worker is only killed while it is still
+        on its expired file: it can't report the file done, nor move on to
+        the next one (or wait for a task, holding the pool's queue lock)
+        until the lock is released.
+        """
+        if not self._expired(running):
+            return []
+        expired = []
+        with self._events.lock:
+            drain()
+            pids = []
+            for filename in self._expired(running):
+                pid = running.pop(filename)[0]
+                logger.warning("%s exceeded its time budget, killing worker "
+                               "%d and quarantining it", filename, pid)
+                pids.append(pid)
+                self.quarantine.append(filename)
+                expired.append(filename)
+            self._kill(pids)
+        return expired
+
+    def _kill(self, pids):
+        """
+        Kills the workers `pids`. Profiled workers are asked to save their
+        profile and exit first, and killed after `PROFILE_SAVE_GRACE`
+        seconds, e.g. when stuck in C code.
+        """
+        if self.profile is not None:
+            for pid in pids:
+                _signal(pid, signal.SIGTERM)
+            deadline = time.time() + PROFILE_SAVE_GRACE
+            while (time.time() < deadline and
+                   any(process_alive(pid) for pid in pids)):
+                time.sleep(0.05)
+        for pid in pids:
+            _signal(pid, signal.SIGKILL)
+
+    def _expired(self, running):
+        now = time.time()
+        return [filename for filename, (_, deadline) in running.items()
+                if deadline is not None and now >= deadline]
+
+    def _reap(self, running):
+        """
+        Returns the `running` files whose worker exited without reporting
+        back, e.g. because it ran out of memory.
+        """
+        died = []
+        for filename, (pid, _) in running.items():
+            if process_alive(pid):
+                continue
+            logger.error("Worker %d died while fingerprinting %s", pid,
+                         filename)
+            del running[filename]
+            died.append(filename)
+        return died
+
+    def retry_quarantined(self, func, *args, **kwargs):
+        """
+        Runs the quarantined files again with `timeout_scale` (default 2)
+        times their normal budget. Files timing out again go back into
+        quarantine.
+        """
+        kwargs.setdefault("timeout_scale", 2)
+        filenames, self.quarantine = self.quarantine, []
+        return self.run(func, filenames, *args, **kwargs)
+
+    def _progress(self, done, total, bytes_done, bytes_total, started):
+        elapsed = time.time() - started
+        files_per_sec = done / elapsed if elapsed > 0 else 0.0
+        bytes_per_sec = bytes_done / elapsed if elapsed > 0 else 0.0
+        if bytes_per_sec > 0:
+            eta = (bytes_total - bytes_done) / bytes_per_sec
+        elif files_per_sec > 0:
+            eta = (total - done) / files_per_sec
+        else:
+            eta = None
+        return IngestProgress(done, total, bytes_done, bytes_total, elapsed,
+                              files_per_sec, bytes_per_sec, eta)
+
+    def close(self):
+        """
+        Waits for the workers to finish and releases the pool.
+        """
+        if self._lost:
+            self.terminate()
+        elif self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._events = None
+
+    def terminate(self):
+        """
+        Stops the workers right away, a new pool is created on next use.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._events = None
+        self._lost = False
+
+    def __getstate__(self):
+        # Pools can't be pickled, a copy starts without one.
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_events'] = None
+        return state
+
+
+# Set in every worker by `_init_worker`.
+_events = None
+_profiler = None
+_profile_dir = None
+_profile_name = None
+
+
+def _init_worker(events, profile=None):
+    global _events, _profiler, _profile_dir, _profile_name
+    _events = events
+    if profile is not None:
+        # imported here, profiling imports this module
+        from dejavu.profiling import Profiler
+        _profile_dir = profile["dir"]
+        # pids get reused by the workers replacing this one
+        _profile_name = "worker-%d-%d" % (os.getpid(), time.time() * 1000)
+        _profiler = Profiler(memory=profile.get("memory", False))
+        _profiler.start()
+        # sent by the watchdog before killing a worker, and by
+        # `Pool.terminate`
+        signal.signal(signal.SIGTERM, _save_profile_and_exit)
+
+
+def _save_profile_and_exit(signum, frame):
+    _profiler.save(_profile_dir, _profile_name)
+    os._exit(1)
+
+
+class _Prefetch(object):
+    """
+    Runs `loader(filename, *args)` in a background thread, `get` returns its
+    result or raises its exception.
+    """
+
+    def __init__(self, loader, filename, args):
+        super(_Prefetch, self).__init__()
+        self.filename = filename
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._load,
+                                        args=(loader, filename, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _load(self, loader, filename, args):
+        try:
+            self._result = loader(filename, *args)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def get(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+
+def _report(filename, ok, value):
+    try:
+        _events.put((EVENT_DONE, filename, ok, value))
+    except (pickle.PicklingError, TypeError) as err:
+        # the parent must hear about every file it handed out
+        _events.put((EVENT_DONE, filename, False, Exception(
+            "Unpicklable result %r: %s" % (value, err))))
+
+
+def _run_batch(batch):
+    """
+    Pool entry point, processes the files of a batch in order and reports
+    start and outcome of each one on the event queue, exceptions included,
+    so the parent knows which file failed.
+    """
+    func, loader, filenames, args = batch
+    prefetched = None
+    for i, filename in enumerate(filenames):
+        _events.put((EVENT_START, filename, os.getpid(), time.time()))
+        try:
+            if loader is None:
+                value = func(filename, *args)
+            else:
+                current, prefetched = prefetched, None
+                if current is not None:
+                    loaded = current.get()
+                else:
+                    loaded = loader(filename, *args)
+                # load the next file while this one is being processed
+                if i + 1 < len(filenames):
+                    prefetched = _Prefetch(loader, filenames[i + 1], args)
+                else:
+                    prefetched = None
+                value = func(filename, loaded)
+        except Exception as err:
+            logger.exception("Failed fingerprint of %s", filename)
+            _report(filename, False, err)
+        else:
+            _report(filename, True, value)
+
+    if _profiler is not None:
+        # the pool may replace this worker after any task
+        _profiler.save(_profile_dir, _profile_name)
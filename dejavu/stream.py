@@ -0,0 +1,251 @@
+""" Sliding-window recognition of long or continuous audio.
+"""
+import threading
+from collections import deque, namedtuple
+
+import numpy as np
+
+import dejavu.fingerprint as fingerprint
+from dejavu.align import Aligner
+
+# Seconds of audio every lookup window covers and seconds it moves by.
+# Every hop is fingerprinted and looked up once, whatever the overlap.
+DEFAULT_WINDOW = 10
+DEFAULT_HOP = 2.5
+
+# Aligned matches the leading song of a window needs, and how many times the
+# runner-up's, for the window to count as recognized.
+DEFAULT_MIN_CONFIDENCE = 20
+DEFAULT_MARGIN = 2.0
+
+# Seconds the alignment of consecutive windows may drift by while they are
+# still taken for one play of a song.
+DEFAULT_TOLERANCE = 1.0
+
+# Result of a window of the stream, times are seconds from the start of the
+# stream. `song_id` is None when no song was recognized. `position` is the
+# offset within the song minus the time within the stream, constant while a
+# song plays. `heard_start` and `heard_end` bound the hops of the window
+# holding matches aligned with the song.
+WindowMatch = namedtuple('WindowMatch', (
+    'start', 'end', 'song_id', 'position', 'confidence', 'heard_start',
+    'heard_end'))
+
+# One play of a song in a stream. `start` and `end` are seconds from the
+# start of the stream, `offset` is the second of the song playing at
+# `start`, `confidence` the highest confidence of its windows.
+TimelineEntry = namedtuple('TimelineEntry', (
+    'song_id', 'song_name', 'start', 'end', 'confidence', 'offset'))
+
+
+class SlidingMatcher(object):
+    """
+    Recognizes audio fed block by block in overlapping windows of `window`
+    seconds, `hop` seconds apart. Every channel has a
+    `fingerprint.StreamFingerprinter`, the hashes of every hop are looked
+    up once and the matches of the hops of a window are aligned together.
+
+    Windows are returned once all their hashes are final, see
+    `StreamFingerprinter`.
+    """
+
+    def __init__(self, dejavu, Fs, channels, window=DEFAULT_WINDOW,
+                 hop=DEFAULT_HOP, min_confidence=DEFAULT_MIN_CONFIDENCE,
+                 margin=DEFAULT_MARGIN, catalog=None):
+        super(SlidingMatcher, self).__init__()
+        self.dejavu = dejavu
+        self.catalog = catalog
+        self.min_confidence = min_confidence
+        self.margin = margin
+        self.fingerprinters = [
+            fingerprint.StreamFingerprinter(Fs=Fs, **dejavu.fingerprint_params)
+            for _ in xrange(channels)]
+        self.frame_seconds = self.fingerprinters[0].frame_seconds()
+        self.hop_frames = max(int(round(hop / self.frame_seconds)), 1)
+        self._hashes = {}  # hop => hashes offset within it
+        self._next_hop = 0
+        self._hops = deque(maxlen=max(int(round(float(window) / hop)), 1))
+
+    def feed(self, channels):
+        """
+        Adds the next samples of every channel, returns the `WindowMatch` of
+        every window completed.
+        """
+        for fingerprinter, samples in zip(self.fingerprinters, channels):
+            self.collect(fingerprinter.feed(samples))
+        return self._match(self.take_hops())
+
+    def flush(self):
+        """
+        Ends the stream, returns the `WindowMatch` of the remaining windows.
+        """
+        for fingerprinter in self.fingerprinters:
+            self.collect(fingerprinter.flush())
+        frames = max(f.frames for f in self.fingerprinters)
+        return self._match(self.take_hops(-(-frames // self.hop_frames)))
+
+    def collect(self, hashes):
+        """
+        Adds final hashes of a channel, e.g. from its fingerprinter's
+        `add_specgram` when the spectrogram is computed elsewhere.
+        """
+        for h in hashes:
+            self._hashes.setdefault(h[1] // self.hop_frames, set()).add(h)
+
+    def take_hops(self, hops=None):
+        """
+        Returns the (hop, hashes) of the hops below `hops` not looked up
+        yet, by default the ones whose hashes are all final.
+        """
+        if hops is None:
+            hops = min(f.hashed for f in self.fingerprinters) // self.hop_frames
+        taken = []
+        while self._next_hop < hops:
+            taken.append((self._next_hop,
+                          self._hashes.pop(self._next_hop, ())))
+            self._next_hop += 1
+        return taken
+
+    def _match(self, taken):
+        """
+        Looks every hop of `taken` up and aligns the windows ending at them.
+        """
+        return self.add_matches([
+            (hop, list(self.dejavu.find_hash_matches(hashes,
+                                                     catalog=self.catalog))
+             if hashes else [])
+            for hop, hashes in taken])
+
+    def add_matches(self, hop_matches):
+        """
+        Adds the (hop, matches) of hops `take_hops` returned, looked up
+        elsewhere, and returns the `WindowMatch` of the windows ending at
+        them.
+        """
+        windows = []
+        for hop, matches in hop_matches:
+            self._hops.append((hop, matches))
+            windows.append(self._align())
+        return windows
+
+    def _align(self):
+        seconds = self.hop_frames * self.frame_seconds
+        start = self._hops[0][0] * seconds
+        end = (self._hops[-1][0] + 1) * seconds
+
+        aligner = Aligner()
+        for _, matches in self._hops:
+            aligner.add(matches)
+        if not aligner.is_confident(self.min_confidence, self.margin):
+            return WindowMatch(start, end, None, None, aligner.confidence,
+                               None, None)
+
+        sid, diff = aligner.song_id, aligner.offset
+        heard = [hop for hop, matches in self._hops
+                 if any(s == sid and abs(d - diff) <= 1 for s, d in matches)]
+        return WindowMatch(start, end, sid, diff * self.frame_seconds,
+                           aligner.confidence, heard[0] * seconds,
+                           (heard[-1] + 1) * seconds)
+
+
+class Timeline(object):
+    """
+    Merges consecutive `WindowMatch`es of the same play of a song into
+    `TimelineEntry`s. `song_name` looks the name of a song identifier up.
+    """
+
+    def __init__(self, song_name, tolerance=DEFAULT_TOLERANCE):
+        super(Timeline, self).__init__()
+        self.song_name = song_name
+        self.tolerance = tolerance
+        # [song_id, position, start, end, confidence, offset]
+        self._current = None
+
+    def add(self, window):
+        """
+        Returns the entries `window` closes, at most one.
+        """
+        current = self._current
+        if window.song_id is None:
+            # the window moved past the last audio of the song
+            if current is not None and window.start >= current[3]:
+                return self.close()
+            return []
+
+        if (current is not None and current[0] == window.song_id and
+                abs(current[1] - window.position) <= self.tolerance):
+            current[1] = window.position
+            current[3] = max(current[3], window.heard_end)
+            current[4] = max(current[4], window.confidence)
+            return []
+
+        closed = self.close()
+        self._current = [window.song_id, window.position, window.heard_start,
+                         window.heard_end, window.confidence,
+                         max(window.heard_start + window.position, 0.0)]
+        return closed
+
+    def close(self):
+        """
+        Ends the entry being merged, returns it in a list when there is one.
+        """
+        if self._current is None:
+            return []
+        song_id, _, start, end, confidence, offset = self._current
+        self._current = None
+        return [TimelineEntry(song_id, self.song_name(song_id), start, end,
+                              confidence, offset)]
+
+
+class SampleRing(object):
+    """
+    Preallocated buffer of the last `capacity` frames of interleaved 16-bit
+    audio, written by a capture callback and read by another thread. Writing
+    only copies into the buffer, so it is safe to call from an audio
+    callback that must not allocate or block for long.
+    """
+
+    def __init__(self, capacity, channels):
+        super(SampleRing, self).__init__()
+        self.capacity = int(capacity)
+        self.channels = channels
+        self._buffer = np.zeros((self.capacity, channels), dtype=np.int16)
+        self._lock = threading.Lock()
+        self.written = 0  # frames written since the start
+        self._read = 0  # frames read since the start
+
+    def write(self, data):
+        """
+        Appends interleaved samples, as a byte string or an int16 array,
+        overwriting the oldest frames once the buffer is full.
+        """
+        if isinstance(data, basestring):
+            data = np.frombuffer(data, dtype=np.int16)
+        frames = data.reshape(-1, self.channels)[-self.capacity:]
+        n = len(frames)
+        with self._lock:
+            start = self.written % self.capacity
+            head = min(n, self.capacity - start)
+            self._buffer[start:start + head] = frames[:head]
+            self._buffer[:n - head] = frames[head:]
+            self.written += n
+
+    def read(self):
+        """
+        Returns the frames written since the previous read as one array per
+        channel, and the number of frames overwritten before they were read.
+        """
+        with self._lock:
+            end = self.written
+            start = max(self._read, end - self.capacity)
+            dropped = start - self._read
+            self._read = end
+            first, last = start % self.capacity, end % self.capacity
+            if end - start == 0:
+                frames = self._buffer[:0].copy()
+            elif first < last:
+                frames = self._buffer[first:last].copy()
+            else:
+                frames = np.concatenate((self._buffer[first:],
+                                         self._buffer[:last]))
+        return [frames[:, c] for c in xrange(self.channels)], dropped
@@ -112,6 +112,60 @@ def autolabeldoubles(rects, ax):
         ax.text(rect.get_x() + rect.get_width() / 2., 1.05 * height, 
             '%s' % round(float(height), 3), ha='center', va='bottom')
 
+def compare_query_budgets(djv, test_folder, budgets, log=True, silent=False):
+    """
+    Recognizes every test file of `test_folder`, named like the ones
+    `generate_test_files` writes, once per query hash budget of `budgets`
+    (None for no budget), to measure what a budget costs in accuracy.
+
+    Returns {budget: (matched, accurate, mean hashes sent, mean query
+    seconds)}, `matched` the fraction of files recognized as the right song
+    and `accurate` the fraction also found within a second of their start.
+    """
+    from dejavu.recognize import FileRecognizer
+    test_files = [f for f in sorted(os.listdir(test_folder))
+                  if os.path.isfile(os.path.join(test_folder, f))]
+    query_config = djv.query_config
+    result_cache = djv.result_cache
+    # every budget must be measured, not answered from the cache
+    djv.result_cache = None
+    results = {}
+    try:
+        for budget in budgets:
+            djv.query_config = dict(query_config, max_hashes=budget)
+            recognizer = FileRecognizer(djv)
+            recognizer.timings = True
+            matched = accurate = hashes_sent = duration = 0
+            for f in test_files:
+                song = path_to_songname(f).split("_")[0]
+                # format: XXXX_offset_length.mp3
+                song_start_time = int(
+                    re.findall("\_[^\_]+", f)[0].lstrip("_ "))
+                extension = os.path.splitext(f)[1].replace(".", "")
+                result = recognizer.recognize(os.path.join(test_folder, f),
+                                              file_type=extension)
+                if not result:
+                    continue
+                hashes_sent += result["counts"].get("hashes_sent", 0)
+                duration += result[Dejavu.MATCH_TIME]
+                if result[Dejavu.SONG_NAME] != song:
+                    continue
+                matched += 1
+                if abs(result[Dejavu.OFFSET_SECS] - song_start_time) <= 1:
+                    accurate += 1
+            n = max(len(test_files), 1)
+            results[budget] = (matched / n, accurate / n, hashes_sent / n,
+                               duration / n)
+            log_msg("budget %s: %.1f%% matched, %.1f%% accurate, %d hashes "
+                    "sent, %.3fs per query" % (
+                        budget, 100 * matched / n, 100 * accurate / n,
+                        hashes_sent / n, duration / n),
+                    log=log, silent=silent)
+    finally:
+        djv.query_config = query_config
+        djv.result_cache = result_cache
+    return results
+
 class DejavuTest(object):
     def __init__(self, folder, seconds):
         super(DejavuTest, self).__init__()
@@ -0,0 +1,101 @@
+""" Per-stage timings and counts of a recognition or an ingested song.
+"""
+import time
+
+from contextlib import contextmanager
+
+# stages, in pipeline order
+STAGE_DECODE = "decode"
+STAGE_SPECGRAM = "specgram"
+STAGE_PEAKS = "peaks"
+STAGE_HASH = "hash"
+STAGE_DEDUPE = "dedupe"
+STAGE_QUERY = "query"
+STAGE_ALIGN = "align"
+STAGE_STORE = "store"
+STAGE_CACHE = "cache"
+
+# counts
+COUNT_SAMPLES = "samples"
+COUNT_PEAKS = "peaks"
+COUNT_HASHES = "hashes"
+COUNT_HASHES_SENT = "hashes_sent"
+COUNT_ROWS = "rows"
+COUNT_CHUNKS = "chunks"
+
+# Told about every stage entered and left, see `set_stage_hook`.
+_stage_hook = None
+
+
+def set_stage_hook(hook):
+    """
+    Installs an object whose `enter(name)` and `exit(name)` are called
+    around every `StageTimer` stage of this process, e.g. to measure memory
+    per stage. None removes it.
+    """
+    global _stage_hook
+    _stage_hook = hook
+
+
+class StageTimer(object):
+    """
+    Adds up the seconds spent in every stage and a few counters. Stages
+    entered more than once, e.g. once per channel, accumulate.
+
+    ```python
+    timer = StageTimer()
+    with timer.stage(STAGE_QUERY):
+        matches = list(db.return_matches(hashes))
+    timer.count(COUNT_ROWS, len(matches))
+    ```
+    """
+
+    def __init__(self):
+        super(StageTimer, self).__init__()
+        self.timings = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        hook = _stage_hook
+        if hook is not None:
+            hook.enter(name)
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = (self.timings.get(name, 0.0) +
+                                  time.time() - started)
+            if hook is not None:
+                hook.exit(name)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def merge(self, other):
+        """
+        Adds the timings and counts of `other` to this timer.
+        """
+        for name, seconds in other.timings.iteritems():
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+        for name, n in other.counts.iteritems():
+            self.count(name, n)
+
+
+class NullTimer(object):
+    """
+    Stand-in for a `StageTimer` when nothing is measured.
+    """
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, n=1):
+        pass
+
+    def merge(self, other):
+        pass
+
+
+NULL_TIMER = NullTimer()
@@ -3,6 +3,7 @@ from dejavu import Dejavu
 from optparse import OptionParser
 import matplotlib.pyplot as plt
 import time
+import json
 import shutil
 
 usage = "usage: %prog [options] TESTING_AUDIOFOLDER"
@@ -49,6 +50,17 @@ parser.add_option("--seed",
                   default=None,
                   type=int,
                   help='Random seed')
+parser.add_option("--budgets",
+                  action="store",
+                  dest="budgets",
+                  default=None,
+                  help='Comma separated query hash budgets to compare, '
+                       '"none" for no budget, e.g. none,2000,500')
+parser.add_option("--config",
+                  action="store",
+                  dest="config",
+                  default="dejavu.cnf",
+                  help='Dejavu configuration used to compare budgets')
 options, args = parser.parse_args()
 test_folder = args[0]
 
@@ -180,5 +192,32 @@ for sec in range(0, n_secs):
  	fig_name = os.path.join(options.results_folder, "matching_acc_%s.png" % test_seconds[sec])
  	fig.savefig(fig_name)
 
+# compare the accuracy of query hash budgets
+if options.budgets:
+	budgets = [None if b.strip().lower() == "none" else int(b)
+	           for b in options.budgets.split(",")]
+	with open(options.config) as f:
+		budget_djv = Dejavu(json.load(f))
+	budget_results = compare_query_budgets(budget_djv, options.temp_folder,
+	                                       budgets, log=options.log,
+	                                       silent=options.silent)
+	budget_djv.close()
+
+	fig = plt.figure()
+	ax = fig.add_subplot(111)
+	sent = [budget_results[b][2] for b in budgets]
+	ax.plot(sent, [100 * budget_results[b][0] for b in budgets], 'ro-',
+	        label='matched')
+	ax.plot(sent, [100 * budget_results[b][1] for b in budgets], 'bs-',
+	        label='accurate')
+	for b, x in zip(budgets, sent):
+		ax.annotate(str(b), (x, 100 * budget_results[b][0]))
+	ax.set_xlabel('Hashes sent per query')
+	ax.set_ylabel('Percentage of queries')
+	ax.set_title('Query Hash Budget Accuracy')
+	ax.legend(loc='lower right')
+	plt.grid()
+	fig.savefig(os.path.join(options.results_folder, "budget_accuracy.png"))
+
 # remove temporary folder
 shutil.rmtree(options.temp_folder)
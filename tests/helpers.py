@@ -0,0 +1,151 @@
+""" Test doubles: an in-memory database and synthetic audio.
+"""
+import time
+import wave
+import binascii
+import itertools
+
+import numpy as np
+
+from dejavu.database import Database
+from dejavu.fingerprint import DEFAULT_FS
+
+
+class MemoryDatabase(Database):
+    """
+    Database kept in dicts, `{"database_type": "memory"}`. Songs have no
+    catalog, the ingestion journal works like the one of the SQL backends.
+    """
+
+    type = "memory"
+
+    def __init__(self, **options):
+        super(MemoryDatabase, self).__init__()
+        self.songs = {}  # sid => [name, sha1, fingerprinted]
+        self.fingerprints = {}  # upper case hash => [(sid, offset)]
+        self.aliases = {}  # upper case sha1 => sid
+        self.journal = {}  # sid => [version, offset, time last moved]
+        self.queries = 0
+        self._ids = itertools.count(1)
+
+    def empty(self):
+        self.songs.clear()
+        self.fingerprints.clear()
+        self.aliases.clear()
+        self.journal.clear()
+
+    def delete_unfingerprinted_songs(self):
+        for sid, (_, _, fingerprinted) in self.songs.items():
+            if not fingerprinted:
+                self.delete_song(sid)
+
+    def delete_song(self, sid):
+        del self.songs[sid]
+        self.journal.pop(sid, None)
+        for rows in self.fingerprints.itervalues():
+            rows[:] = [row for row in rows if row[0] != sid]
+
+    def get_num_songs(self):
+        return sum(1 for _, _, done in self.songs.itervalues() if done)
+
+    def get_num_fingerprints(self):
+        return sum(len(rows) for rows in self.fingerprints.itervalues())
+
+    def set_song_fingerprinted(self, sid):
+        self.songs[sid][2] = True
+        self.journal.pop(sid, None)
+
+    def get_songs(self):
+        for sid, (name, sha1, done) in sorted(self.songs.items()):
+            if done:
+                yield Database.Song(sid, name, sha1)
+
+    def get_songs_after(self, sid):
+        for song_id, (_, sha1, done) in sorted(self.songs.items()):
+            if song_id > sid:
+                yield song_id, binascii.unhexlify(sha1), done
+
+    def get_song_aliases(self):
+        return (binascii.unhexlify(sha1) for sha1 in self.aliases)
+
+    def insert_alias(self, file_hash, sid):
+        self.aliases[file_hash.upper()] = sid
+
+    def get_unfinished_songs(self):
+        for sid, (version, offset, _) in sorted(self.journal.items()):
+            yield Database.UnfinishedSong(sid, self.songs[sid][1], None,
+                                          version, offset)
+
+    def delete_stale_songs(self, max_age):
+        for sid, (_, _, done) in self.songs.items():
+            entry = self.journal.get(sid)
+            if not done and (entry is None or
+                             entry[2] < time.time() - max_age):
+                self.delete_song(sid)
+
+    def insert_hash_batch(self, sid, hashes, offset, version=None):
+        self.insert_hashes(sid, hashes)
+        self.journal[sid] = [version, offset, time.time()]
+
+    def get_song_by_id(self, sid):
+        if sid not in self.songs:
+            return None
+        name, sha1, _ = self.songs[sid]
+        return Database.Song(sid, name, sha1)
+
+    def insert(self, hash, sid, offset):
+        self.fingerprints.setdefault(hash.upper(), []).append((sid, offset))
+
+    def insert_song(self, song_name, file_hash, catalog=None):
+        sid = next(self._ids)
+        self.songs[sid] = [song_name, file_hash.upper(), False]
+        self.journal[sid] = [None, 0, time.time()]
+        return sid
+
+    def query(self, hash):
+        self.queries += 1
+        return [(sid, offset) for sid, offset
+                in self.fingerprints.get(hash.upper(), ())
+                if self.songs[sid][2]]
+
+    def get_iterable_kv_pairs(self):
+        for hash, rows in self.fingerprints.iteritems():
+            for sid, offset in rows:
+                yield Database.Fingerprint(sid, offset, hash)
+
+    def insert_hashes(self, sid, hashes):
+        for hash, offset in hashes:
+            self.insert(hash, sid, offset)
+
+    def return_matches(self, hashes, catalog=None):
+        offsets = {}
+        for hash, offset in hashes:
+            offsets.setdefault(hash.upper(), set()).add(offset)
+        for hash, sampled in offsets.iteritems():
+            for sid, offset in self.query(hash):
+                for sample_offset in sampled:
+                    yield sid, offset - sample_offset
+
+
+def noise(seconds, seed, Fs=DEFAULT_FS):
+    """
+    Returns `seconds` of white noise as 16-bit samples, the same for the
+    same `seed`. Noise has peaks everywhere, so every part of it
+    fingerprints and matches like music would.
+    """
+    random = np.random.RandomState(seed)
+    return (random.randn(int(seconds * Fs)) * 4000).astype(np.int16)
+
+
+def write_wav(path, samples, Fs=DEFAULT_FS):
+    """
+    Writes mono 16-bit `samples` to the WAV file `path`.
+    """
+    f = wave.open(path, "wb")
+    try:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(Fs)
+        f.writeframes(np.asarray(samples, np.int16).tostring())
+    finally:
+        f.close()
@@ -0,0 +1,111 @@
+import time
+import unittest
+
+from dejavu import Dejavu
+from dejavu.align import Aligner
+from dejavu.fingerprint import DEFAULT_FS
+from dejavu.timing import StageTimer, COUNT_CHUNKS, COUNT_HASHES_SENT
+
+from tests.helpers import noise
+
+
+class AlignerTest(unittest.TestCase):
+
+    def test_leader(self):
+        aligner = Aligner()
+        aligner.add([(1, 10), (1, 10), (2, 3), (1, 11)])
+        aligner.add([(2, 3), (2, 3), (2, 4)])
+        self.assertEqual((aligner.song_id, aligner.offset, aligner.confidence),
+                         (2, 3, 3))
+        self.assertEqual(aligner.runner_up(), 2)
+        self.assertEqual((aligner.rows, aligner.chunks), (7, 2))
+
+    def test_empty(self):
+        aligner = Aligner()
+        aligner.add([])
+        self.assertEqual((aligner.song_id, aligner.confidence), (-1, 0))
+        self.assertEqual(aligner.runner_up(), 0)
+        self.assertFalse(aligner.is_confident(1, 2.0))
+
+    def test_is_confident(self):
+        aligner = Aligner()
+        aligner.add([(1, 0)] * 10 + [(2, 5)] * 4)
+        self.assertTrue(aligner.is_confident(10, 2.5))
+        self.assertFalse(aligner.is_confident(11, 2.5))
+        self.assertFalse(aligner.is_confident(10, 3.0))
+
+    def test_runner_up_counts_best_offset_only(self):
+        aligner = Aligner()
+        # song 2 has more matches, spread over offsets that don't align
+        aligner.add([(1, 0)] * 5 + [(2, diff) for diff in range(20)])
+        self.assertEqual(aligner.song_id, 1)
+        self.assertEqual(aligner.runner_up(), 1)
+        self.assertTrue(aligner.is_confident(5, 5.0))
+
+
+class ProgressiveMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.djv = self.dejavu()
+
+    def dejavu(self, **config):
+        config["database"] = {"database_type": "memory"}
+        djv = Dejavu(config)
+        for seed in range(3):
+            samples = noise(15, seed)
+            sid = djv.db.insert_song("song%d" % seed, "%040X" % seed)
+            djv.db.insert_hashes(sid, djv.query_hashes([samples]))
+            djv.db.set_song_fingerprinted(sid)
+        return djv
+
+    def query(self, djv, **kwargs):
+        clip = noise(15, 1)[5 * DEFAULT_FS:10 * DEFAULT_FS]
+        hashes = djv.query_hashes([clip])
+        timer = StageTimer()
+        match = djv.find_match_progressive(hashes, chunk_size=100,
+                                           timer=timer, **kwargs)
+        return match, timer.counts, hashes
+
+    def test_stops_once_confident(self):
+        match, counts, hashes = self.query(self.djv, min_confidence=20,
+                                           margin=2.0)
+        self.assertEqual(match["song_name"], "song1")
+        self.assertAlmostEqual(match["offset_seconds"], 5.0, delta=0.2)
+        distinct = len(set(h.upper() for h, _ in hashes))
+        self.assertLess(counts[COUNT_HASHES_SENT], distinct)
+        self.assertEqual(counts[COUNT_HASHES_SENT], 100 * counts[COUNT_CHUNKS])
+
+    def test_counts_every_hash_sent(self):
+        match, counts, hashes = self.query(self.djv, min_confidence=10 ** 9)
+        self.assertEqual(match["song_name"], "song1")
+        distinct = len(set(h.upper() for h, _ in hashes))
+        self.assertEqual(counts[COUNT_HASHES_SENT], distinct)
+        self.assertEqual(counts[COUNT_CHUNKS], (distinct + 99) // 100)
+
+    def test_deadline(self):
+        match, counts, _ = self.query(self.djv, min_confidence=10 ** 9,
+                                      deadline=time.time())
+        self.assertEqual(counts[COUNT_CHUNKS], 1)
+        self.assertEqual(counts[COUNT_HASHES_SENT], 100)
+
+    def test_ranked_hashes_keep_their_order(self):
+        djv = self.dejavu(query={"max_hashes": 300})
+        sent = []
+        lookup = djv.db.lookup_hashes_chunks
+
+        def lookup_hashes_chunks(hashes, *args, **kwargs):
+            sent.extend(hashes)
+            return lookup(hashes, *args, **kwargs)
+        djv.db.lookup_hashes_chunks = lookup_hashes_chunks
+
+        match, _, hashes = self.query(djv)
+        self.assertEqual(match["song_name"], "song1")
+        ranked = []
+        for h, _ in hashes:
+            if h.upper() not in ranked:
+                ranked.append(h.upper())
+        self.assertEqual(sent, ranked)
+
+
+if __name__ == "__main__":
+    unittest.main()
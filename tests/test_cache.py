@@ -0,0 +1,133 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dejavu import Dejavu
+from dejavu.cache import ResultCache, samples_key
+from dejavu.fingerprint import DEFAULT_FS
+from dejavu.recognize import FileRecognizer
+
+from tests.helpers import noise, write_wav
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def test_hit(self):
+        cache = ResultCache()
+        result = {"song_id": 1}
+        cache.put("key", 1, result)
+        cached = cache.get("key", 1)
+        self.assertEqual(cached, result)
+        # callers may add to the result they get
+        cached["match_time"] = 0.1
+        self.assertEqual(cache.get("key", 1), result)
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+
+    def test_other_version_misses(self):
+        cache = ResultCache()
+        cache.put("key", 1, None)
+        self.assertEqual(cache.get("key", 2, "missing"), "missing")
+        self.assertEqual(cache.get("key", 1, "missing"), "missing")
+        self.assertEqual(cache.misses, 2)
+
+    def test_expired(self):
+        cache = ResultCache(ttl=0.05)
+        cache.put("key", 1, "result")
+        self.assertEqual(cache.get("key", 1), "result")
+        time.sleep(0.1)
+        self.assertEqual(cache.get("key", 1), None)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ResultCache(maxsize=2)
+        cache.put("a", 1, "a")
+        cache.put("b", 1, "b")
+        cache.get("a", 1)
+        cache.put("c", 1, "c")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("b", 1), None)
+        self.assertEqual(cache.get("a", 1), "a")
+        self.assertEqual(cache.get("c", 1), "c")
+
+    def test_samples_key(self):
+        interleaved = noise(1, 0)
+        left, right = interleaved[0::2], interleaved[1::2]
+        self.assertEqual(samples_key([left, right], DEFAULT_FS),
+                         samples_key([left.copy(), right.copy()], DEFAULT_FS))
+        self.assertNotEqual(samples_key([left, right], DEFAULT_FS),
+                            samples_key([right, left], DEFAULT_FS))
+        self.assertNotEqual(samples_key([left], DEFAULT_FS),
+                            samples_key([left], 2 * DEFAULT_FS))
+        self.assertNotEqual(samples_key([left, right], DEFAULT_FS),
+                            samples_key([np.concatenate([left, right])],
+                                        DEFAULT_FS))
+
+
+class CacheInvalidationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.songs = []
+        for seed in range(2):
+            path = os.path.join(self.directory, "song%d.wav" % seed)
+            write_wav(path, noise(15, seed))
+            self.songs.append(path)
+        self.clip = os.path.join(self.directory, "clip.wav")
+        write_wav(self.clip, noise(15, 1)[5 * DEFAULT_FS:10 * DEFAULT_FS])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def dejavu(self, **config):
+        config.update(database={"database_type": "memory"},
+                      cache={"size": 10})
+        return Dejavu(config)
+
+    def recognize(self, djv):
+        match = FileRecognizer(djv).recognize_file(self.clip)
+        return match and match["song_name"]
+
+    def test_repeated_query_is_answered_from_cache(self):
+        djv = self.dejavu()
+        djv.fingerprint_file(self.songs[1])
+        self.assertEqual(self.recognize(djv), "song1")
+        queries = djv.db.queries
+        self.assertEqual(self.recognize(djv), "song1")
+        self.assertEqual(djv.db.queries, queries)
+        self.assertEqual(djv.result_cache.hits, 1)
+
+    def test_songs_added_here_invalidate(self):
+        djv = self.dejavu()
+        djv.fingerprint_file(self.songs[0])
+        self.assertEqual(self.recognize(djv), None)
+        djv.fingerprint_file(self.songs[1])
+        self.assertEqual(self.recognize(djv), "song1")
+
+    def test_songs_added_elsewhere_invalidate_on_refresh(self):
+        djv = self.dejavu(song_refresh_interval=0)
+        djv.fingerprint_file(self.songs[0])
+        self.assertEqual(self.recognize(djv), None)
+        # another process, sharing the database
+        other = Dejavu({"database": {"database_type": "memory"}})
+        other.db = djv.db
+        other.fingerprint_file(self.songs[1])
+        self.assertEqual(self.recognize(djv), "song1")
+
+    def test_songs_added_elsewhere_without_refresh(self):
+        djv = self.dejavu()
+        djv.fingerprint_file(self.songs[0])
+        self.assertEqual(self.recognize(djv), None)
+        other = Dejavu({"database": {"database_type": "memory"}})
+        other.db = djv.db
+        other.fingerprint_file(self.songs[1])
+        # only the ttl ends the stale answer
+        self.assertEqual(self.recognize(djv), None)
+        djv.result_cache.clear()
+        self.assertEqual(self.recognize(djv), "song1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from dejavu import fingerprint
+from dejavu.fingerprint import select_hashes
+
+from tests.helpers import noise
+
+
+class SelectHashesTest(unittest.TestCase):
+
+    def test_no_budget_keeps_every_hash(self):
+        hashes = [("a", 0, 5.0), ("b", 1, 1.0), ("c", 1, 9.0)]
+        self.assertEqual(select_hashes(hashes, None),
+                         [("a", 0), ("b", 1), ("c", 1)])
+
+    def test_common_hashes_are_left_out(self):
+        hashes = [("aa", 0, 5.0), ("bb", 1, 1.0), ("cc", 2, 9.0)]
+        self.assertEqual(select_hashes(hashes, None, common=set(["BB"])),
+                         [("aa", 0), ("cc", 2)])
+        self.assertEqual(select_hashes(hashes, 1, common=set(["CC"])),
+                         [("aa", 0)])
+
+    def test_budget_picks_strongest_of_every_slot(self):
+        # two slots, the first one much stronger
+        hashes = ([("early%d" % i, i, 100.0 + i) for i in range(10)] +
+                  [("late%d" % i, 10 + i, float(i)) for i in range(10)])
+        picked = select_hashes(hashes, 4, slot_hashes=2)
+        self.assertEqual(picked, [("early9", 9), ("late9", 19),
+                                  ("early8", 8), ("late8", 18)])
+
+    def test_budget_is_spread_over_the_query(self):
+        samples = noise(20, 0)
+        hashes = list(fingerprint.fingerprint(samples, strength=True))
+        picked = select_hashes(hashes, 200)
+        self.assertEqual(len(picked), 200)
+        self.assertTrue(set(picked) <= set((h, offset)
+                                           for h, offset, _ in hashes))
+        # every tenth of the query gets its share
+        last = max(offset for _, offset, _ in hashes) + 1
+        tenths = [0] * 10
+        for _, offset in picked:
+            tenths[offset * 10 // last] += 1
+        self.assertTrue(min(tenths) >= 15, tenths)
+
+    def test_strength_leaves_hashes_alone(self):
+        samples = noise(5, 1)
+        plain = set(fingerprint.fingerprint(samples))
+        ranked = set(fingerprint.fingerprint(samples, strength=True))
+        self.assertEqual(set((h, offset) for h, offset, _ in ranked), plain)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from dejavu.jobqueue import (SQLiteJobQueue, STATE_PENDING, STATE_RUNNING,
+                             STATE_DONE, STATE_FAILED)
+
+
+class SQLiteJobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "jobs.sqlite")
+        self.queue = self.open("a")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, worker, max_attempts=2):
+        queue = SQLiteJobQueue(self.path, worker=worker,
+                               max_attempts=max_attempts)
+        queue.setup()
+        return queue
+
+    def counts(self):
+        counts = self.queue.counts()
+        return (counts[STATE_PENDING], counts[STATE_RUNNING],
+                counts[STATE_DONE], counts[STATE_FAILED])
+
+    def test_enqueue_once_per_catalog(self):
+        self.queue.enqueue([("a.mp3", "AA"), ("b.mp3", "BB")])
+        # same content under another path
+        self.queue.enqueue([("copy/a.mp3", "AA")])
+        self.queue.enqueue([("a.mp3", "AA")], catalog="live")
+        self.assertEqual(self.counts(), (3, 0, 0, 0))
+
+        jobs = self.queue.claim(10)
+        self.assertEqual(sorted((job.file_sha1, job.filename, job.catalog)
+                                for job in jobs),
+                         [("AA", "a.mp3", None), ("AA", "a.mp3", "live"),
+                          ("BB", "b.mp3", None)])
+        self.assertEqual(set(job.attempts for job in jobs), set([1]))
+
+    def test_claim_is_exclusive(self):
+        self.queue.enqueue([("%d.mp3" % i, "%02d" % i) for i in range(5)])
+        other = self.open("b")
+        mine = self.queue.claim(3)
+        theirs = other.claim(10)
+        self.assertEqual(len(mine), 3)
+        self.assertEqual(len(theirs), 2)
+        self.assertFalse(set(job.file_sha1 for job in mine) &
+                         set(job.file_sha1 for job in theirs))
+        self.assertEqual(other.claim(10), [])
+        self.assertEqual(self.counts(), (0, 5, 0, 0))
+
+    def test_expired_lease_is_claimed_again(self):
+        self.queue.enqueue([("a.mp3", "AA")])
+        job, = self.queue.claim(1, lease=-1)
+        key = (job.file_sha1, job.catalog)
+
+        other = self.open("b")
+        stolen, = other.claim(1)
+        self.assertEqual(stolen.attempts, 2)
+        # the first worker finds out and must not store its result
+        self.assertEqual(self.queue.renew([key]), set())
+        self.assertFalse(self.queue.complete(key))
+        self.assertEqual(other.renew([key]), set([key]))
+        self.assertTrue(other.complete(key))
+        self.assertEqual(self.counts(), (0, 0, 1, 0))
+
+    def test_renewed_lease_is_kept(self):
+        self.queue.enqueue([("a.mp3", "AA")], catalog="live")
+        job, = self.queue.claim(1, lease=-1)
+        key = (job.file_sha1, job.catalog)
+        self.assertEqual(self.queue.renew([key], lease=300), set([key]))
+        self.assertEqual(self.open("b").claim(1), [])
+
+    def test_fail_until_max_attempts(self):
+        self.queue.enqueue([("a.mp3", "AA")])
+        job, = self.queue.claim(1)
+        self.assertTrue(self.queue.fail((job.file_sha1, None), "bad"))
+        self.assertEqual(self.counts(), (1, 0, 0, 0))
+        job, = self.queue.claim(1)
+        self.assertEqual(job.attempts, 2)
+        self.queue.fail((job.file_sha1, None), "bad again")
+        self.assertEqual(self.counts(), (0, 0, 0, 1))
+        self.assertEqual(self.queue.claim(1), [])
+
+        self.queue.retry_failed()
+        job, = self.queue.claim(1)
+        self.assertEqual(job.attempts, 1)
+
+    def test_crashing_file_is_given_up(self):
+        self.queue.enqueue([("a.mp3", "AA")])
+        # claimed by workers that die without failing it
+        self.queue.claim(1, lease=-1)
+        self.open("b").claim(1, lease=-1)
+        self.assertEqual(self.open("c").claim(1), [])
+        self.assertEqual(self.counts(), (0, 0, 0, 1))
+
+    def test_release_does_not_count_an_attempt(self):
+        self.queue.enqueue([("a.mp3", "AA")])
+        job, = self.queue.claim(1)
+        self.queue.release([(job.file_sha1, job.catalog)])
+        self.assertEqual(self.counts(), (1, 0, 0, 0))
+        job, = self.open("b").claim(1)
+        self.assertEqual(job.attempts, 1)
+
+    def test_enqueue_requeues_finished_jobs(self):
+        self.queue.enqueue([("a.mp3", "AA"), ("b.mp3", "BB")])
+        for job in self.queue.claim(2):
+            self.queue.complete((job.file_sha1, job.catalog))
+        self.queue.enqueue([("a.mp3", "AA"), ("b.mp3", "BB"), ("c.mp3", "CC")])
+        self.assertEqual(self.counts(), (3, 0, 0, 0))
+
+    def test_enqueue_leaves_running_jobs_alone(self):
+        self.queue.enqueue([("a.mp3", "AA")])
+        job, = self.queue.claim(1)
+        self.queue.enqueue([("moved/a.mp3", "AA")])
+        self.assertEqual(self.counts(), (0, 1, 0, 0))
+        self.assertTrue(self.queue.complete((job.file_sha1, job.catalog)))
+
+    def test_pickle(self):
+        queue = pickle.loads(pickle.dumps(self.queue))
+        self.assertEqual((queue.path, queue.worker, queue.max_attempts),
+                         (self.path, "a", 2))
+        self.queue.enqueue([("a.mp3", "AA")])
+        self.assertEqual(len(queue.claim(1)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dejavu import Dejavu, _journal_batches
+from dejavu import fingerprint
+
+from tests.helpers import noise, write_wav
+
+
+class JournalBatchesTest(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.hashes = [("%x" % i, int(offset)) for i, offset
+                       in enumerate(random.randint(0, 50, 500))]
+
+    def test_batches(self):
+        batches = list(_journal_batches(self.hashes, 0, 40))
+        stored = []
+        self.assertTrue(all(len(batch) >= 40 for batch, _ in batches[:-1]))
+        for batch, offset in batches:
+            # everything below the journal offset is stored
+            self.assertTrue(all(h[1] < offset for h in batch))
+            stored.extend(batch)
+            self.assertEqual(
+                sorted(h for h in self.hashes if h[1] < offset),
+                sorted(stored))
+        self.assertEqual(sorted(stored), sorted(self.hashes))
+        self.assertEqual(batches[-1][1], max(h[1] for h in self.hashes) + 1)
+
+    def test_offset_is_never_split(self):
+        for batch, offset in _journal_batches(self.hashes, 0, 7):
+            self.assertFalse(any(h[1] == offset for h in batch))
+
+    def test_start(self):
+        stored = [h for batch, _ in _journal_batches(self.hashes, 20, 40)
+                  for h in batch]
+        self.assertEqual(sorted(stored),
+                         sorted(h for h in self.hashes if h[1] >= 20))
+
+    def test_nothing_to_store(self):
+        self.assertEqual(list(_journal_batches([], 0, 40)), [])
+        self.assertEqual(list(_journal_batches(self.hashes, 50, 40)), [])
+
+
+class FingerprintFromTest(unittest.TestCase):
+
+    def test_same_hashes_as_whole_channel(self):
+        samples = noise(15, 0)
+        hashes = set(fingerprint.fingerprint(samples))
+        for offset in (0, 1, 20, 50):
+            self.assertEqual(
+                set(fingerprint.fingerprint_from(samples, offset)),
+                set(h for h in hashes if h[1] >= offset))
+
+
+class Crash(Exception):
+    pass
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.song = os.path.join(self.directory, "song.wav")
+        write_wav(self.song, noise(15, 0))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def dejavu(self, **ingest):
+        ingest.setdefault("journal_batch", 300)
+        return Dejavu({"database": {"database_type": "memory"},
+                       "ingest": ingest})
+
+    def crash_after(self, djv, batches):
+        insert = djv.db.insert_hash_batch
+
+        def insert_hash_batch(*args, **kwargs):
+            if len(calls) == batches:
+                raise Crash()
+            calls.append(args)
+            return insert(*args, **kwargs)
+        calls = []
+        djv.db.insert_hash_batch = insert_hash_batch
+
+    def rows(self, djv):
+        return sorted((h, offset) for h, rows in djv.db.fingerprints.items()
+                      for _, offset in rows)
+
+    def test_resume(self):
+        djv = self.dejavu()
+        self.crash_after(djv, 3)
+        self.assertRaises(Crash, djv.fingerprint_file, self.song)
+        (sid, (_, offset, _)), = djv.db.journal.items()
+        self.assertTrue(offset > 0)
+        self.assertEqual(djv.db.get_num_songs(), 0)
+
+        # the next run continues the same song
+        resumed = self.dejavu()
+        resumed.db = djv.db
+        del resumed.db.insert_hash_batch
+        result = resumed.fingerprint_file(self.song)
+        self.assertEqual(result.song_id, sid)
+        self.assertTrue(result.num_hashes < len(self.rows(resumed)))
+        self.assertEqual(resumed.db.journal, {})
+        self.assertEqual(resumed.db.get_num_songs(), 1)
+
+        clean = self.dejavu()
+        clean.fingerprint_file(self.song)
+        self.assertEqual(self.rows(resumed), self.rows(clean))
+
+    def test_unfinished_song_does_not_match(self):
+        djv = self.dejavu()
+        djv.songhashes_set
+        self.crash_after(djv, 1)
+        self.assertRaises(Crash, djv.fingerprint_file, self.song)
+        djv.refresh_songs()
+        self.assertEqual(len(djv.songhashes_set), 0)
+        self.assertFalse(djv.is_fingerprinted(
+            [djv.db.songs.values()[0][1]]))
+
+    def test_refresh_picks_up_songs_finished_later(self):
+        djv = self.dejavu()
+        other = self.dejavu()
+        other.db = djv.db
+        djv.songhashes_set
+        self.crash_after(other, 1)
+        self.assertRaises(Crash, other.fingerprint_file, self.song)
+
+        # a later song, finished, is picked up past the unfinished one
+        later = os.path.join(self.directory, "later.wav")
+        write_wav(later, noise(5, 1))
+        del other.db.insert_hash_batch
+        other.fingerprint_file(later)
+        djv.refresh_songs()
+        self.assertEqual(len(djv.songhashes_set), 1)
+
+        other.fingerprint_file(self.song)
+        djv.refresh_songs()
+        self.assertEqual(len(djv.songhashes_set), 2)
+        self.assertEqual(djv._songs_unfinished, {})
+
+    def test_stale_songs_are_reclaimed(self):
+        djv = self.dejavu()
+        self.crash_after(djv, 1)
+        self.assertRaises(Crash, djv.fingerprint_file, self.song)
+
+        djv.reclaim_unfinished_songs()
+        self.assertEqual(len(djv.db.songs), 1)
+        sid, = djv.db.journal
+        djv.db.journal[sid][2] -= 2 * 24 * 3600
+        # done by the next Dejavu using the database
+        djv.reclaim_unfinished_songs()
+        self.assertEqual(djv.db.songs, {})
+        self.assertEqual(djv.db.get_num_fingerprints(), 0)
+
+    def test_reclaim_disabled(self):
+        djv = self.dejavu(unfinished_max_age=None)
+        self.crash_after(djv, 1)
+        self.assertRaises(Crash, djv.fingerprint_file, self.song)
+        sid, = djv.db.journal
+        djv.db.journal[sid][2] = 0
+        djv.reclaim_unfinished_songs()
+        self.assertEqual(len(djv.db.songs), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
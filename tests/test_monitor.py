@@ -0,0 +1,114 @@
+import unittest
+from StringIO import StringIO
+
+import numpy as np
+
+from dejavu import Dejavu
+from dejavu.fingerprint import DEFAULT_FS
+from dejavu.monitor import Monitor
+from dejavu.stream import SlidingMatcher
+
+from tests.helpers import noise
+
+
+class MonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.djv = Dejavu({"database": {"database_type": "memory"}})
+        self.songs = [noise(15, seed) for seed in range(3)]
+        for seed, samples in enumerate(self.songs):
+            sid = self.djv.db.insert_song("song%d" % seed, "%040X" % seed)
+            self.djv.db.insert_hashes(sid, self.djv.query_hashes([samples]))
+            self.djv.db.set_song_fingerprinted(sid)
+        # two stations: song 1 then song 0, and song 2 joined after about
+        # four seconds, on a frame boundary so its hashes are the same
+        self.streams = {
+            "a": np.concatenate((self.songs[1], self.songs[0][3 * DEFAULT_FS:])),
+            "b": self.songs[2][22 * 2048:],
+        }
+
+    def alone(self, samples):
+        """
+        Returns the recognized windows of a stream matched on its own.
+        """
+        matcher = SlidingMatcher(self.djv, DEFAULT_FS, 1)
+        windows = []
+        for start in xrange(0, len(samples), DEFAULT_FS):
+            windows.extend(matcher.feed([samples[start:start + DEFAULT_FS]]))
+        windows.extend(matcher.flush())
+        return [w for w in windows if w.song_id is not None]
+
+    def summary(self, windows):
+        return [(w.start, w.end, w.song_id, round(w.position, 3),
+                 w.confidence) for w in windows]
+
+    def by_stream(self, events):
+        streams = {}
+        for event in events:
+            streams.setdefault(event.stream, []).append(event.match)
+        return streams
+
+    def test_feed_matches_like_streams_alone(self):
+        monitor = Monitor(self.djv)
+        for name in self.streams:
+            monitor.add_stream(name)
+        events = []
+        for start in xrange(0, len(self.streams["a"]), DEFAULT_FS):
+            # "b" is shorter and ends first
+            events.extend(monitor.feed(dict(
+                (name, [samples[start:start + DEFAULT_FS]])
+                for name, samples in self.streams.items()
+                if start < len(samples))))
+        for name in self.streams:
+            events.extend(monitor.remove_stream(name))
+
+        streams = self.by_stream(events)
+        self.assertEqual(sorted(streams), ["a", "b"])
+        for name, samples in self.streams.items():
+            self.assertEqual(self.summary(streams[name]),
+                             self.summary(self.alone(samples)))
+        self.assertEqual(set(w.song_id for w in streams["b"]), set([3]))
+        self.assertEqual(monitor.matchers, {})
+
+    def test_one_lookup_per_feed(self):
+        monitor = Monitor(self.djv)
+        for name in self.streams:
+            monitor.add_stream(name)
+        lookups = []
+        lookup = self.djv.lookup_hashes
+
+        def lookup_hashes(hashes, *args, **kwargs):
+            lookups.append(hashes)
+            return lookup(hashes, *args, **kwargs)
+        self.djv.lookup_hashes = lookup_hashes
+
+        chunk = 3 * DEFAULT_FS
+        feeds = 0
+        for start in xrange(0, len(self.streams["b"]), chunk):
+            monitor.feed(dict(
+                (name, [samples[start:start + chunk]])
+                for name, samples in self.streams.items()))
+            feeds += 1
+        self.assertTrue(0 < len(lookups) <= feeds)
+
+    def test_stream_names_are_unique(self):
+        monitor = Monitor(self.djv)
+        monitor.add_stream("a")
+        self.assertRaises(ValueError, monitor.add_stream, "a")
+
+    def test_watch(self):
+        monitor = Monitor(self.djv, gather=0.1, backlog=2)
+        for name, samples in self.streams.items():
+            monitor.watch(name, StringIO(samples.astype("<i2").tostring()))
+        streams = self.by_stream(monitor.events())
+        self.assertEqual(monitor.matchers, {})
+        for name, samples in self.streams.items():
+            # chunks are gathered differently, the songs heard are the same
+            self.assertEqual(
+                set((w.song_id, round(w.position)) for w in streams[name]),
+                set((w.song_id, round(w.position))
+                    for w in self.alone(samples)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import time
+import signal
+import unittest
+
+from dejavu.scheduler import IngestScheduler, WorkerTimeout, WorkerDied
+
+
+def work(filename):
+    if filename.startswith("hang"):
+        time.sleep(60)
+    elif filename.startswith("slow"):
+        time.sleep(1.5)
+    elif filename.startswith("die"):
+        os.kill(os.getpid(), signal.SIGKILL)
+    else:
+        time.sleep(0.2)
+    return filename.upper()
+
+
+def load(filename):
+    return filename
+
+
+def work_loaded(filename, loaded):
+    return work(loaded)
+
+
+class IngestSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = None
+
+    def tearDown(self):
+        if self.scheduler is not None:
+            self.scheduler.close()
+
+    def run_files(self, filenames, consume=0, **options):
+        self.scheduler = IngestScheduler(**options)
+        results = {}
+        for filename, ok, value, _ in self.scheduler.run(work, filenames):
+            results[filename] = (ok, value)
+            time.sleep(consume)
+        return results
+
+    def test_results(self):
+        results = self.run_files(["a", "b", "c"], nprocesses=2)
+        self.assertEqual(results, {"a": (True, "A"), "b": (True, "B"),
+                                   "c": (True, "C")})
+
+    def test_timeout_quarantines(self):
+        results = self.run_files(["a", "hang"], nprocesses=2,
+                                 timeout_base=1, timeout_per_mb=0)
+        self.assertEqual(results["a"], (True, "A"))
+        self.assertFalse(results["hang"][0])
+        self.assertIsInstance(results["hang"][1], WorkerTimeout)
+        self.assertEqual(self.scheduler.quarantine, ["hang"])
+        # the pool is usable, and closable, after a kill
+        self.assertEqual([r[:2] for r in self.scheduler.run(work, ["x"])],
+                         [("x", True)])
+
+    def test_retry_quarantined(self):
+        results = self.run_files(["slow", "hang"], nprocesses=2,
+                                 timeout_base=1, timeout_per_mb=0)
+        self.assertEqual(results, {"slow": (False, results["slow"][1]),
+                                   "hang": (False, results["hang"][1])})
+        self.assertEqual(sorted(self.scheduler.quarantine), ["hang", "slow"])
+        # twice the budget is enough for the slow file only
+        retried = dict((filename, ok) for filename, ok, _, _
+                       in self.scheduler.retry_quarantined(work))
+        self.assertEqual(retried, {"slow": True, "hang": False})
+        self.assertEqual(self.scheduler.quarantine, ["hang"])
+
+    def test_dead_worker_fails_its_file(self):
+        for timeout in (None, 30):
+            results = self.run_files(["a", "die", "b"], nprocesses=2,
+                                     timeout_base=timeout)
+            self.assertEqual(results["a"], (True, "A"))
+            self.assertEqual(results["b"], (True, "B"))
+            self.assertIsInstance(results["die"][1], WorkerDied)
+            self.assertEqual(self.scheduler.quarantine, [])
+            self.scheduler.close()
+
+    def test_dead_worker_requeues_its_batch(self):
+        self.scheduler = IngestScheduler(2, timeout_base=None, prefetch=2)
+        filenames = ["a", "die", "b", "c", "d", "e"]
+        results = dict((filename, ok) for filename, ok, _, _
+                       in self.scheduler.run(work_loaded, filenames,
+                                             loader=load))
+        self.assertEqual(sorted(results), sorted(filenames))
+        self.assertEqual([f for f, ok in results.items() if not ok], ["die"])
+
+    def test_slow_consumer(self):
+        # files finishing while the caller stores earlier results are not
+        # past their deadline
+        filenames = ["f%d" % i for i in range(6)]
+        results = self.run_files(filenames, consume=0.8, nprocesses=4,
+                                 timeout_base=0.5, timeout_per_mb=0)
+        self.assertEqual(results, dict((f, (True, f.upper()))
+                                       for f in filenames))
+        self.assertEqual(self.scheduler.quarantine, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dejavu import Dejavu
+from dejavu import fingerprint
+from dejavu.fingerprint import DEFAULT_FS, StreamFingerprinter
+from dejavu.recognize import TimelineRecognizer
+from dejavu.stream import SlidingMatcher, Timeline, WindowMatch
+
+from tests.helpers import noise, write_wav
+
+
+class StreamFingerprinterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.samples = noise(20, 0)
+        self.hashes = set(fingerprint.fingerprint(self.samples))
+
+    def feed(self, blocks):
+        fingerprinter = StreamFingerprinter()
+        hashes = []
+        start = 0
+        for size in blocks:
+            hashes.extend(fingerprinter.feed(self.samples[start:start + size]))
+            start += size
+        hashes.extend(fingerprinter.feed(self.samples[start:]))
+        hashes.extend(fingerprinter.flush())
+        return hashes, fingerprinter
+
+    def test_same_hashes_as_whole_channel(self):
+        for blocks in ([], [1000] * 50, [4096, 1, 2047, 30000, 7]):
+            hashes, _ = self.feed(blocks)
+            self.assertEqual(set(hashes), self.hashes)
+            self.assertEqual(len(hashes), len(set(hashes)))
+
+    def test_hashes_are_final_when_returned(self):
+        fingerprinter = StreamFingerprinter()
+        hashed = 0
+        for start in xrange(0, len(self.samples), 5000):
+            hashes = fingerprinter.feed(self.samples[start:start + 5000])
+            # nothing below the previous mark comes later
+            self.assertTrue(all(offset >= hashed for _, offset in hashes))
+            self.assertTrue(all(offset < fingerprinter.hashed or
+                                offset >= hashed for _, offset in hashes))
+            hashed = fingerprinter.hashed
+        self.assertTrue(all(offset >= hashed
+                            for _, offset in fingerprinter.flush()))
+
+    def test_external_specgram(self):
+        fingerprinter = StreamFingerprinter()
+        hashes = []
+        for start in xrange(0, len(self.samples), 10000):
+            frames = fingerprinter.take_frames(
+                self.samples[start:start + 10000])
+            hashes.extend(fingerprinter.add_specgram(
+                fingerprint.frames_specgram(frames, DEFAULT_FS)))
+        hashes.extend(fingerprinter.flush())
+        self.assertEqual(set(hashes), self.hashes)
+
+
+def window(start, song_id=None, position=None, confidence=50):
+    if song_id is None:
+        return WindowMatch(start, start + 10, None, None, 3, None, None)
+    return WindowMatch(start, start + 10, song_id, position, confidence,
+                       start, start + 10)
+
+
+class TimelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timeline = Timeline(lambda sid: "song%d" % sid)
+
+    def add(self, windows):
+        entries = []
+        for w in windows:
+            entries.extend(self.timeline.add(w))
+        return entries + self.timeline.close()
+
+    def test_merges_windows_of_one_play(self):
+        entries = self.add([window(0, 1, 30.0, 40), window(2.5, 1, 30.2, 60),
+                            window(5, 1, 29.9, 50)])
+        self.assertEqual(len(entries), 1)
+        entry = entries[0]
+        self.assertEqual((entry.song_id, entry.song_name, entry.start,
+                          entry.end, entry.confidence, entry.offset),
+                         (1, "song1", 0, 15, 60, 30.0))
+
+    def test_splits_on_another_song_or_position(self):
+        entries = self.add([window(0, 1, 30.0), window(2.5, 2, -2.5),
+                            window(5, 2, 40.0)])
+        self.assertEqual([(e.song_id, e.start) for e in entries],
+                         [(1, 0), (2, 2.5), (2, 5)])
+
+    def test_unrecognized_windows(self):
+        # silence inside the last window of a song keeps it open
+        entries = self.add([window(0, 1, 0.0), window(5), window(20),
+                            window(25)])
+        self.assertEqual([(e.song_id, e.end) for e in entries], [(1, 10)])
+        self.assertEqual(self.add([window(0), window(2.5)]), [])
+
+
+class SlidingMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.djv = Dejavu({"database": {"database_type": "memory"}})
+        self.songs = [noise(15, seed) for seed in range(3)]
+        for seed, samples in enumerate(self.songs):
+            sid = self.djv.db.insert_song("song%d" % seed, "%040X" % seed)
+            self.djv.db.insert_hashes(sid, self.djv.query_hashes([samples]))
+            self.djv.db.set_song_fingerprinted(sid)
+        # all of song 1, then song 0 from its fourth second on
+        self.stream = np.concatenate((self.songs[1],
+                                      self.songs[0][3 * DEFAULT_FS:]))
+
+    def test_windows(self):
+        matcher = SlidingMatcher(self.djv, DEFAULT_FS, 1)
+        windows = []
+        for start in xrange(0, len(self.stream), DEFAULT_FS):
+            windows.extend(matcher.feed(
+                [self.stream[start:start + DEFAULT_FS]]))
+        windows.extend(matcher.flush())
+
+        # a window ends every hop, the first ones are shorter
+        hop = windows[1].end - windows[0].end
+        self.assertAlmostEqual(hop, 2.5, delta=0.1)
+        for previous, w in zip(windows, windows[1:]):
+            self.assertAlmostEqual(w.end - previous.end, hop)
+            self.assertAlmostEqual(w.start, max(w.end - 4 * hop, 0))
+        self.assertTrue(windows[-1].end >= 27)
+
+        # song ids follow insertion, song 1 is 2
+        plays = [(w.song_id, round(w.position)) for w in windows]
+        self.assertEqual(plays[0], (2, 0))
+        self.assertEqual(plays[-1], (1, -12))
+        switch = plays.index((1, -12))
+        self.assertEqual(set(plays[:switch]), set([(2, 0)]))
+        self.assertEqual(set(plays[switch:]), set([(1, -12)]))
+        self.assertAlmostEqual(windows[switch - 1].heard_end, 15, delta=2.5)
+
+    def test_timeline(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "stream.wav")
+            write_wav(path, self.stream)
+            entries = TimelineRecognizer(self.djv).recognize(path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([e.song_name for e in entries], ["song1", "song0"])
+        first, second = entries
+        self.assertAlmostEqual(first.start, 0, delta=2.5)
+        self.assertAlmostEqual(first.offset, 0, delta=0.5)
+        self.assertAlmostEqual(second.start, 15, delta=2.5)
+        self.assertAlmostEqual(second.end, 27, delta=2.5)
+        self.assertAlmostEqual(second.offset - second.start, -12, delta=0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()